@@ -1,28 +1,84 @@
 # File: `aemet.py`
+import json
 import logging
 import os
-from typing import Optional, Any
+import tempfile
+import threading
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Optional, Tuple
 import requests
 
+from http_transport import HttpTransport
+from token_store import file_lock
+
 _logger = logging.getLogger(__name__)
 
+DEFAULT_WEATHER_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "madrid-mobility", "aemet_weather.json"
+)
+
 
-def get_weather(datos_url: str, timeout: int = 10, logger: Optional[logging.Logger] = None) -> Any:
+def get_weather(
+        datos_url: str,
+        timeout: int = 10,
+        logger: Optional[logging.Logger] = None,
+        transport: Optional[HttpTransport] = None,
+) -> Any:
     """
     Descarga y devuelve el JSON de la URL `datos_url`.
+    Si se pasa `transport`, reutiliza su pool de conexiones.
     Lanza requests.RequestException en errores de conexión y RuntimeError si la respuesta no es JSON.
     """
+    datos, _validators, _not_modified = _download_datos(
+        datos_url, timeout=timeout, logger=logger, transport=transport
+    )
+    return datos
+
+
+def _download_datos(
+        datos_url: str,
+        timeout: int = 10,
+        logger: Optional[logging.Logger] = None,
+        transport: Optional[HttpTransport] = None,
+        validators: Optional[Dict[str, str]] = None,
+) -> Tuple[Any, Dict[str, str], bool]:
+    """
+    Como `get_weather`, pero con petición condicional: envía `If-None-Match` /
+    `If-Modified-Since` a partir de `validators` y devuelve
+    `(datos, nuevos_validadores, no_modificado)`.
+
+    Los errores transitorios (429, 5xx, conexión y timeout) se propagan para
+    que `UpstreamGuard` reintente y cuente la caída en el circuito.
+    """
     logger = logger or _logger
+    http_get = transport.get if transport is not None else requests.get
 
     if not datos_url:
         logger.error("❌ No se proporcionó 'datos_url'. La API de AEMET no devolvió una URL válida.")
-        return None
+        return None, {}, False
+
+    headers = {}
+    if validators:
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
 
     try:
         logger.info(f"🌍 URL intermedia obtenida: {datos_url}")
 
         # SEGUNDA PETICIÓN: Vamos a buscar los datos reales a esa URL
-        respuesta_final = requests.get(datos_url, timeout=timeout)
+        respuesta_final = http_get(datos_url, headers=headers, timeout=timeout)
+
+        if respuesta_final.status_code == 429 or respuesta_final.status_code >= 500:
+            # Se propaga para que el caller respete Retry-After o reintente con backoff
+            respuesta_final.raise_for_status()
+
+        if respuesta_final.status_code == 304:
+            logger.info("♻️ Datos climáticos sin cambios (HTTP 304).")
+            return None, dict(validators or {}), True
 
         if respuesta_final.status_code == 200:
             # AEMET a veces devuelve la codificación en 'latin-1'
@@ -31,22 +87,239 @@ def get_weather(datos_url: str, timeout: int = 10, logger: Optional[logging.Logg
 
             logger.info("✅ Datos climáticos descargados correctamente.")
             logger.debug(f"Payload recibido: {datos_climaticos}")
-            return datos_climaticos
+            new_validators = {
+                "etag": respuesta_final.headers.get("ETag"),
+                "last_modified": respuesta_final.headers.get("Last-Modified"),
+            }
+            return datos_climaticos, {k: v for k, v in new_validators.items() if v}, False
 
         else:
             logger.error(f"❌ Error al descargar los datos finales: HTTP {respuesta_final.status_code}")
-            return None
+            return None, {}, False
 
+    except requests.exceptions.HTTPError as e:
+        logger.warning(f"⏳ Error HTTP transitorio al descargar los datos de AEMET: {e}")
+        raise
     except requests.exceptions.RequestException as e:
         logger.error(f"💥 Error de conexión al obtener datos finales de AEMET: {e}")
-        return None
+        raise
     except ValueError:
         logger.error("💥 La respuesta final de AEMET no es un JSON válido.")
+        return None, {}, False
+
+
+def _parse_fint(fint: Any) -> Optional[datetime]:
+    """`fint` de AEMET es la hora UTC de fin de la observación, sin zona horaria."""
+    if not isinstance(fint, str):
         return None
+    try:
+        dt = datetime.fromisoformat(fint)
+    except ValueError:
+        return None
+    return dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt
+
+
+@dataclass
+class _CacheEntry:
+    datos: Any
+    expires_at: float
+    fetched_at: float
+    validators: Dict[str, str] = field(default_factory=dict)
+
+
+class WeatherCache:
+    """
+    Caché por estación de las series de observación de AEMET.
+
+    La validez de cada entrada se calcula a partir del `fint` de la última
+    observación: la siguiente llega `cadence` segundos después y AEMET la
+    publica con unos `publish_lag` segundos de retraso. Hasta entonces no se
+    vuelve a llamar a la API.
+
+    - Si la entrada caducó y otro hilo ya la está refrescando, se sirve el
+      último valor bueno sin esperar (stale-while-revalidate).
+    - Si el refresco falla (429, error de red...), se sirve el último valor
+      bueno mientras no supere `max_stale` segundos (stale-if-error) y se
+      reintenta pasados `retry_after_error` segundos.
+    - Los validadores `ETag`/`Last-Modified` se reenvían en la descarga de
+      datos para aprovechar `304 Not Modified` si el servidor lo soporta.
+
+    Las entradas se persisten en `path` (JSON, escritura atómica bajo
+    bloqueo entre procesos), de modo que en modo cron cada ejecución parte de
+    la caché de la anterior y sólo llama a AEMET cuando hay una observación
+    nueva. Si el fichero no se puede leer o escribir se sigue en memoria.
+
+    Args:
+        path (Optional[str]): Fichero JSON; por defecto `AEMET_WEATHER_CACHE`
+            o `~/.cache/madrid-mobility/aemet_weather.json`.
+        cadence (int): Segundos entre observaciones de una estación.
+        publish_lag (int): Retraso típico de publicación tras `fint`.
+        min_ttl (int): Validez mínima de una entrada recién descargada.
+        retry_after_error (int): Espera antes de reintentar tras un fallo.
+        max_stale (int): Antigüedad máxima de un valor servido tras fallos.
+    """
+
+    def __init__(
+            self,
+            path: Optional[str] = None,
+            cadence: int = 3600,
+            publish_lag: int = 900,
+            min_ttl: int = 300,
+            retry_after_error: int = 120,
+            max_stale: int = 6 * 3600,
+    ) -> None:
+        self.cadence = cadence
+        self.publish_lag = publish_lag
+        self.min_ttl = min_ttl
+        self.retry_after_error = retry_after_error
+        self.max_stale = max_stale
+        self.path = path or os.getenv("AEMET_WEATHER_CACHE", DEFAULT_WEATHER_CACHE)
+        self._entries: Optional[Dict[str, _CacheEntry]] = None
+        self._locks: Dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+    def _lock_for(self, key: str) -> threading.Lock:
+        with self._guard:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _loaded(self) -> Dict[str, _CacheEntry]:
+        if self._entries is None:
+            with self._guard:
+                if self._entries is None:
+                    self._entries = self._read()
+        return self._entries
+
+    def _read(self) -> Dict[str, _CacheEntry]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        raw = data.get("entries") if isinstance(data, dict) else None
+        entries = {}
+        for key, item in (raw if isinstance(raw, dict) else {}).items():
+            try:
+                entries[key] = _CacheEntry(
+                    datos=item["datos"],
+                    expires_at=float(item["expires_at"]),
+                    fetched_at=float(item["fetched_at"]),
+                    validators=dict(item.get("validators") or {}),
+                )
+            except (KeyError, TypeError, ValueError):
+                continue
+        return entries
+
+    def _persist(self, key: str, entry: _CacheEntry) -> None:
+        try:
+            self._save(key, entry)
+        except OSError as e:
+            # La caché en disco es una optimización: si no se puede escribir seguimos en memoria
+            _logger.debug("No se pudo guardar la caché de AEMET en %s: %s", self.path, e)
+
+    def _save(self, key: str, entry: _CacheEntry) -> None:
+        # Se relee bajo bloqueo para no perder lo que hayan guardado otros procesos (shards)
+        directory = os.path.dirname(self.path) or "."
+        with file_lock(self.path + ".lock"):
+            merged = self._read()
+            merged[key] = entry
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".aemet_weather.")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                    json.dump({"entries": {k: asdict(e) for k, e in merged.items()}}, fh, ensure_ascii=False)
+                os.replace(tmp, self.path)
+            except OSError:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+
+    def peek(self, key: str) -> Any:
+        """Último valor bueno de `key`, aunque esté caducado (o None)."""
+        entry = self._loaded().get(key)
+        return entry.datos if entry else None
+
+    def ttl_for(self, datos: Any, now: Optional[float] = None) -> float:
+        """Instante (epoch) hasta el que `datos` se considera vigente."""
+        now = time.time() if now is None else now
+        last = datos[-1] if isinstance(datos, list) and datos else None
+        observed = _parse_fint(last.get("fint")) if isinstance(last, dict) else None
+        if observed is None:
+            return now + self.min_ttl
+        next_available = observed.timestamp() + self.cadence + self.publish_lag
+        return max(now + self.min_ttl, next_available)
+
+    def get(
+            self,
+            key: str,
+            fetch: Callable[[Dict[str, str]], Tuple[Any, Dict[str, str], bool]],
+    ) -> Any:
+        """
+        Devuelve la serie de `key`, refrescándola con `fetch(validadores)` si ha
+        caducado. `fetch` devuelve `(datos, validadores, no_modificado)`.
+        """
+        now = time.time()
+        entry = self._loaded().get(key)
+        if entry and entry.expires_at > now:
+            return entry.datos
+
+        lock = self._lock_for(key)
+        if entry is not None:
+            if not lock.acquire(blocking=False):
+                # Refresco en curso en otro hilo: servimos el último valor bueno
+                return entry.datos
+        else:
+            lock.acquire()
+
+        try:
+            entry = self._loaded().get(key)
+            now = time.time()
+            if entry and entry.expires_at > now:
+                return entry.datos
+
+            error = None
+            try:
+                datos, validators, not_modified = fetch(entry.validators if entry else {})
+            except Exception as e:
+                if entry is None:
+                    raise
+                error = e
+                datos, validators, not_modified = None, {}, False
+            now = time.time()
+
+            if not_modified and entry is not None:
+                entry.expires_at = max(now + self.min_ttl, self.ttl_for(entry.datos, now))
+                entry.validators = validators or entry.validators
+                self._persist(key, entry)
+                return entry.datos
+
+            if datos:
+                entry = self._entries[key] = _CacheEntry(
+                    datos=datos,
+                    expires_at=self.ttl_for(datos, now),
+                    fetched_at=now,
+                    validators=validators,
+                )
+                self._persist(key, entry)
+                return datos
+
+            if entry is not None and now - entry.fetched_at <= self.max_stale:
+                _logger.warning("AEMET no disponible para %s: se sirve el último valor bueno.", key)
+                entry.expires_at = now + self.retry_after_error
+                # Las ejecuciones siguientes (cron) también esperan antes de reintentar
+                self._persist(key, entry)
+                return entry.datos
+            if error is not None:
+                # Sin valor bueno que servir: el caller (y su circuito) ve la caída
+                raise error
+            return datos
+        finally:
+            lock.release()
 
 
 class AEMETClient:
     AEMET_BASE = "https://opendata.aemet.es/opendata/api/observacion/convencional/datos/estacion"
+    # Última observación de todas las estaciones en una sola llamada
+    AEMET_ALL = "https://opendata.aemet.es/opendata/api/observacion/convencional/todas"
+    ALL_STATIONS_KEY = "todas"
 
     def __init__(
             self,
@@ -54,22 +327,54 @@ class AEMETClient:
             station_id: str = "3195",
             timeout: int = 10,
             logger: Optional[logging.Logger] = None,
+            transport: Optional[HttpTransport] = None,
+            cache: Optional[WeatherCache] = None,
     ) -> None:
         # Priorizar la API key pasada por argumento, si no, buscar en entorno
         self.api_key = os.getenv("AEMET_API_KEY")
         self.station_id = station_id
         self.timeout = timeout
         self.logger = logger or _logger
+        # Transporte compartido: la segunda petición (datos) reutiliza la conexión
+        self.transport = transport or HttpTransport()
+        # Caché opcional compartida entre instancias (ver WeatherCache)
+        self.cache = cache
 
-        if not self.api_key:
+        # Con un transporte `offline` (replay.ReplayTransport) no hace falta clave
+        if not self.api_key and not getattr(self.transport, "offline", False):
             self.logger.error("Falta AEMET_API_KEY")
             raise ValueError("Falta api_key: configura `AEMET_API_KEY` o pásala al crear AEMETClient.")
 
     def get_aemet_datos_url(self, timeout: int = 10) -> Any:
         """
         Llama al endpoint de AEMET para la estación y delega en get_weather para obtener el JSON final.
+        Si el cliente tiene `cache`, sólo se llama a la API cuando la serie en caché ha caducado.
         """
-        url = f"{self.AEMET_BASE}/{self.station_id}"
+        if self.cache is not None:
+            return self.cache.get(
+                self.station_id, lambda validators: self._fetch_datos(timeout, validators)
+            )
+        datos, _validators, _not_modified = self._fetch_datos(timeout)
+        return datos
+
+    def get_all_observations(self, timeout: int = 10) -> Any:
+        """
+        Observaciones de todas las estaciones (endpoint `todas`), con la misma
+        caché y peticiones condicionales que `get_aemet_datos_url`.
+        """
+        url = self.AEMET_ALL
+        if self.cache is not None:
+            return self.cache.get(
+                self.ALL_STATIONS_KEY, lambda validators: self._fetch_datos(timeout, validators, url)
+            )
+        datos, _validators, _not_modified = self._fetch_datos(timeout, url=url)
+        return datos
+
+    def _fetch_datos(
+            self, timeout: int = 10, validators: Optional[Dict[str, str]] = None, url: Optional[str] = None
+    ) -> Tuple[Any, Dict[str, str], bool]:
+        target = "todas las estaciones" if url else f"estación: {self.station_id}"
+        url = url or f"{self.AEMET_BASE}/{self.station_id}"
         headers = {
             "accept": "application/json",
             "api_key": self.api_key,
@@ -77,8 +382,8 @@ class AEMETClient:
         }
 
         try:
-            self.logger.info(f"📡 Solicitando URL de datos para estación: {self.station_id}")
-            resp = requests.get(url, headers=headers, timeout=timeout or self.timeout)
+            self.logger.info(f"📡 Solicitando URL de datos para {target}")
+            resp = self.transport.get(url, headers=headers, timeout=timeout or self.timeout)
             resp.raise_for_status()
 
             payload = resp.json()
@@ -87,11 +392,23 @@ class AEMETClient:
             datos_url = payload.get("datos")
 
             # Llamamos a la función auxiliar para bajar el JSON real
-            return get_weather(datos_url, timeout=timeout, logger=self.logger)
+            return _download_datos(
+                datos_url, timeout=timeout, logger=self.logger,
+                transport=self.transport, validators=validators,
+            )
 
         except requests.exceptions.HTTPError as e:
+            status = getattr(e.response, "status_code", None)
+            if status == 429 or (status is not None and status >= 500):
+                # Transitorio: lo propagamos para que el caller reintente con backoff
+                self.logger.warning(f"⏳ Error HTTP transitorio en la petición inicial a AEMET: {e}")
+                raise
             self.logger.error(f"❌ Error HTTP en la petición inicial a AEMET: {e}")
-            return None
+            return None, {}, False
+        except requests.exceptions.RequestException as e:
+            # Conexión o timeout: transitorio, cuenta como caída en el circuito
+            self.logger.warning(f"⏳ Error de conexión con AEMET: {e}")
+            raise
         except Exception as e:
             self.logger.error(f"❌ Error inesperado en AEMETClient: {e}")
-            return None
+            return None, {}, False
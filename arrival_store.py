@@ -0,0 +1,226 @@
+# python
+"""
+Almacenamiento de llegadas en MongoDB como colección time-series.
+
+Este módulo proporciona la clase `ArrivalStore`, que define el esquema de
+persistencia de las llegadas consumidas de RabbitMQ (ver `consumer.py`):
+
+- Colección time-series `arrivals` con ``timeField="sent_at"`` y
+  ``metaField="meta"`` (``{"line", "stop", "vehicle_id"}``). MongoDB agrupa en
+  un mismo bucket las medidas de igual `meta` y cercanas en el tiempo, lo que
+  comprime mucho más que un documento suelto por llegada.
+- Índices secundarios compuestos para las consultas habituales:
+
+  ============== ===================================== ==================
+  Índice          Clave                                 Consulta
+  ============== ===================================== ==================
+  line_time       ``meta.line`` + ``sent_at``           `by_line`
+  stop_latest     ``meta.stop`` + ``sent_at`` desc      `latest_at_stop`
+  vehicle_track   ``meta.vehicle_id`` + ``sent_at``     `vehicle_track`
+  ============== ===================================== ==================
+
+- Retención: los datos crudos caducan a los `raw_ttl` segundos
+  (``expireAfterSeconds`` de la colección). Antes, `rollup` resume cada hora
+  por (línea, parada) en `arrivals_hourly`, una colección normal con índice
+  TTL propio (`rollup_ttl`) para conservar la tendencia mucho más tiempo.
+
+Funciona igual con `pymongo` y con `local_mongo.InMemoryMongoClient`.
+
+Variables de entorno utilizadas (opcional):
+- ARRIVALS_RAW_TTL_S: retención de las llegadas crudas (por defecto 30 días).
+- ARRIVALS_ROLLUP_TTL_S: retención del resumen horario (por defecto 2 años).
+"""
+
+import logging
+import os
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+DEFAULT_RAW_TTL = 30 * 24 * 3600
+DEFAULT_ROLLUP_TTL = 2 * 365 * 24 * 3600
+DEFAULT_CHUNK_SIZE = 10000
+
+ARRIVALS_COLLECTION = "arrivals"
+ROLLUP_COLLECTION = "arrivals_hourly"
+
+# (nombre, clave) de los índices secundarios de la colección time-series
+ARRIVAL_INDEXES: List[Tuple[str, List[Tuple[str, int]]]] = [
+    ("line_time", [("meta.line", 1), ("sent_at", 1)]),
+    ("stop_latest", [("meta.stop", 1), ("sent_at", -1)]),
+    ("vehicle_track", [("meta.vehicle_id", 1), ("sent_at", 1)]),
+]
+ROLLUP_INDEXES: List[Tuple[str, List[Tuple[str, int]]]] = [
+    ("line_hour", [("line", 1), ("hour", 1)]),
+    ("stop_hour", [("stop", 1), ("hour", -1)]),
+]
+
+
+def to_timeseries_doc(entry: Mapping[str, Any]) -> Dict[str, Any]:
+    """
+    Convierte un documento de `consumer.to_documents` (entrada de
+    `group_by_line` + `sent_at`) al formato de la colección time-series.
+    """
+    coords = entry.get("coords") or {}
+    doc = {
+        "sent_at": entry["sent_at"],
+        "meta": {
+            "line": entry.get("line"),
+            "stop": entry.get("stop"),
+            "vehicle_id": entry.get("vehicle_id"),
+        },
+        "destination": entry.get("destination"),
+        "eta_s": entry.get("estimateArrive"),
+        "lat": coords.get("lat"),
+        "lon": coords.get("lon"),
+    }
+    for key in ("stop_name", "weather", "shard_id", "message_type"):
+        if entry.get(key) is not None:
+            doc[key] = entry[key]
+    return doc
+
+
+def _hour(dt: datetime) -> datetime:
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+class ArrivalStore:
+    """
+    Esquema, carga y consultas de llegadas en MongoDB.
+
+    Args:
+        db: Base de datos (`pymongo.database.Database` o `InMemoryDatabase`).
+        raw_ttl (Optional[float]): Retención en segundos de las llegadas crudas.
+        rollup_ttl (Optional[float]): Retención en segundos del resumen horario.
+        chunk_size (int): Documentos máximos por `insert_many`.
+    """
+
+    def __init__(
+        self,
+        db: Any,
+        raw_ttl: Optional[float] = None,
+        rollup_ttl: Optional[float] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.db = db
+        self.raw_ttl = int(raw_ttl or os.getenv("ARRIVALS_RAW_TTL_S", DEFAULT_RAW_TTL))
+        self.rollup_ttl = int(rollup_ttl or os.getenv("ARRIVALS_ROLLUP_TTL_S", DEFAULT_ROLLUP_TTL))
+        self.chunk_size = chunk_size
+        self.logger = logger or logging.getLogger(__name__)
+        self.arrivals = db[ARRIVALS_COLLECTION]
+        self.hourly = db[ROLLUP_COLLECTION]
+
+    def ensure_schema(self) -> None:
+        """Crea la colección time-series y los índices si no existen (idempotente)."""
+        if ARRIVALS_COLLECTION not in self.db.list_collection_names():
+            self.arrivals = self.db.create_collection(
+                ARRIVALS_COLLECTION,
+                timeseries={"timeField": "sent_at", "metaField": "meta", "granularity": "minutes"},
+                expireAfterSeconds=self.raw_ttl,
+            )
+            self.logger.info("Colección time-series %s creada", ARRIVALS_COLLECTION)
+        for name, keys in ARRIVAL_INDEXES:
+            self.arrivals.create_index(keys, name=name)
+        for name, keys in ROLLUP_INDEXES:
+            self.hourly.create_index(keys, name=name)
+        self.hourly.create_index([("hour", 1)], name="hour_ttl", expireAfterSeconds=self.rollup_ttl)
+
+    # --- carga ---
+
+    def insert_batch(self, entries: Iterable[Mapping[str, Any]]) -> int:
+        """
+        Inserta documentos de `consumer.to_documents` en bloques de
+        `chunk_size` con `insert_many(ordered=False)`. Devuelve cuántos.
+        """
+        total = 0
+        chunk: List[Dict[str, Any]] = []
+        for entry in entries:
+            chunk.append(to_timeseries_doc(entry))
+            if len(chunk) >= self.chunk_size:
+                self.arrivals.insert_many(chunk, ordered=False)
+                total += len(chunk)
+                chunk = []
+        if chunk:
+            self.arrivals.insert_many(chunk, ordered=False)
+            total += len(chunk)
+        return total
+
+    # --- consultas ---
+
+    def by_line(self, line: str, start: datetime, end: datetime, limit: int = 0) -> List[Dict[str, Any]]:
+        """Llegadas de `line` en ``[start, end)`` en orden temporal (índice `line_time`)."""
+        cursor = self.arrivals.find(
+            {"meta.line": line, "sent_at": {"$gte": start, "$lt": end}}
+        ).sort([("sent_at", 1)])
+        return list(cursor.limit(limit) if limit else cursor)
+
+    def latest_at_stop(self, stop: str, n: int = 20) -> List[Dict[str, Any]]:
+        """Las `n` llegadas más recientes de `stop` (índice `stop_latest`)."""
+        return list(self.arrivals.find({"meta.stop": stop}).sort([("sent_at", -1)]).limit(n))
+
+    def vehicle_track(self, vehicle_id: Any, start: datetime, end: datetime) -> List[Dict[str, Any]]:
+        """Posiciones de un vehículo en ``[start, end)`` (índice `vehicle_track`)."""
+        return list(self.arrivals.find(
+            {"meta.vehicle_id": vehicle_id, "sent_at": {"$gte": start, "$lt": end}},
+            {"_id": 0, "sent_at": 1, "lat": 1, "lon": 1, "meta": 1, "eta_s": 1},
+        ).sort([("sent_at", 1)]))
+
+    # --- retención ---
+
+    def rollup(self, start: datetime, end: Optional[datetime] = None) -> int:
+        """
+        Resume las horas completas de ``[start, end)`` por (línea, parada) en
+        `arrivals_hourly`: llegadas, vehículos distintos y ETA media/mín/máx.
+
+        Es idempotente: las horas del rango se recalculan y sustituyen. Debe
+        ejecutarse con más frecuencia que `raw_ttl` (p. ej. cada hora).
+        Devuelve el número de documentos de resumen escritos.
+        """
+        start = _hour(start)
+        end = _hour(end or datetime.now(timezone.utc))
+        written = 0
+        # Hora a hora para que la memoria no dependa de la longitud del rango
+        hour = start
+        while hour < end:
+            summaries = self._summarize_hour(hour)
+            self.hourly.delete_many({"hour": hour})
+            if summaries:
+                self.hourly.insert_many(summaries, ordered=False)
+            written += len(summaries)
+            hour += timedelta(hours=1)
+        return written
+
+    def _summarize_hour(self, hour: datetime) -> List[Dict[str, Any]]:
+        # Se agrega en el servidor: sólo viaja un documento por (línea, parada)
+        groups = self.arrivals.aggregate([
+            {"$match": {"sent_at": {"$gte": hour, "$lt": hour + timedelta(hours=1)}}},
+            {"$group": {
+                "_id": {"line": "$meta.line", "stop": "$meta.stop"},
+                "arrivals": {"$sum": 1},
+                "vehicles": {"$addToSet": "$meta.vehicle_id"},
+                "eta_avg_s": {"$avg": "$eta_s"},
+                "eta_min_s": {"$min": "$eta_s"},
+                "eta_max_s": {"$max": "$eta_s"},
+            }},
+        ])
+        summaries = []
+        for g in groups:
+            line, stop = g["_id"].get("line"), g["_id"].get("stop")
+            summaries.append({
+                "_id": f"{line}|{stop}|{hour.isoformat()}",
+                "line": line,
+                "stop": stop,
+                "hour": hour,
+                "arrivals": g["arrivals"],
+                "vehicles": sum(1 for v in g["vehicles"] if v is not None),
+                "eta_avg_s": g["eta_avg_s"],
+                "eta_min_s": g["eta_min_s"],
+                "eta_max_s": g["eta_max_s"],
+            })
+        return summaries
+
+    def hourly_by_line(self, line: str, start: datetime, end: datetime) -> List[Dict[str, Any]]:
+        """Resumen horario de `line` en ``[start, end)`` (índice `line_hour`)."""
+        return list(self.hourly.find(
+            {"line": line, "hour": {"$gte": start, "$lt": end}}
+        ).sort([("hour", 1)]))
@@ -0,0 +1,346 @@
+# python
+"""
+Benchmarks de extremo a extremo del pipeline de ingesta.
+
+Mide cada etapa con datos sintéticos deterministas (llegadas EMT con el
+formato `Arrive` y observaciones AEMET) para tamaños de 10 a 100k llegadas:
+
+- `QueueBusBuilder.from_iterable` (+ build) y su variante columnar.
+- `BusArrivalDTOBuilder.build` (cadena completa del builder por llegada).
+- `_parse_iso_datetime`.
+- `WeatherBuilder.from_aemet`.
+- `main.group_by_line`.
+- `BusArrivalDTO.to_json` y `batch_to_json`.
+- `RabbitPublisher.publish` contra `local_broker.InMemoryBroker`.
+
+Por cada etapa y tamaño informa throughput (elementos/s sobre la mediana),
+latencias p50/p99 y pico de memoria (tracemalloc); p99 sólo se da con al
+menos `P99_MIN_SAMPLES` muestras. Los resultados se comparan con
+`benchmarks/baseline.json`: si el throughput cae más de `--threshold`
+respecto a la línea base el proceso termina con código 1. Sólo se comparan
+los tamaños desde `--gate-min-size` (por defecto 1000): con menos llegadas
+cada medición dura microsegundos y el ruido de la máquina supera el umbral.
+
+Uso::
+
+    python -m benchmarks.bench                      # comparar con la línea base
+    python -m benchmarks.bench --save-baseline      # regenerar la línea base
+    python -m benchmarks.bench --sizes 1000,10000 --stages group_by_line,to_json
+
+Las líneas base dependen de la máquina: regenéralas en la máquina de referencia
+antes de usarlas como puerta de regresión.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bus_arrival_builder import BusArrivalDTOBuilder  # noqa: E402
+from bus_arrival_dto import batch_to_json  # noqa: E402
+from local_broker import InMemoryBroker  # noqa: E402
+from queue_bus_builder import ColumnarQueueBusBuilder, QueueBusBuilder, _parse_iso_datetime  # noqa: E402
+from rabbit_publisher import RabbitPublisher  # noqa: E402
+from weather_builder import WeatherBuilder  # noqa: E402
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_SIZES = (10, 100, 1000, 10000, 100000)
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_GATE_MIN_SIZE = 1000
+# Tiempo mínimo acumulado por medición y límites de repeticiones; las etapas
+# lentas paran al superar MAX_TOTAL_SECONDS (con al menos MIN_SLOW_REPEATS)
+MIN_TOTAL_SECONDS = 1.0
+MAX_TOTAL_SECONDS = 15.0
+MIN_REPEATS = 15
+MIN_SLOW_REPEATS = 5
+MAX_REPEATS = 1000
+# Muestras mínimas para que el percentil 99 signifique algo
+P99_MIN_SAMPLES = 100
+
+
+# --- datos sintéticos ---------------------------------------------------------
+
+
+def make_arrivals(n: int, seed: int = 42) -> List[Dict[str, Any]]:
+    """Llegadas con la forma de `EMTClient.lines_bus_stop` + `origin_stop`."""
+    rnd = random.Random(seed)
+    base = datetime(2026, 1, 17, 8, 0, 0)
+    lines = [str(x) for x in rnd.sample(range(1, 200), 40)]
+    destinations = {line: f"DESTINO {line}" for line in lines}
+    out = []
+    for i in range(n):
+        line = rnd.choice(lines)
+        stop = str(rnd.randint(1, 5000))
+        out.append({
+            "line": line,
+            "stop": stop,
+            "isHead": "False",
+            "destination": destinations[line],
+            "deviation": 0,
+            "bus": rnd.randint(1000, 9999),
+            "geometry": {"type": "Point", "coordinates": [-3.70 + rnd.uniform(-0.1, 0.1), 40.42 + rnd.uniform(-0.1, 0.1)]},
+            "estimateArrive": rnd.randint(0, 1800),
+            "DistanceBus": rnd.randint(0, 6000),
+            "positionTypeBus": "0",
+            "eta": (base + timedelta(seconds=rnd.randint(0, 3600))).isoformat() + "+01:00",
+            "origin_stop": stop,
+        })
+    return out
+
+
+def make_aemet(n: int, seed: int = 42) -> List[Dict[str, Any]]:
+    rnd = random.Random(seed)
+    base = datetime(2026, 1, 17, 0, 0, 0)
+    return [{
+        "idema": "3195",
+        "fint": (base + timedelta(hours=i % 24)).isoformat(),
+        "ta": round(rnd.uniform(-2, 38), 1),
+        "hr": rnd.randint(10, 100),
+        "vv": round(rnd.uniform(0, 15), 1),
+        "prec": round(rnd.choice([0.0, 0.0, 0.2, 1.4]), 1),
+    } for i in range(n)]
+
+
+WEATHER = WeatherBuilder().from_aemet(make_aemet(1)[0]).build()
+
+
+# --- etapas -------------------------------------------------------------------
+# Cada etapa recibe n y devuelve (función a medir, número de elementos procesados)
+
+
+def _stage_queue_builder(n: int):
+    items = make_arrivals(n)
+    return lambda: QueueBusBuilder().from_iterable(items).build()
+
+
+def _stage_columnar_builder(n: int):
+    items = make_arrivals(n)
+    return lambda: ColumnarQueueBusBuilder().from_iterable(items).build()
+
+
+def _stage_dto_builder(n: int):
+    items = make_arrivals(n)
+    etas = [datetime.fromisoformat(i["eta"]) for i in items]
+
+    def run():
+        for item, eta in zip(items, etas):
+            (BusArrivalDTOBuilder()
+             .line(item["line"]).stop(item["stop"]).eta(eta)
+             .vehicle_id(item["bus"]).destination(item["destination"])
+             .coords(item["geometry"]["coordinates"]).weather(WEATHER)
+             .distance(item["DistanceBus"]).estimate_arrive(item["estimateArrive"])
+             .build())
+    return run
+
+
+def _stage_parse_iso(n: int):
+    values = [i["eta"] for i in make_arrivals(n)]
+    return lambda: [_parse_iso_datetime(v) for v in values]
+
+
+def _stage_weather(n: int):
+    records = make_aemet(n)
+    return lambda: [WeatherBuilder().from_aemet(r).build() for r in records]
+
+
+def _stage_group_by_line(n: int):
+    from main import group_by_line
+    items = make_arrivals(n)
+    return lambda: group_by_line(items, WEATHER)
+
+
+def _dtos(n: int):
+    items = make_arrivals(n)
+    for it in items:
+        it["weather"] = WEATHER
+    return QueueBusBuilder().from_iterable(items).build()
+
+
+def _stage_to_json(n: int):
+    dtos = _dtos(n)
+    return lambda: [d.to_json() for d in dtos]
+
+
+def _stage_batch_to_json(n: int):
+    dtos = _dtos(n)
+    return lambda: batch_to_json(dtos)
+
+
+def _stage_publish(n: int):
+    from main import group_by_line
+    payload = group_by_line(make_arrivals(n), WEATHER)
+    broker = InMemoryBroker()
+    pub = RabbitPublisher(connection_factory=broker.connection_factory, logger=logging.getLogger("bench"))
+
+    def run():
+        pub.publish(payload)
+        broker.purge()
+    return run
+
+
+STAGES: Dict[str, Callable[[int], Callable[[], Any]]] = {
+    "queue_builder": _stage_queue_builder,
+    "columnar_builder": _stage_columnar_builder,
+    "dto_builder": _stage_dto_builder,
+    "parse_iso_datetime": _stage_parse_iso,
+    "weather_from_aemet": _stage_weather,
+    "group_by_line": _stage_group_by_line,
+    "to_json": _stage_to_json,
+    "batch_to_json": _stage_batch_to_json,
+    "rabbit_publish": _stage_publish,
+}
+
+
+# --- medición -----------------------------------------------------------------
+
+
+def _percentile(samples: List[float], pct: float) -> float:
+    ordered = sorted(samples)
+    k = (len(ordered) - 1) * pct / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+def measure(fn: Callable[[], Any], n: int) -> Dict[str, float]:
+    fn()  # calentamiento
+    samples: List[float] = []
+    total = 0.0
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        while len(samples) < MAX_REPEATS and (len(samples) < MIN_REPEATS or total < MIN_TOTAL_SECONDS):
+            if len(samples) >= MIN_SLOW_REPEATS and total >= MAX_TOTAL_SECONDS:
+                break
+            t0 = time.perf_counter()
+            fn()
+            dt = time.perf_counter() - t0
+            samples.append(dt)
+            total += dt
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    tracemalloc.start()
+    try:
+        fn()
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    p50 = statistics.median(samples)
+    return {
+        "n": n,
+        "repeats": len(samples),
+        "throughput": n / p50 if p50 > 0 else float("inf"),
+        "p50_ms": p50 * 1000,
+        "p99_ms": _percentile(samples, 99) * 1000 if len(samples) >= P99_MIN_SAMPLES else None,
+        "peak_mem_kb": peak / 1024,
+    }
+
+
+def run(stages: List[str], sizes: List[int]) -> Dict[str, Dict[str, Dict[str, float]]]:
+    results: Dict[str, Dict[str, Dict[str, float]]] = {}
+    for name in stages:
+        results[name] = {}
+        for n in sizes:
+            r = measure(STAGES[name](n), n)
+            results[name][str(n)] = r
+            p99 = "n/a" if r["p99_ms"] is None else f"{r['p99_ms']:.3f}ms"
+            print(f"{name:<20} n={n:<7} {r['throughput']:>14,.0f}/s  p50={r['p50_ms']:>10.3f}ms  "
+                  f"p99={p99:>12}  mem={r['peak_mem_kb']:>10,.0f}KB  x{r['repeats']}", flush=True)
+    return results
+
+
+def compare(results, baseline, threshold: float, min_size: int = DEFAULT_GATE_MIN_SIZE) -> List[str]:
+    """
+    Devuelve la lista de regresiones de throughput respecto a `baseline`
+    (sólo tamaños de al menos `min_size` llegadas).
+    """
+    regressions = []
+    for name, by_size in results.items():
+        for size, r in by_size.items():
+            if int(size) < min_size:
+                continue
+            ref = baseline.get(name, {}).get(size)
+            if not ref:
+                continue
+            floor = ref["throughput"] * (1 - threshold)
+            if r["throughput"] < floor:
+                regressions.append(
+                    f"{name} n={size}: {r['throughput']:,.0f}/s < {floor:,.0f}/s "
+                    f"(línea base {ref['throughput']:,.0f}/s, -{threshold:.0%})"
+                )
+    return regressions
+
+
+def parse_args(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmarks del pipeline de ingesta.")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)),
+                        help="Tamaños separados por comas (por defecto 10..100000).")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help=f"Etapas separadas por comas: {', '.join(STAGES)}.")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="Archivo de línea base.")
+    parser.add_argument("--save-baseline", action="store_true", help="Guarda los resultados como línea base.")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="Caída de throughput tolerada antes de fallar (0.25 = 25%%).")
+    parser.add_argument("--gate-min-size", type=int, default=DEFAULT_GATE_MIN_SIZE,
+                        help="Tamaño mínimo que se compara con la línea base (por defecto 1000).")
+    parser.add_argument("--output", help="Guarda los resultados de esta ejecución en JSON.")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    logging.disable(logging.CRITICAL)
+    args = parse_args(argv)
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = [s for s in stages if s not in STAGES]
+    if unknown:
+        print(f"Etapas desconocidas: {unknown}", file=sys.stderr)
+        return 2
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+
+    results = run(stages, sizes)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            json.dump(results, fh, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, "r", encoding="utf-8") as fh:
+                baseline = json.load(fh)
+        for name, by_size in results.items():
+            baseline.setdefault(name, {}).update(by_size)
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump(baseline, fh, indent=2, sort_keys=True)
+        print(f"Línea base guardada en {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print("Sin línea base: ejecuta con --save-baseline para crearla.")
+        return 0
+    with open(args.baseline, "r", encoding="utf-8") as fh:
+        baseline = json.load(fh)
+    regressions = compare(results, baseline, args.threshold, args.gate_min_size)
+    if regressions:
+        print("\nRegresiones detectadas:")
+        for r in regressions:
+            print(f"  - {r}")
+        return 1
+    print("\nSin regresiones respecto a la línea base.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,10 @@
 import json
-from dataclasses import asdict, dataclass, field
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Iterable, Optional, Tuple
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class BusArrivalDTO:
     """
     BusArrivalDTO - Datos enviados al tópico sobre una llegada de autobús.
@@ -21,6 +21,10 @@ class BusArrivalDTO:
     - weather: Información meteorológica asociada (si disponible).
     - extra: Diccionario con campos adicionales libres.
     - sent_at: Marca temporal de envío (datetime, ISO 8601 en serialización).
+
+    Usa `__slots__` para reducir memoria por instancia. `to_dict` hace copias
+    superficiales de `coords`, `weather` y `extra` en lugar de la copia profunda
+    de `dataclasses.asdict`.
     """
 
     line: str = field(metadata={"description": "Número o identificador de la línea"})
@@ -60,12 +64,54 @@ class BusArrivalDTO:
     )
 
     def to_dict(self) -> Dict[str, Any]:
-        d = asdict(self)
-        if self.eta:
-            d["eta"] = self.eta.isoformat()
-        if self.sent_at:
-            d["sent_at"] = self.sent_at.isoformat()
+        d = self._to_dict_without_weather()
+        d["weather"] = dict(self.weather) if self.weather is not None else None
+        # Mantenemos el orden de claves de los campos
+        d["extra"] = d.pop("extra")
+        d["sent_at"] = d.pop("sent_at")
         return d
 
+    def _to_dict_without_weather(self) -> Dict[str, Any]:
+        return {
+            "line": self.line,
+            "stop": self.stop,
+            "eta": self.eta.isoformat() if self.eta else self.eta,
+            "distance": self.distance,
+            "estimate_arrive": self.estimate_arrive,
+            "vehicle_id": self.vehicle_id,
+            "destination": self.destination,
+            "coords": dict(self.coords) if self.coords is not None else None,
+            "extra": dict(self.extra),
+            "sent_at": self.sent_at.isoformat() if self.sent_at else self.sent_at,
+        }
+
     def to_json(self) -> str:
         return json.dumps(self.to_dict(), ensure_ascii=False)
+
+
+def batch_to_json(arrivals: Iterable[BusArrivalDTO]) -> str:
+    """
+    Serializa una lista de llegadas como array JSON.
+
+    El dict `weather` suele ser el mismo objeto para todo el ciclo, así que se
+    codifica una sola vez por objeto distinto y se reutiliza el texto en cada
+    llegada. La clave `weather` queda al final de cada objeto. La caché guarda
+    también el dict: con un generador, un dict ya liberado podría reutilizar
+    el `id` de otro.
+    """
+    weather_json: Dict[int, Tuple[Dict[str, Any], str]] = {}
+    parts = []
+    for a in arrivals:
+        body = json.dumps(a._to_dict_without_weather(), ensure_ascii=False)
+        w = a.weather
+        if w is None:
+            encoded = "null"
+        else:
+            cached = weather_json.get(id(w))
+            if cached is not None and cached[0] is w:
+                encoded = cached[1]
+            else:
+                encoded = json.dumps(w, ensure_ascii=False)
+                weather_json[id(w)] = (w, encoded)
+        parts.append(f'{body[:-1]}, "weather": {encoded}}}')
+    return "[" + ", ".join(parts) + "]"
@@ -0,0 +1,378 @@
+# python
+"""
+Worker que consume los snapshots de RabbitMQ y los guarda en MongoDB.
+
+Este módulo proporciona la clase `BatchConsumer`, que lee de la cola del
+ingestor (`micola_queue`) con `prefetch` amplio y agrupa los mensajes en lotes
+acotados por número de mensajes, de documentos y de tiempo. Cada lote se
+escribe con una sola llamada `insert_many(ordered=False)` y sólo cuando MongoDB
+la acepta se confirma a RabbitMQ con un único `basic_ack(multiple=True)`. Si
+la escritura falla, el lote se devuelve a la cola (`basic_nack(requeue=True)`)
+y se reintenta tras un backoff; la entrega es at-least-once.
+
+Cada llegada de un mensaje (v1 o v2, completo o delta) se convierte en un
+documento con `sent_at` tomado del `timestamp` AMQP del mensaje y se guarda
+con `ArrivalStore` (colección time-series, ver `arrival_store.py`). Los
+mensajes que no se pueden decodificar se rechazan sin reencolar (dead-letter).
+
+Para escalar se lanzan varios procesos (`--workers N`), cada uno con su
+conexión; RabbitMQ reparte los mensajes entre ellos.
+
+El primer worker resume además cada `ARRIVALS_ROLLUP_INTERVAL_S` las últimas
+horas completas en `arrivals_hourly` (`ArrivalStore.rollup`, idempotente), de
+modo que el resumen existe antes de que caduquen los datos crudos. Con
+`--rollup` sólo se ejecuta ese resumen una vez (apto para cron) y se sale.
+
+Uso::
+
+    python consumer.py --workers 4 --prefetch 400 --batch-size 200
+    python consumer.py --rollup --rollup-hours 24
+
+Variables de entorno utilizadas (opcional):
+- RABBITMQ_USER / RABBITMQ_PASS / RABBITMQ_HOST: como en `RabbitPublisher`.
+- MONGO_URI / MONGO_DB: destino en MongoDB.
+- CONSUMER_PREFETCH / CONSUMER_BATCH_SIZE / CONSUMER_BATCH_DOCS /
+  CONSUMER_BATCH_TIMEOUT_S: ajuste del batching.
+- ARRIVALS_ROLLUP_INTERVAL_S: segundos entre resúmenes horarios (por defecto
+  3600; 0 los desactiva).
+- ARRIVALS_ROLLUP_LOOKBACK_H: horas completas que se recalculan en cada
+  resumen (por defecto 3, cubre mensajes reencolados o tardíos).
+"""
+
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Mapping, Optional
+
+import pika
+from pika.exceptions import AMQPChannelError, AMQPConnectionError
+
+import metrics
+from arrival_store import ArrivalStore
+from payload_schema import decode_to_v1
+from rabbit_publisher import DEFAULT_QUEUE, rabbit_url
+from sharding import SHARD_HEADER
+from wire_codec import decode_payload
+
+try:
+    import pymongo
+except ImportError:  # opcional: sin pymongo sólo se puede usar local_mongo
+    pymongo = None
+
+DEFAULT_PREFETCH = 400
+DEFAULT_BATCH_SIZE = 200
+DEFAULT_BATCH_DOCS = 20000
+DEFAULT_BATCH_TIMEOUT = 1.0
+DEFAULT_ROLLUP_INTERVAL = 3600.0
+DEFAULT_ROLLUP_LOOKBACK_H = 3
+
+CONSUMED = metrics.REGISTRY.register(metrics.Counter(
+    "consumer_messages_total", "Mensajes consumidos por resultado.", ("outcome",)
+))
+WRITTEN_DOCS = metrics.REGISTRY.register(metrics.Counter(
+    "consumer_documents_total", "Documentos escritos en MongoDB.", ()
+))
+
+WriteBatch = Callable[[List[Dict[str, Any]]], Any]
+
+
+def to_documents(
+    payload: Any,
+    headers: Optional[Mapping[str, Any]] = None,
+    sent_at: Optional[datetime] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Convierte un mensaje del ingestor en un documento por llegada.
+
+    Acepta la lista de `group_by_line` (v1 o v2) y los mensajes de
+    `SnapshotDiffer`; de estos últimos se guardan las llegadas nuevas o
+    cambiadas (`removed` no genera documentos). Los informes de
+    `headway_analytics` tampoco generan documentos.
+    """
+    headers = headers or {}
+    payload = decode_to_v1(payload, headers)
+    message_type = None
+    if isinstance(payload, dict):
+        message_type = payload.get("type")
+        groups = payload.get("groups") or []
+    else:
+        groups = payload or []
+    sent_at = sent_at or datetime.now(timezone.utc)
+    shard_id = headers.get(SHARD_HEADER)
+
+    docs = []
+    for group in groups:
+        for entry in group.get("stops", []):
+            doc = dict(entry)
+            doc["sent_at"] = sent_at
+            if shard_id is not None:
+                doc["shard_id"] = shard_id
+            if message_type is not None:
+                doc["message_type"] = message_type
+            docs.append(doc)
+    return docs
+
+
+def _sent_at(properties: Any) -> datetime:
+    ts = getattr(properties, "timestamp", None)
+    if ts:
+        return datetime.fromtimestamp(ts, timezone.utc)
+    return datetime.now(timezone.utc)
+
+
+def mongo_database(uri: Optional[str] = None, db: Optional[str] = None):
+    """Base de datos de destino a partir de `MONGO_URI` y `MONGO_DB`."""
+    if pymongo is None:
+        raise RuntimeError("pymongo no está instalado (pip install -r requirements.txt)")
+    client = pymongo.MongoClient(uri or os.getenv("MONGO_URI", "mongodb://localhost:27017"))
+    return client[db or os.getenv("MONGO_DB", "madrid_mobility")]
+
+
+class BatchConsumer:
+    """
+    Consumidor con prefetch y ack por lotes.
+
+    Args:
+        write_batch (WriteBatch): Escribe una lista de documentos; debe lanzar
+            excepción si la escritura no queda garantizada.
+        connection_factory (Optional[Callable]): Crea la conexión AMQP (por
+            defecto `pika.BlockingConnection`; `local_broker` en pruebas).
+        queue (str): Cola a consumir.
+        prefetch (Optional[int]): Mensajes sin ack que el broker entrega por
+            adelantado. Se eleva al menos a `batch_size` para que los lotes
+            puedan llenarse.
+        batch_size (Optional[int]): Mensajes máximos por lote.
+        batch_docs (Optional[int]): Documentos máximos por lote.
+        batch_timeout (Optional[float]): Segundos máximos que un mensaje
+            espera en un lote incompleto.
+    """
+
+    def __init__(
+        self,
+        write_batch: WriteBatch,
+        connection_factory: Optional[Callable[[Any], Any]] = None,
+        queue: str = DEFAULT_QUEUE,
+        prefetch: Optional[int] = None,
+        batch_size: Optional[int] = None,
+        batch_docs: Optional[int] = None,
+        batch_timeout: Optional[float] = None,
+        durable: bool = True,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.write_batch = write_batch
+        self._connection_factory = connection_factory or pika.BlockingConnection
+        self.queue = queue
+        self.durable = durable
+        self.batch_size = batch_size or int(os.getenv("CONSUMER_BATCH_SIZE", DEFAULT_BATCH_SIZE))
+        self.batch_docs = batch_docs or int(os.getenv("CONSUMER_BATCH_DOCS", DEFAULT_BATCH_DOCS))
+        self.batch_timeout = batch_timeout or float(os.getenv("CONSUMER_BATCH_TIMEOUT_S", DEFAULT_BATCH_TIMEOUT))
+        self.prefetch = max(prefetch or int(os.getenv("CONSUMER_PREFETCH", DEFAULT_PREFETCH)), self.batch_size)
+        self.logger = logger or logging.getLogger(__name__)
+        self._stop = threading.Event()
+        self._write_failures = 0
+
+    def stop(self) -> None:
+        """Pide la parada: se escribe y confirma el lote en curso y se sale."""
+        self._stop.set()
+
+    def install_signal_handlers(self) -> None:
+        def _handler(signum, _frame):
+            self.logger.info("Señal %s recibida: parada tras el lote en curso.", signum)
+            self.stop()
+
+        signal.signal(signal.SIGINT, _handler)
+        signal.signal(signal.SIGTERM, _handler)
+
+    def run(self) -> None:
+        """Consume hasta `stop()`, reconectando ante caídas del broker."""
+        backoff = 1.0
+        while not self._stop.is_set():
+            try:
+                self._consume()
+                backoff = 1.0
+            except (AMQPConnectionError, AMQPChannelError) as e:
+                # Los mensajes sin ack vuelven a la cola al caer la conexión
+                self.logger.warning(f"Conexión con RabbitMQ perdida: {e}. Reintento en {backoff:.0f}s")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, 60.0)
+
+    def _consume(self) -> None:
+        connection = self._connection_factory(pika.URLParameters(rabbit_url()))
+        channel = connection.channel()
+        try:
+            channel.queue_declare(queue=self.queue, durable=self.durable)
+            channel.basic_qos(prefetch_count=self.prefetch)
+            self.logger.info(
+                "Consumiendo %s (prefetch=%d, lote=%d msgs/%d docs/%.1fs)",
+                self.queue, self.prefetch, self.batch_size, self.batch_docs, self.batch_timeout,
+            )
+            docs: List[Dict[str, Any]] = []
+            messages = 0
+            last_tag = None
+            deadline = 0.0
+            poll = min(self.batch_timeout, 1.0) / 2
+            for method, properties, body in channel.consume(self.queue, inactivity_timeout=poll):
+                if method is not None:
+                    try:
+                        payload = decode_payload(
+                            body, getattr(properties, "content_type", None),
+                            getattr(properties, "content_encoding", None),
+                        )
+                        new_docs = to_documents(payload, getattr(properties, "headers", None), _sent_at(properties))
+                    except Exception as e:
+                        self.logger.error(f"Mensaje no decodificable (tag {method.delivery_tag}): {e}")
+                        channel.basic_nack(delivery_tag=method.delivery_tag, multiple=False, requeue=False)
+                        CONSUMED.inc(outcome="rejected")
+                    else:
+                        if last_tag is None:
+                            deadline = time.monotonic() + self.batch_timeout
+                        docs.extend(new_docs)
+                        messages += 1
+                        last_tag = method.delivery_tag
+
+                full = messages >= self.batch_size or len(docs) >= self.batch_docs
+                if last_tag is not None and (full or time.monotonic() >= deadline or self._stop.is_set()):
+                    self._flush(channel, docs, messages, last_tag)
+                    docs, messages, last_tag = [], 0, None
+                if self._stop.is_set() and last_tag is None:
+                    break
+        finally:
+            try:
+                channel.cancel()
+                connection.close()
+            except (AMQPConnectionError, AMQPChannelError):
+                pass
+
+    def _flush(self, channel: Any, docs: List[Dict[str, Any]], messages: int, last_tag: int) -> None:
+        try:
+            if docs:
+                with metrics.stage("mongo_write"):
+                    self.write_batch(docs)
+        except Exception as e:
+            self._write_failures += 1
+            wait = min(2 ** self._write_failures, 60)
+            self.logger.error(
+                f"Fallo escribiendo {len(docs)} documentos ({messages} mensajes): {e}. "
+                f"Se reencolan y se reintenta en {wait}s"
+            )
+            channel.basic_nack(delivery_tag=last_tag, multiple=True, requeue=True)
+            CONSUMED.inc(messages, outcome="requeued")
+            self._stop.wait(wait)
+            return
+        self._write_failures = 0
+        # Un único ack para todo el lote, sólo tras confirmar la escritura
+        channel.basic_ack(delivery_tag=last_tag, multiple=True)
+        CONSUMED.inc(messages, outcome="acked")
+        WRITTEN_DOCS.inc(len(docs))
+        self.logger.debug("Lote de %d mensajes (%d documentos) guardado", messages, len(docs))
+
+
+def run_rollup(store: ArrivalStore, hours: Optional[int] = None, now: Optional[datetime] = None) -> int:
+    """
+    Resume en `arrivals_hourly` las últimas `hours` horas completas (por
+    defecto `ARRIVALS_ROLLUP_LOOKBACK_H`). Devuelve los documentos escritos.
+    """
+    hours = hours or int(os.getenv("ARRIVALS_ROLLUP_LOOKBACK_H", DEFAULT_ROLLUP_LOOKBACK_H))
+    now = now or datetime.now(timezone.utc)
+    return store.rollup(now - timedelta(hours=hours), now)
+
+
+def _start_rollup(store: ArrivalStore, interval: float, logger: logging.Logger) -> threading.Thread:
+    """Lanza en un hilo daemon `run_rollup` al arrancar y cada `interval` segundos."""
+    def _loop():
+        while True:
+            try:
+                written = run_rollup(store)
+                logger.info("Resumen horario actualizado (%d documentos)", written)
+            except Exception as e:
+                # Es idempotente: la siguiente pasada recalcula las mismas horas
+                logger.error(f"Fallo en el resumen horario: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=_loop, name="arrivals-rollup", daemon=True)
+    thread.start()
+    return thread
+
+
+def _worker_entry(worker: int, options: Dict[str, Any]) -> None:
+    """Punto de entrada de cada proceso en `run_workers`."""
+    logging.basicConfig(
+        level=getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO),
+        format=f"%(asctime)s %(levelname)s [worker-{worker}] %(message)s",
+    )
+    store = ArrivalStore(mongo_database())
+    store.ensure_schema()
+    consumer = BatchConsumer(store.insert_batch, **options)
+    consumer.install_signal_handlers()
+    # Un único worker resume: con varios, las pasadas se pisarían
+    interval = float(os.getenv("ARRIVALS_ROLLUP_INTERVAL_S", DEFAULT_ROLLUP_INTERVAL))
+    if worker == 0 and interval > 0:
+        _start_rollup(store, interval, consumer.logger)
+    consumer.run()
+
+
+def run_workers(workers: int, **options: Any) -> int:
+    """Lanza `workers` procesos consumidores y espera a todos. Devuelve 0 si todo fue bien."""
+    if workers <= 1:
+        _worker_entry(0, options)
+        return 0
+    processes = [
+        multiprocessing.Process(target=_worker_entry, args=(i, options), name=f"consumer-{i}")
+        for i in range(workers)
+    ]
+    for proc in processes:
+        proc.start()
+
+    def _forward(signum, _frame):
+        for proc in processes:
+            if proc.is_alive():
+                proc.terminate()
+
+    signal.signal(signal.SIGTERM, _forward)
+    # SIGINT ya llega a los hijos desde la terminal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    failed = 0
+    for proc in processes:
+        proc.join()
+        if proc.exitcode != 0:
+            failed += 1
+    return 1 if failed else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Consumidor RabbitMQ → MongoDB por lotes.")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("CONSUMER_WORKERS", 1)),
+                        help="Procesos consumidores (por defecto CONSUMER_WORKERS o 1).")
+    parser.add_argument("--prefetch", type=int, default=None, help="prefetch_count por consumidor.")
+    parser.add_argument("--batch-size", type=int, default=None, help="Mensajes máximos por lote.")
+    parser.add_argument("--batch-docs", type=int, default=None, help="Documentos máximos por lote.")
+    parser.add_argument("--batch-timeout", type=float, default=None, help="Segundos máximos por lote.")
+    parser.add_argument("--rollup", action="store_true",
+                        help="Sólo actualiza el resumen horario (arrivals_hourly) y sale.")
+    parser.add_argument("--rollup-hours", type=int, default=None,
+                        help="Horas completas a resumir con --rollup (por defecto ARRIVALS_ROLLUP_LOOKBACK_H o 3).")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.rollup:
+        logging.basicConfig(level=getattr(logging, os.getenv("LOG_LEVEL", "INFO").upper(), logging.INFO))
+        store = ArrivalStore(mongo_database())
+        store.ensure_schema()
+        written = run_rollup(store, hours=args.rollup_hours)
+        logging.getLogger(__name__).info("Resumen horario: %d documentos escritos", written)
+        sys.exit(0)
+    sys.exit(run_workers(
+        args.workers,
+        prefetch=args.prefetch,
+        batch_size=args.batch_size,
+        batch_docs=args.batch_docs,
+        batch_timeout=args.batch_timeout,
+    ))
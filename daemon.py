@@ -0,0 +1,169 @@
+# python
+"""
+Planificador interno para ejecutar el ingestor como proceso de larga duración.
+
+Este módulo proporciona la clase `IngestDaemon`, que ejecuta un ciclo
+(fetch → build → publish) cada `interval` segundos dentro de las ventanas de
+servicio de EMT, reproduciendo los horarios del workflow
+`.github/workflows/ingest_madrid.yml` en hora local de Madrid:
+
+- Lunes a viernes: 06:20 a 23:30.
+- Sábados y domingos: 07:15 a 23:30.
+
+Los ticks se alinean a múltiplos de `interval` desde medianoche (como
+`*/5` en cron). Si un ciclo dura más que el intervalo, los ticks perdidos se
+descartan en lugar de encadenar ejecuciones. SIGINT/SIGTERM piden una parada
+ordenada: el ciclo en curso termina y el proceso sale; una segunda señal
+fuerza la salida.
+"""
+
+import logging
+import signal
+import threading
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from datetime import time as dtime
+from typing import Callable, FrozenSet, Optional, Sequence
+from zoneinfo import ZoneInfo
+
+SPAIN = ZoneInfo("Europe/Madrid")
+
+# Cada cuánto se invoca `idle` mientras se espera al siguiente tick
+IDLE_SLICE_SECONDS = 10.0
+
+
+@dataclass(frozen=True)
+class ServiceWindow:
+    """Franja diaria [start, end] (ambos incluidos) para los días `weekdays` (0=lunes)."""
+
+    weekdays: FrozenSet[int]
+    start: dtime
+    end: dtime
+
+    def contains(self, dt: datetime) -> bool:
+        local = dt.astimezone(SPAIN)
+        return local.weekday() in self.weekdays and self.start <= local.time() <= self.end
+
+
+SERVICE_WINDOWS = (
+    ServiceWindow(frozenset({0, 1, 2, 3, 4}), dtime(6, 20), dtime(23, 30)),
+    ServiceWindow(frozenset({5, 6}), dtime(7, 15), dtime(23, 30)),
+)
+
+
+def in_service(dt: datetime, windows: Sequence[ServiceWindow] = SERVICE_WINDOWS) -> bool:
+    return any(w.contains(dt) for w in windows)
+
+
+def next_tick(now: datetime, interval: float) -> datetime:
+    """Primer instante estrictamente posterior a `now` alineado a `interval` desde medianoche local."""
+    local = now.astimezone(SPAIN)
+    midnight = local.replace(hour=0, minute=0, second=0, microsecond=0)
+    elapsed = (local - midnight).total_seconds()
+    ticks = int(elapsed // interval) + 1
+    return midnight + timedelta(seconds=ticks * interval)
+
+
+class IngestDaemon:
+    """
+    Ejecuta `cycle` periódicamente dentro de las ventanas de servicio.
+
+    Args:
+        cycle (Callable[[], object]): Ciclo completo de ingesta.
+        interval (float): Segundos entre ticks.
+        windows (Optional[Sequence[ServiceWindow]]): Ventanas de servicio; con
+            una secuencia vacía se ejecuta a cualquier hora.
+        idle (Optional[Callable[[], None]]): Se invoca periódicamente durante la
+            espera (p. ej. para atender heartbeats de RabbitMQ).
+        logger (Optional[logging.Logger]): Logger a usar.
+    """
+
+    def __init__(
+        self,
+        cycle: Callable[[], object],
+        interval: float = 300.0,
+        windows: Optional[Sequence[ServiceWindow]] = None,
+        idle: Optional[Callable[[], None]] = None,
+        logger: Optional[logging.Logger] = None,
+    ):
+        if interval <= 0:
+            raise ValueError("interval debe ser positivo")
+        self.cycle = cycle
+        self.interval = float(interval)
+        self.windows = SERVICE_WINDOWS if windows is None else tuple(windows)
+        self.idle = idle
+        self.logger = logger or logging.getLogger(__name__)
+        self._stop = threading.Event()
+        self.cycles_run = 0
+        self.ticks_skipped = 0
+
+    def stop(self) -> None:
+        """Solicita una parada ordenada tras el ciclo en curso."""
+        self._stop.set()
+
+    @property
+    def stopping(self) -> bool:
+        return self._stop.is_set()
+
+    def install_signal_handlers(self) -> None:
+        def _handler(signum, _frame):
+            if self._stop.is_set():
+                self.logger.warning("Segunda señal %s: salida inmediata.", signum)
+                raise KeyboardInterrupt
+            self.logger.info("Señal %s recibida: parada tras el ciclo en curso.", signum)
+            self._stop.set()
+
+        signal.signal(signal.SIGINT, _handler)
+        signal.signal(signal.SIGTERM, _handler)
+
+    def _is_active(self, dt: datetime) -> bool:
+        return not self.windows or in_service(dt, self.windows)
+
+    def _wait_until(self, deadline: datetime) -> bool:
+        """Espera hasta `deadline` atendiendo `idle`. Devuelve False si se pidió parada."""
+        while not self._stop.is_set():
+            remaining = (deadline - datetime.now(SPAIN)).total_seconds()
+            if remaining <= 0:
+                return True
+            if self._stop.wait(min(remaining, IDLE_SLICE_SECONDS)):
+                break
+            if self.idle is not None:
+                try:
+                    self.idle()
+                except Exception as e:
+                    self.logger.warning("Error en tarea de mantenimiento: %s", e)
+        return False
+
+    def run_once(self) -> None:
+        """Ejecuta un ciclo aislando cualquier excepción para no tumbar el daemon."""
+        started = time.monotonic()
+        try:
+            self.cycle()
+        except Exception:
+            self.logger.exception("Error no controlado en el ciclo de ingesta")
+        finally:
+            self.cycles_run += 1
+        elapsed = time.monotonic() - started
+        if elapsed > self.interval:
+            skipped = int(elapsed // self.interval)
+            self.ticks_skipped += skipped
+            self.logger.warning(
+                "Ciclo de %.1fs supera el intervalo de %.0fs: se descartan %d tick(s).",
+                elapsed, self.interval, skipped,
+            )
+        else:
+            self.logger.info("Ciclo completado en %.2fs.", elapsed)
+
+    def run(self) -> None:
+        """Bucle principal: bloquea hasta que se solicite la parada."""
+        self.logger.info("Daemon de ingesta iniciado (intervalo %.0fs).", self.interval)
+        while not self._stop.is_set():
+            tick = next_tick(datetime.now(SPAIN), self.interval)
+            if not self._wait_until(tick):
+                break
+            if not self._is_active(tick):
+                self.logger.debug("Fuera de ventana de servicio: %s", tick.isoformat())
+                continue
+            self.run_once()
+        self.logger.info("Daemon de ingesta detenido tras %d ciclo(s).", self.cycles_run)
@@ -5,18 +5,54 @@ Cliente para la API de EMT Madrid.
 Este módulo proporciona la clase `EMTClient` para obtener un token de acceso y
 consultar las llegadas de autobuses en una parada determinada.
 
+El token se persiste en disco mediante `TokenStore` junto con su caducidad,
+de modo que sucesivas ejecuciones lo reutilizan y lo renuevan poco antes de
+que expire.
+
+Los metadatos estáticos de cada parada se guardan en `StopMetadataCache`: sólo
+se piden a la API (`Text_StopRequired_YN: "Y"`) cuando faltan o caducan; el
+resto de consultas piden únicamente estimaciones.
+
 Variables de entorno utilizadas (opcional):
 - EMT_CLIENT_ID
 - EMT_PASSWORD
+- EMT_TOKEN_CACHE
+- STOP_METADATA_CACHE / STOP_METADATA_TTL_S
+
+Con un transporte `offline` (`replay.ReplayTransport`) no se exigen
+credenciales y ambas cachés se guardan en el `cache_dir` del transporte.
 """
 
 import json
+import logging
 import os
-from typing import Any, Dict, Optional
+import threading
+import time
+from contextlib import ExitStack
+from datetime import datetime
+from typing import Any, Dict, Optional, Tuple
+from zoneinfo import ZoneInfo
+
+import metrics
+from http_transport import HttpTransport
+from stop_metadata import StopMetadataCache
+from token_store import TokenStore, is_fresh
 
-import requests
+_logger = logging.getLogger(__name__)
 
 LOGIN_URL = "https://datos.emtmadrid.es/v3/mobilitylabs/user/login/"
+API_BASE = "https://openapi.emtmadrid.es"
+
+# Validez asumida si el login no informa de `tokenSecExpiration`
+DEFAULT_TOKEN_TTL = 3600
+# Margen con el que se renueva el token antes de que caduque
+TOKEN_REFRESH_MARGIN = 300
+# Códigos HTTP que indican token inválido o caducado
+AUTH_ERROR_STATUS = {401, 403}
+# Códigos HTTP transitorios que se propagan como `requests.HTTPError`
+RETRYABLE_STATUS = {429}
+
+SPAIN = ZoneInfo("Europe/Madrid")
 
 
 class EMTClient:
@@ -25,22 +61,49 @@ class EMTClient:
 
     Args:
        timeout (int): Tiempo de espera en segundos para las peticiones HTTP.
+       transport (Optional[HttpTransport]): Transporte HTTP compartido; si no se
+           indica, el cliente crea uno propio.
+       token_store (Optional[TokenStore]): Caché persistente del token; si no se
+           indica, se usa la ruta por defecto (`EMT_TOKEN_CACHE`).
+       stop_metadata (Optional[StopMetadataCache]): Caché de metadatos de
+           paradas; si no se indica, se usa la ruta por defecto.
 
     Attributes:
         client_id (Optional[str]): Identificador usado.
         password (Optional[str]): Contraseña usada.
         timeout (int): Tiempo de espera para peticiones.
         token (Optional[str]): Token de acceso obtenido tras autenticación.
+        token_expires_at (Optional[float]): Caducidad del token (epoch, segundos).
+        transport (HttpTransport): Sesión HTTP con pool de conexiones.
+        token_store (TokenStore): Caché del token compartida entre procesos.
+        stop_metadata (StopMetadataCache): Metadatos de paradas con TTL largo.
     """
 
     def __init__(
         self,
         timeout: int = 60,
+        transport: Optional[HttpTransport] = None,
+        token_store: Optional[TokenStore] = None,
+        stop_metadata: Optional[StopMetadataCache] = None,
     ):
         self.client_id = os.getenv("EMT_CLIENT_ID")
         self.password = os.getenv("EMT_PASSWORD")
         self.timeout = timeout
         self.token: Optional[str] = None
+        self.token_expires_at: Optional[float] = None
+        self.transport = transport or HttpTransport()
+        # Reproducción sin red: el token y los metadatos grabados no tocan las cachés reales
+        self.offline = getattr(self.transport, "offline", False)
+        cache_dir = getattr(self.transport, "cache_dir", None) if self.offline else None
+        self.token_store = token_store or TokenStore(
+            os.path.join(cache_dir, "emt_token.json") if cache_dir else None
+        )
+        self._token_lock = threading.Lock()
+        self.stop_metadata = stop_metadata or StopMetadataCache(
+            os.path.join(cache_dir, "emt_stops.json") if cache_dir else None
+        )
+        # Cuerpos de `arrives` ya serializados por (con metadatos de parada, fecha)
+        self._arrives_bodies: Dict[Tuple[bool, str], str] = {}
 
     def get_token(self) -> str:
         """
@@ -54,12 +117,13 @@ class EMTClient:
             RuntimeError: Si la respuesta no es JSON, el formato es inesperado o
                 la API responde con error.
         """
-        if not self.client_id or not self.password:
+        if not self.offline and (not self.client_id or not self.password):
             raise ValueError(
                 "Faltan credenciales: configura `EMT_CLIENT_ID` y `EMT_PASSWORD` en el entorno."
             )
-        headers = {"email": self.client_id, "password": self.password}
-        resp = requests.get(LOGIN_URL, headers=headers, timeout=self.timeout)
+        headers = {"email": self.client_id or "", "password": self.password or ""}
+        with metrics.stage("emt_login"):
+            resp = self.transport.get(LOGIN_URL, headers=headers, timeout=self.timeout)
         try:
             data = resp.json()
         except ValueError:
@@ -70,13 +134,20 @@ class EMTClient:
             lst = data.get("data")
             if isinstance(lst, list) and lst and "accessToken" in lst[0]:
                 self.token = lst[0]["accessToken"]
+                self.token_expires_at = time.time() + _token_ttl(lst[0])
+                self._persist_token()
                 return self.token
             raise RuntimeError("Formato de respuesta inesperado: falta accessToken.")
         raise RuntimeError(f"Error al obtener token: {data.get('description') or data}")
 
     def ensure_token(self) -> str:
         """
-        Asegura que existe un token válido en memoria; si no, lo solicita.
+        Asegura que existe un token válido; si no, lo solicita.
+
+        Primero mira el token en memoria, después el persistido en disco y sólo
+        si ambos caducan en menos de `TOKEN_REFRESH_MARGIN` segundos hace login.
+        La comprobación del disco y el login se hacen bajo bloqueo, de modo que
+        hilos y procesos concurrentes esperan al primero y reutilizan su token.
 
         Returns:
             str: Token de acceso.
@@ -84,9 +155,45 @@ class EMTClient:
         Raises:
             Verifica las mismas condiciones que `get_token`.
         """
-        if not self.token:
+        if self.token and is_fresh(self.token_expires_at, TOKEN_REFRESH_MARGIN):
+            return self.token
+        return self._refresh_token(stale_token=self.token)
+
+    def _refresh_token(self, stale_token: Optional[str] = None) -> str:
+        """
+        Renueva el token descartando `stale_token`. Si otro hilo o proceso ya
+        ha guardado uno distinto y vigente, se adopta sin volver a hacer login.
+        Si el bloqueo de la caché no se puede tomar (directorio sin permisos,
+        fichero de bloqueo inválido...), se hace login sólo con el bloqueo local.
+        """
+        with self._token_lock, ExitStack() as stack:
+            try:
+                stack.enter_context(self.token_store.lock())
+                shared = True
+            except OSError as e:
+                _logger.warning(f"Caché de token no disponible ({e}): login sin compartir el token")
+                shared = False
+            if self.token and self.token != stale_token and is_fresh(
+                self.token_expires_at, TOKEN_REFRESH_MARGIN
+            ):
+                return self.token
+            cached = self.token_store.load(self.client_id or "") if shared else None
+            if (
+                cached
+                and cached["access_token"] != stale_token
+                and is_fresh(cached["expires_at"], TOKEN_REFRESH_MARGIN)
+            ):
+                self.token = cached["access_token"]
+                self.token_expires_at = cached["expires_at"]
+                return self.token
             return self.get_token()
-        return self.token
+
+    def _persist_token(self) -> None:
+        try:
+            self.token_store.save(self.client_id or "", self.token, self.token_expires_at)
+        except OSError:
+            # La caché es una optimización: si no se puede escribir seguimos con el token en memoria
+            pass
 
     def lines_bus_stop(self, stop_id: str) -> Optional[Dict[str, Any]]:
         """
@@ -95,23 +202,28 @@ class EMTClient:
         Args:
             stop_id (str): Identificador de la parada EMT.
 
+        Si la parada no está en `stop_metadata` (o ha caducado) se piden también
+        sus metadatos y se guardan; en otro caso sólo se piden estimaciones.
+        En ambos casos cada llegada lleva `stop_name` y `stop_coords` de la caché.
+
         Returns:
             Optional[Dict[str, Any]]: Bloque de llegadas (`Arrive`) tal como lo
             devuelve la API, para ser procesado por el caller.
+
+        Raises:
+            requests.HTTPError: Ante 429 o 5xx, para que el caller reintente.
+            RuntimeError: Ante cualquier otra respuesta de error o formato inesperado.
         """
         token = self.ensure_token()
-        url = f"https://openapi.emtmadrid.es/v2/transport/busemtmad/stops/{stop_id}/arrives/"
-        headers = {"accessToken": token, "Content-Type": "application/json"}
-        payload = {
-            "cultureInfo": "ES",
-            "Text_StopRequired_YN": "Y",
-            "Text_EstimationsRequired_YN": "Y",
-            "Text_IncidencesRequired_YN": "N",
-            "DateTime_Referenced_Incidencies_YYYYMMDD": "20260117",
-        }
-        resp = requests.post(
-            url, headers=headers, data=json.dumps(payload), timeout=self.timeout
-        )
+        with_stop = self.stop_metadata.get(stop_id) is None
+        resp = self._post_arrives(stop_id, token, with_stop)
+        if resp.status_code in AUTH_ERROR_STATUS:
+            # Token revocado o caducado antes de lo previsto: renovamos una sola vez
+            token = self._refresh_token(stale_token=token)
+            resp = self._post_arrives(stop_id, token, with_stop)
+        if resp.status_code in RETRYABLE_STATUS or resp.status_code >= 500:
+            # Errores transitorios como HTTPError para que el caller pueda reintentar
+            resp.raise_for_status()
         try:
             data = resp.json()
         except ValueError:
@@ -123,6 +235,47 @@ class EMTClient:
                 f"La API respondió con error: {data.get('description') or data}"
             )
         try:
-            return data["data"][0]["Arrive"]
+            block = data["data"][0]
+            arrivals = block["Arrive"]
         except Exception:
             raise RuntimeError("Formato inesperado en la respuesta de llegadas.")
+        stop_info = block.get("StopInfo")
+        if with_stop and isinstance(stop_info, list) and stop_info:
+            self.stop_metadata.put(stop_id, stop_info[0])
+        if arrivals:
+            self.stop_metadata.join(stop_id, arrivals)
+        return arrivals
+
+    def _arrives_body(self, with_stop: bool) -> str:
+        """Cuerpo JSON de `arrives`, serializado una vez por variante y día."""
+        day = datetime.now(SPAIN).strftime("%Y%m%d")
+        key = (with_stop, day)
+        body = self._arrives_bodies.get(key)
+        if body is None:
+            body = json.dumps({
+                "cultureInfo": "ES",
+                "Text_StopRequired_YN": "Y" if with_stop else "N",
+                "Text_EstimationsRequired_YN": "Y",
+                "Text_IncidencesRequired_YN": "N",
+                "DateTime_Referenced_Incidencies_YYYYMMDD": day,
+            })
+            # Sólo se conservan las variantes del día en curso
+            self._arrives_bodies = {k: v for k, v in self._arrives_bodies.items() if k[1] == day}
+            self._arrives_bodies[key] = body
+        return body
+
+    def _post_arrives(self, stop_id: str, token: str, with_stop: bool = True):
+        url = f"{API_BASE}/v2/transport/busemtmad/stops/{stop_id}/arrives/"
+        headers = {"accessToken": token, "Content-Type": "application/json"}
+        return self.transport.post(
+            url, headers=headers, data=self._arrives_body(with_stop), timeout=self.timeout
+        )
+
+
+def _token_ttl(login_data: Dict[str, Any]) -> float:
+    """Segundos de validez del token según `tokenSecExpiration` del login."""
+    try:
+        ttl = float(login_data.get("tokenSecExpiration"))
+    except (TypeError, ValueError):
+        return DEFAULT_TOKEN_TTL
+    return ttl if ttl > 0 else DEFAULT_TOKEN_TTL
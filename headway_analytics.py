@@ -0,0 +1,299 @@
+# python
+"""
+Análisis incremental de intervalos de paso (headways) por línea y parada.
+
+Este módulo proporciona la clase `HeadwayAnalyzer`, que recibe en cada ciclo
+la salida de `main.group_by_line` y mantiene, por (línea, destino, parada):
+
+- Headways observados: cuando un vehículo desaparece de la lista de una
+  parada con una estimación de llegada reciente (`pass_window`), se da por
+  pasado en ``instante del ciclo + estimateArrive`` y el headway es el tiempo
+  desde el paso anterior por esa misma parada.
+- Headways previstos: diferencias entre las estimaciones ordenadas de los
+  vehículos que se acercan ahora a la parada.
+- Estadísticos en streaming de los headways observados: media y varianza de
+  Welford, media móvil exponencial y percentiles con el sketch P² de Jain y
+  Chlamtac (memoria constante, sin guardar el histórico).
+- Eventos de agrupamiento (``bunching``: headway menor que `bunching_s`) y de
+  hueco (``gap``: headway mayor que `gap_factor` veces la media), tanto
+  observados como previstos.
+
+Sólo se recalculan las claves cuyo conjunto de vehículos o estimaciones ha
+cambiado respecto al ciclo anterior, y el informe de cada ciclo contiene sólo
+esas claves.
+
+Formato del informe::
+
+    {
+        "type": "headways",
+        "generated_at": "2024-05-01T10:00:00+00:00",
+        "stats": [{"line", "destination", "stop", "count", "mean_s", "std_s",
+                   "ewma_s", "p50_s", "p90_s", "predicted_s": [...]}, ...],
+        "events": [{"type": "bunching" | "gap", "observed": bool, "line",
+                    "destination", "stop", "headway_s", "vehicles": [a, b]}, ...]
+    }
+
+Variables de entorno utilizadas por `main` (opcional):
+- HEADWAY_ANALYTICS: "1" para calcular y publicar el informe en cada ciclo.
+- HEADWAY_BUNCHING_S: headway por debajo del cual hay agrupamiento (por defecto 60).
+- HEADWAY_GAP_FACTOR: múltiplo de la media a partir del cual hay hueco (por defecto 2).
+"""
+
+import math
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+HEADWAYS = "headways"
+DEFAULT_BUNCHING_S = 60.0
+DEFAULT_GAP_FACTOR = 2.0
+# Estimación máxima (s) con la que la desaparición de un vehículo cuenta como paso
+DEFAULT_PASS_WINDOW = 120.0
+DEFAULT_EWMA_ALPHA = 0.1
+# Observaciones mínimas antes de detectar huecos respecto a la media
+MIN_GAP_SAMPLES = 5
+
+StopKey = Tuple[Any, Any, Any]
+
+
+class P2Quantile:
+    """
+    Estimador P² de un cuantil `p` en memoria constante (cinco marcadores).
+
+    Con menos de cinco observaciones devuelve el cuantil exacto.
+    """
+
+    def __init__(self, p: float):
+        self.p = p
+        self._q: List[float] = []
+        self._n = [0, 1, 2, 3, 4]
+        self._np = [0.0, 2 * p, 4 * p, 2 + 2 * p, 4.0]
+        self._dn = [0.0, p / 2, p, (1 + p) / 2, 1.0]
+
+    def add(self, x: float) -> None:
+        q = self._q
+        if len(q) < 5:
+            q.append(x)
+            q.sort()
+            return
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = next(i for i in range(4) if q[i] <= x < q[i + 1])
+        for i in range(k + 1, 5):
+            self._n[i] += 1
+        for i in range(5):
+            self._np[i] += self._dn[i]
+        for i in (1, 2, 3):
+            d = self._np[i] - self._n[i]
+            if (d >= 1 and self._n[i + 1] - self._n[i] > 1) or (d <= -1 and self._n[i - 1] - self._n[i] < -1):
+                step = 1 if d > 0 else -1
+                candidate = self._parabolic(i, step)
+                if not q[i - 1] < candidate < q[i + 1]:
+                    candidate = q[i] + step * (q[i + step] - q[i]) / (self._n[i + step] - self._n[i])
+                q[i] = candidate
+                self._n[i] += step
+
+    def _parabolic(self, i: int, d: int) -> float:
+        q, n = self._q, self._n
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self) -> Optional[float]:
+        q = self._q
+        if not q:
+            return None
+        if len(q) < 5 or self._n[4] < 5:
+            k = (len(q) - 1) * self.p
+            lo, hi = int(k), min(int(k) + 1, len(q) - 1)
+            return q[lo] + (q[hi] - q[lo]) * (k - lo)
+        return q[2]
+
+
+class RunningStats:
+    """Media/varianza (Welford), media móvil exponencial y percentiles P²."""
+
+    def __init__(self, percentiles: Sequence[float] = (0.5, 0.9), alpha: float = DEFAULT_EWMA_ALPHA):
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.ewma: Optional[float] = None
+        self.alpha = alpha
+        self.sketches = {p: P2Quantile(p) for p in percentiles}
+
+    def add(self, x: float) -> None:
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (x - self.mean)
+        self.ewma = x if self.ewma is None else self.alpha * x + (1 - self.alpha) * self.ewma
+        for sketch in self.sketches.values():
+            sketch.add(x)
+
+    @property
+    def variance(self) -> float:
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = {
+            "count": self.count,
+            "mean_s": self.mean if self.count else None,
+            "std_s": math.sqrt(self.variance) if self.count > 1 else None,
+            "ewma_s": self.ewma,
+        }
+        for p, sketch in self.sketches.items():
+            out[f"p{round(p * 100)}_s"] = sketch.value()
+        return out
+
+
+class _StopState:
+    __slots__ = ("etas", "seen_at", "last_pass", "last_vehicle", "stats", "predicted")
+
+    def __init__(self, percentiles: Sequence[float]):
+        self.etas: Dict[Any, float] = {}
+        self.seen_at = 0.0
+        self.last_pass: Optional[float] = None
+        self.last_vehicle: Any = None
+        self.stats = RunningStats(percentiles)
+        self.predicted: List[float] = []
+
+
+class HeadwayAnalyzer:
+    """
+    Headways, agrupamientos y huecos por (línea, destino, parada) entre ciclos.
+
+    Args:
+        bunching_s (float): Headway (s) por debajo del cual hay agrupamiento.
+        gap_factor (float): Múltiplo de la media por encima del cual hay hueco.
+        pass_window (float): Estimación máxima (s) con la que la desaparición
+            de un vehículo se cuenta como paso por la parada; por encima se
+            considera que ha salido de la consulta (p. ej. parada sin datos).
+        percentiles (Sequence[float]): Cuantiles estimados con P².
+    """
+
+    def __init__(
+        self,
+        bunching_s: float = DEFAULT_BUNCHING_S,
+        gap_factor: float = DEFAULT_GAP_FACTOR,
+        pass_window: float = DEFAULT_PASS_WINDOW,
+        percentiles: Sequence[float] = (0.5, 0.9),
+    ):
+        self.bunching_s = bunching_s
+        self.gap_factor = gap_factor
+        self.pass_window = pass_window
+        self.percentiles = tuple(percentiles)
+        self._stops: Dict[StopKey, _StopState] = {}
+        # Claves con vehículos en el último ciclo, por parada
+        self._active: Dict[str, Set[StopKey]] = {}
+
+    def stats(self, line: Any, destination: Any, stop: Any) -> Optional[Dict[str, Any]]:
+        """Estadísticos acumulados de una parada, o None si no hay datos."""
+        state = self._stops.get((line, destination, stop))
+        return None if state is None else self._stat_entry((line, destination, stop), state)
+
+    def update(self, groups: Iterable[Dict[str, Any]], now: float,
+               stops: Optional[Iterable[Any]] = None) -> Dict[str, Any]:
+        """
+        Incorpora el snapshot `groups` (salida de `group_by_line`) tomado en
+        el instante `now` (epoch) y devuelve el informe de las claves cambiadas.
+
+        Con `stops`, `groups` es un snapshot parcial que sólo cubre esas
+        paradas (pipeline en streaming): las claves de otras paradas no se
+        dan por pasadas.
+        """
+        current: Dict[StopKey, Dict[Any, float]] = {}
+        for group in groups:
+            for entry in group.get("stops", []):
+                vid, eta = entry.get("vehicle_id"), entry.get("estimateArrive")
+                if vid is None or not isinstance(eta, (int, float)):
+                    continue
+                key = (entry.get("line"), entry.get("destination"), entry.get("stop"))
+                current.setdefault(key, {})[vid] = float(eta)
+
+        stats: List[Dict[str, Any]] = []
+        events: List[Dict[str, Any]] = []
+        # Claves con vehículos ahora o en el ciclo anterior (en las paradas cubiertas)
+        if stops is None:
+            covered = list(self._active)
+        else:
+            covered = {str(stop) for stop in stops} | {str(key[2]) for key in current}
+        previous: Set[StopKey] = set()
+        for stop in covered:
+            previous.update(self._active.pop(stop, ()))
+        for key in previous.union(current):
+            etas = current.get(key, {})
+            state = self._stops.get(key)
+            if state is not None and state.etas == etas:
+                # Misma estimación en un ciclo posterior: el paso previsto se retrasa
+                state.seen_at = now
+                continue
+            if state is None:
+                state = self._stops[key] = _StopState(self.percentiles)
+            self._observe_passes(key, state, etas, events)
+            state.etas, state.seen_at = etas, now
+            self._predict(key, state, events)
+            stats.append(self._stat_entry(key, state))
+        for key in current:
+            self._active.setdefault(str(key[2]), set()).add(key)
+
+        return {
+            "type": HEADWAYS,
+            "generated_at": datetime.fromtimestamp(now, timezone.utc).isoformat(),
+            "stats": stats,
+            "events": events,
+        }
+
+    def _observe_passes(self, key: StopKey, state: _StopState, etas: Dict[Any, float],
+                        events: List[Dict[str, Any]]) -> None:
+        passed = sorted(
+            (state.seen_at + eta, vid)
+            for vid, eta in state.etas.items()
+            if vid not in etas and eta <= self.pass_window
+        )
+        for at, vid in passed:
+            if state.last_pass is not None and at > state.last_pass:
+                headway = at - state.last_pass
+                self._classify(key, state, headway, (state.last_vehicle, vid), True, events)
+                state.stats.add(headway)
+            state.last_pass, state.last_vehicle = at, vid
+
+    def _predict(self, key: StopKey, state: _StopState, events: List[Dict[str, Any]]) -> None:
+        ordered = sorted(state.etas.items(), key=lambda item: item[1])
+        state.predicted = []
+        for (a, eta_a), (b, eta_b) in zip(ordered, ordered[1:]):
+            headway = eta_b - eta_a
+            state.predicted.append(headway)
+            self._classify(key, state, headway, (a, b), False, events)
+
+    def _classify(self, key: StopKey, state: _StopState, headway: float, vehicles: Tuple[Any, Any],
+                  observed: bool, events: List[Dict[str, Any]]) -> None:
+        if headway < self.bunching_s:
+            kind = "bunching"
+        elif state.stats.count >= MIN_GAP_SAMPLES and headway > self.gap_factor * state.stats.mean:
+            kind = "gap"
+        else:
+            return
+        events.append({
+            "type": kind,
+            "observed": observed,
+            "line": key[0],
+            "destination": key[1],
+            "stop": key[2],
+            "headway_s": headway,
+            "vehicles": list(vehicles),
+        })
+
+    @staticmethod
+    def _stat_entry(key: StopKey, state: _StopState) -> Dict[str, Any]:
+        return {
+            "line": key[0],
+            "destination": key[1],
+            "stop": key[2],
+            **state.stats.to_dict(),
+            "predicted_s": list(state.predicted),
+        }
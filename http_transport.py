@@ -0,0 +1,102 @@
+# python
+"""
+Transporte HTTP compartido por los clientes de EMT y AEMET.
+
+Este módulo proporciona la clase `HttpTransport`, un envoltorio sobre
+`requests.Session` con pool de conexiones y keep-alive, para que las
+peticiones sucesivas a un mismo host reutilicen la conexión TCP+TLS en lugar
+de repetir el handshake en cada llamada.
+
+Variables de entorno utilizadas (opcional):
+- HTTP_POOL_CONNECTIONS: número de hosts distintos con pool propio.
+- HTTP_POOL_MAXSIZE: conexiones máximas por host por defecto.
+"""
+
+import os
+import threading
+from typing import Any, Dict, Optional
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+
+
+class HttpTransport:
+    """
+    Sesión HTTP con pool de conexiones reutilizable entre clientes.
+
+    Args:
+        pool_connections (Optional[int]): Número de pools (hosts) a mantener.
+        pool_maxsize (Optional[int]): Conexiones máximas por host por defecto.
+        host_pool_sizes (Optional[Dict[str, int]]): Tamaño de pool específico
+            por prefijo de URL, p. ej. ``{"https://openapi.emtmadrid.es": 32}``.
+
+    Attributes:
+        session (requests.Session): Sesión subyacente con keep-alive.
+    """
+
+    def __init__(
+        self,
+        pool_connections: Optional[int] = None,
+        pool_maxsize: Optional[int] = None,
+        host_pool_sizes: Optional[Dict[str, int]] = None,
+    ):
+        self.pool_connections = pool_connections or int(
+            os.getenv("HTTP_POOL_CONNECTIONS", DEFAULT_POOL_CONNECTIONS)
+        )
+        self.pool_maxsize = pool_maxsize or int(
+            os.getenv("HTTP_POOL_MAXSIZE", DEFAULT_POOL_MAXSIZE)
+        )
+        self._lock = threading.Lock()
+        self.session = requests.Session()
+
+        default_adapter = HTTPAdapter(
+            pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize
+        )
+        self.session.mount("https://", default_adapter)
+        self.session.mount("http://", default_adapter)
+
+        for prefix, size in (host_pool_sizes or {}).items():
+            self.set_host_pool_size(prefix, size)
+
+    def set_host_pool_size(self, prefix: str, size: int) -> None:
+        """
+        Monta un adaptador con `size` conexiones para las URLs que empiezan por `prefix`.
+
+        Conviene igualarlo a la concurrencia máxima contra ese host: si hay más
+        hilos que conexiones, urllib3 descarta las sobrantes y vuelve a abrirlas.
+        """
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, int(size)))
+        with self._lock:
+            self.session.mount(prefix, adapter)
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self._request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self._request("POST", url, **kwargs)
+
+    def _request(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        host = urlsplit(url).netloc
+        try:
+            resp = self.session.request(method, url, **kwargs)
+        except requests.RequestException:
+            metrics.HTTP_RESPONSES.inc(host=host, status="error")
+            raise
+        metrics.HTTP_RESPONSES.inc(host=host, status=str(resp.status_code))
+        return resp
+
+    def close(self) -> None:
+        """Cierra todas las conexiones del pool."""
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
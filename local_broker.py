@@ -0,0 +1,247 @@
+# python
+"""
+Broker AMQP en memoria para benchmarks y pruebas locales.
+
+Este módulo proporciona `InMemoryBroker`, que imita el subconjunto de
+`pika.BlockingConnection` / `BlockingChannel` que usan `RabbitPublisher`
+(declarar cola, activar confirms, publicar y cerrar) y `consumer`
+(`basic_qos`, `consume`, `basic_ack`/`basic_nack` con `multiple`), sin red
+ni RabbitMQ. Los mensajes sin ack vuelven a la cola al cerrar el canal.
+
+Uso::
+
+    broker = InMemoryBroker()
+    pub = RabbitPublisher(connection_factory=broker.connection_factory)
+    pub.publish({"hola": "mundo"})
+    body, properties = broker.queues["micola_queue"][0]
+"""
+
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass
+from typing import Any, Deque, Dict, Iterator, Optional, Tuple
+
+from pika.exceptions import ChannelClosedByBroker, ConnectionClosed, UnroutableError
+
+Message = Tuple[bytes, Any]
+
+
+@dataclass
+class Delivery:
+    """Equivalente mínimo de `pika.spec.Basic.Deliver`."""
+
+    delivery_tag: int
+    routing_key: str
+    redelivered: bool = False
+
+
+class InMemoryChannel:
+    """Canal que publica directamente en las colas del broker."""
+
+    def __init__(self, broker: "InMemoryBroker", connection: "InMemoryConnection"):
+        self._broker = broker
+        self._connection = connection
+        self.confirms = False
+        self.is_open = True
+        self.prefetch_count = 0
+        self._next_tag = 0
+        # delivery_tag -> (cola, mensaje) pendientes de ack, en orden de entrega
+        self._unacked: "OrderedDict[int, Tuple[str, Message]]" = OrderedDict()
+
+    @property
+    def is_closed(self) -> bool:
+        return not self.is_open
+
+    def _check_open(self) -> None:
+        if not self.is_open or self._connection.is_closed:
+            raise ChannelClosedByBroker(504, "Canal cerrado")
+
+    def queue_declare(self, queue: str, durable: bool = False, **_kwargs: Any) -> None:
+        self._check_open()
+        self._broker.declare(queue)
+
+    def confirm_delivery(self) -> None:
+        self._check_open()
+        self.confirms = True
+
+    def basic_publish(
+        self,
+        exchange: str,
+        routing_key: str,
+        body: bytes,
+        properties: Any = None,
+        mandatory: bool = False,
+    ) -> None:
+        self._check_open()
+        if self._broker.fail_next_publishes > 0:
+            self._broker.fail_next_publishes -= 1
+            self._connection.is_open = False
+            raise ConnectionClosed(320, "Fallo simulado del broker")
+        if not self._broker.route(routing_key, body, properties) and mandatory:
+            raise UnroutableError([])
+
+    def basic_qos(self, prefetch_count: int = 0, **_kwargs: Any) -> None:
+        self._check_open()
+        self.prefetch_count = prefetch_count
+
+    def consume(self, queue: str, inactivity_timeout: Optional[float] = None, **_kwargs: Any) -> Iterator[Tuple[Any, Any, Any]]:
+        """
+        Como `BlockingChannel.consume`: entrega `(method, properties, body)`
+        respetando `prefetch_count` y `(None, None, None)` si pasa
+        `inactivity_timeout` sin mensajes.
+        """
+        self._check_open()
+        while self.is_open:
+            message = self._broker.take(
+                queue, inactivity_timeout,
+                lambda: not self.prefetch_count or len(self._unacked) < self.prefetch_count,
+            )
+            if message is None:
+                yield None, None, None
+                continue
+            (body, properties), redelivered = message
+            self._next_tag += 1
+            self._unacked[self._next_tag] = (queue, (body, properties))
+            yield Delivery(self._next_tag, queue, redelivered), properties, body
+
+    def _settle(self, delivery_tag: int, multiple: bool) -> list:
+        if multiple:
+            tags = [t for t in self._unacked if t <= delivery_tag]
+        else:
+            tags = [delivery_tag] if delivery_tag in self._unacked else []
+        return [self._unacked.pop(t) for t in tags]
+
+    def basic_ack(self, delivery_tag: int = 0, multiple: bool = False) -> None:
+        self._check_open()
+        settled = self._settle(delivery_tag, multiple)
+        self._broker.acked += len(settled)
+        self._broker.notify()
+
+    def basic_nack(self, delivery_tag: int = 0, multiple: bool = False, requeue: bool = True) -> None:
+        self._check_open()
+        settled = self._settle(delivery_tag, multiple)
+        if requeue:
+            self._broker.requeue(settled)
+        else:
+            self._broker.dead_lettered.extend(message for _queue, message in settled)
+        self._broker.notify()
+
+    def cancel(self) -> int:
+        """Devuelve a la cola los mensajes sin ack (como al cancelar en pika)."""
+        pending = list(self._unacked.values())
+        self._unacked.clear()
+        self._broker.requeue(pending)
+        return len(pending)
+
+    def close(self) -> None:
+        if self.is_open:
+            self.cancel()
+        self.is_open = False
+
+
+class InMemoryConnection:
+    """Conexión ficticia compatible con lo que usa `RabbitPublisher`."""
+
+    def __init__(self, broker: "InMemoryBroker"):
+        self._broker = broker
+        self.is_open = True
+        self._channels = []
+
+    @property
+    def is_closed(self) -> bool:
+        return not self.is_open
+
+    def channel(self) -> InMemoryChannel:
+        if self.is_closed:
+            raise ConnectionClosed(320, "Conexión cerrada")
+        channel = InMemoryChannel(self._broker, self)
+        self._channels.append(channel)
+        return channel
+
+    def process_data_events(self, time_limit: Optional[float] = 0) -> None:
+        pass
+
+    def close(self) -> None:
+        for channel in self._channels:
+            channel.close()
+        self.is_open = False
+
+
+class InMemoryBroker:
+    """
+    Colas en memoria compartidas entre conexiones.
+
+    Attributes:
+        queues (Dict[str, Deque[Message]]): Mensajes `(body, properties)` por cola.
+        fail_next_publishes (int): Número de publicaciones siguientes que
+            fallarán con `ConnectionClosed` (para simular caídas).
+        acked (int): Mensajes confirmados por consumidores.
+        dead_lettered (list): Mensajes rechazados sin reencolar.
+    """
+
+    def __init__(self):
+        self.queues: Dict[str, Deque[Message]] = {}
+        self.fail_next_publishes = 0
+        self.published = 0
+        self.acked = 0
+        self.dead_lettered = []
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+        # Mensajes reencolados (se entregan con redelivered=True)
+        self._redelivered: Dict[str, Deque[Message]] = {}
+
+    def declare(self, queue: str) -> None:
+        with self._lock:
+            self.queues.setdefault(queue, deque())
+
+    def route(self, queue: str, body: bytes, properties: Any) -> bool:
+        with self._lock:
+            q = self.queues.get(queue)
+            if q is None:
+                return False
+            q.append((body, properties))
+            self.published += 1
+            self._available.notify_all()
+            return True
+
+    def take(self, queue: str, timeout: Optional[float], can_take) -> Optional[Tuple[Message, bool]]:
+        """Saca el siguiente mensaje de `queue` cuando `can_take()`; None si vence `timeout`."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._available:
+            while True:
+                if can_take():
+                    redelivered = self._redelivered.get(queue)
+                    if redelivered:
+                        return redelivered.popleft(), True
+                    q = self.queues.get(queue)
+                    if q:
+                        return q.popleft(), False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._available.wait(remaining)
+
+    def requeue(self, settled) -> None:
+        with self._available:
+            for queue, message in settled:
+                self._redelivered.setdefault(queue, deque()).append(message)
+            self._available.notify_all()
+
+    def notify(self) -> None:
+        with self._available:
+            self._available.notify_all()
+
+    def pending(self, queue: str) -> int:
+        """Mensajes listos para entregar en `queue` (incluidos los reencolados)."""
+        with self._lock:
+            return len(self.queues.get(queue, ())) + len(self._redelivered.get(queue, ()))
+
+    def connection_factory(self, _params: Any = None) -> InMemoryConnection:
+        return InMemoryConnection(self)
+
+    def purge(self, queue: Optional[str] = None) -> None:
+        with self._lock:
+            for name, q in list(self.queues.items()) + list(self._redelivered.items()):
+                if queue is None or name == queue:
+                    q.clear()
@@ -0,0 +1,308 @@
+# python
+"""
+MongoDB en memoria para benchmarks y pruebas locales.
+
+Este módulo proporciona `InMemoryMongoClient`, que imita el subconjunto de
+`pymongo.MongoClient` / `Database` / `Collection` que usan `consumer` y
+`arrival_store`, sin servidor ni `pymongo`:
+
+- `insert_one`, `insert_many` (con `ordered`), `delete_many`.
+- `find` con filtros de igualdad (también sobre rutas ``a.b``) y operadores
+  ``$gt``, ``$gte``, ``$lt``, ``$lte``, ``$in``, ``$ne`` y ``$exists``, más
+  `sort` y `limit` encadenables; `count_documents`.
+- `aggregate` con etapas ``$match`` y ``$group`` (acumuladores ``$sum``,
+  ``$avg``, ``$min``, ``$max`` y ``$addToSet``).
+- `create_index` / `index_information` (sólo se registran) y `create_collection`
+  con opciones (`timeseries`, `expireAfterSeconds`), que tampoco se aplican.
+
+Uso::
+
+    db = InMemoryMongoClient()["madrid"]
+    db["arrivals"].insert_many([{"line": "27"}])
+    db["arrivals"].fail_next_writes = 1  # el siguiente insert falla
+"""
+
+import copy
+import itertools
+import threading
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
+
+_MISSING = object()
+_ids = itertools.count(1)
+
+
+class InMemoryWriteError(Exception):
+    """Fallo de escritura simulado (equivalente a `pymongo.errors.PyMongoError`)."""
+
+
+@dataclass
+class InsertManyResult:
+    inserted_ids: List[Any] = field(default_factory=list)
+
+
+@dataclass
+class DeleteResult:
+    deleted_count: int = 0
+
+
+def _get_path(doc: Mapping[str, Any], path: str) -> Any:
+    value: Any = doc
+    for part in path.split("."):
+        if not isinstance(value, Mapping) or part not in value:
+            return _MISSING
+        value = value[part]
+    return value
+
+
+def _match_value(value: Any, cond: Any) -> bool:
+    if isinstance(cond, Mapping) and cond and all(str(k).startswith("$") for k in cond):
+        for op, arg in cond.items():
+            present = value is not _MISSING
+            if op == "$exists":
+                if present != bool(arg):
+                    return False
+            elif op == "$ne":
+                if present and value == arg:
+                    return False
+            elif op == "$in":
+                if not present or value not in arg:
+                    return False
+            elif not present or value is None:
+                return False
+            elif op == "$gt" and not value > arg:
+                return False
+            elif op == "$gte" and not value >= arg:
+                return False
+            elif op == "$lt" and not value < arg:
+                return False
+            elif op == "$lte" and not value <= arg:
+                return False
+            elif op not in ("$gt", "$gte", "$lt", "$lte"):
+                raise ValueError(f"Operador no soportado: {op}")
+        return True
+    return value is not _MISSING and value == cond
+
+
+def matches(doc: Mapping[str, Any], flt: Optional[Mapping[str, Any]]) -> bool:
+    """True si `doc` cumple el filtro `flt`."""
+    return all(_match_value(_get_path(doc, k), v) for k, v in (flt or {}).items())
+
+
+SortSpec = Union[str, Sequence[Tuple[str, int]]]
+
+
+class InMemoryCursor:
+    """Resultado de `find`, con `sort` y `limit` encadenables."""
+
+    def __init__(self, docs: List[Dict[str, Any]]):
+        self._docs = docs
+        self._limit = 0
+
+    def sort(self, key: SortSpec, direction: int = 1) -> "InMemoryCursor":
+        spec = [(key, direction)] if isinstance(key, str) else list(key)
+        for path, d in reversed(spec):
+            # Los documentos sin el campo van al principio, como en MongoDB
+            self._docs.sort(
+                key=lambda doc: (_get_path(doc, path) is not _MISSING, _sort_value(doc, path)),
+                reverse=d < 0,
+            )
+        return self
+
+    def limit(self, n: int) -> "InMemoryCursor":
+        self._limit = n
+        return self
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        docs = self._docs[: self._limit] if self._limit else self._docs
+        return iter(copy.deepcopy(docs))
+
+
+def _sort_value(doc: Mapping[str, Any], path: str) -> Any:
+    value = _get_path(doc, path)
+    return (0, "") if value is _MISSING or value is None else (1, value)
+
+
+class InMemoryCollection:
+    """
+    Colección en memoria.
+
+    Attributes:
+        options (Dict[str, Any]): Opciones de `create_collection` (p. ej. `timeseries`).
+        fail_next_writes (int): Número de escrituras siguientes que fallarán
+            con `InMemoryWriteError` (para simular caídas).
+    """
+
+    def __init__(self, name: str, options: Optional[Dict[str, Any]] = None):
+        self.name = name
+        self.options = dict(options or {})
+        self.fail_next_writes = 0
+        self.write_calls = 0
+        # Como en MongoDB, la colección existe tras la primera escritura o índice
+        self.created = False
+        self._docs: List[Dict[str, Any]] = []
+        self._indexes: Dict[str, Dict[str, Any]] = {"_id_": {"key": [("_id", 1)]}}
+        self._lock = threading.Lock()
+
+    def _check_write(self) -> None:
+        self.created = True
+        self.write_calls += 1
+        if self.fail_next_writes > 0:
+            self.fail_next_writes -= 1
+            raise InMemoryWriteError("Fallo simulado de MongoDB")
+
+    def insert_one(self, doc: Dict[str, Any]) -> Any:
+        return self.insert_many([doc]).inserted_ids[0]
+
+    def insert_many(self, docs: Iterable[Dict[str, Any]], ordered: bool = True) -> InsertManyResult:
+        with self._lock:
+            self._check_write()
+            result = InsertManyResult()
+            for doc in docs:
+                doc.setdefault("_id", next(_ids))
+                self._docs.append(copy.deepcopy(doc))
+                result.inserted_ids.append(doc["_id"])
+            return result
+
+    def find(self, flt: Optional[Mapping[str, Any]] = None, projection: Optional[Mapping[str, Any]] = None) -> InMemoryCursor:
+        with self._lock:
+            docs = [d for d in self._docs if matches(d, flt)]
+        if projection:
+            include = {k for k, v in projection.items() if v and k != "_id"}
+            if include and projection.get("_id", 1):
+                include.add("_id")
+            docs = [
+                {k: v for k, v in d.items() if k in include} if include
+                else {k: v for k, v in d.items() if projection.get(k, 1)}
+                for d in docs
+            ]
+        return InMemoryCursor(docs)
+
+    def aggregate(self, pipeline: Sequence[Mapping[str, Any]]) -> Iterator[Dict[str, Any]]:
+        with self._lock:
+            docs = copy.deepcopy(self._docs)
+        for stage in pipeline:
+            (op, arg), = stage.items()
+            if op == "$match":
+                docs = [d for d in docs if matches(d, arg)]
+            elif op == "$group":
+                docs = _group(docs, arg)
+            else:
+                raise NotImplementedError(f"Etapa {op} no soportada por local_mongo")
+        return iter(docs)
+
+    def count_documents(self, flt: Optional[Mapping[str, Any]] = None) -> int:
+        with self._lock:
+            return sum(1 for d in self._docs if matches(d, flt))
+
+    def delete_many(self, flt: Optional[Mapping[str, Any]] = None) -> DeleteResult:
+        with self._lock:
+            self._check_write()
+            before = len(self._docs)
+            self._docs = [d for d in self._docs if not matches(d, flt)]
+            return DeleteResult(before - len(self._docs))
+
+    def create_index(self, keys: SortSpec, **kwargs: Any) -> str:
+        spec = [(keys, 1)] if isinstance(keys, str) else list(keys)
+        name = kwargs.pop("name", None) or "_".join(f"{k}_{d}" for k, d in spec)
+        with self._lock:
+            self.created = True
+            self._indexes[name] = {"key": spec, **kwargs}
+        return name
+
+    def index_information(self) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return copy.deepcopy(self._indexes)
+
+
+def _eval(doc: Mapping[str, Any], expr: Any) -> Any:
+    """Evalúa una expresión de agregación simple: ``"$ruta"``, dict o constante."""
+    if isinstance(expr, str) and expr.startswith("$"):
+        value = _get_path(doc, expr[1:])
+        return None if value is _MISSING else value
+    if isinstance(expr, Mapping):
+        return {k: _eval(doc, v) for k, v in expr.items()}
+    return expr
+
+
+def _group(docs: Iterable[Mapping[str, Any]], spec: Mapping[str, Any]) -> List[Dict[str, Any]]:
+    groups: Dict[Any, Dict[str, Any]] = {}
+    keys: Dict[Any, Any] = {}
+    fields = [(name, *next(iter(acc.items()))) for name, acc in spec.items() if name != "_id"]
+    for doc in docs:
+        key = _eval(doc, spec["_id"])
+        hashable = repr(key)
+        state = groups.get(hashable)
+        if state is None:
+            keys[hashable] = key
+            state = groups[hashable] = {name: [] for name, _op, _expr in fields}
+        for name, _op, expr in fields:
+            state[name].append(_eval(doc, expr))
+    result = []
+    for hashable, state in groups.items():
+        out = {"_id": keys[hashable]}
+        for name, op, _expr in fields:
+            values = state[name]
+            numbers = [v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)]
+            if op == "$sum":
+                out[name] = sum(numbers)
+            elif op == "$avg":
+                out[name] = sum(numbers) / len(numbers) if numbers else None
+            elif op in ("$min", "$max"):
+                present = [v for v in values if v is not None]
+                out[name] = (min if op == "$min" else max)(present) if present else None
+            elif op == "$addToSet":
+                unique = []
+                for v in values:
+                    if v not in unique:
+                        unique.append(v)
+                out[name] = unique
+            else:
+                raise NotImplementedError(f"Acumulador {op} no soportado por local_mongo")
+        result.append(out)
+    return result
+
+
+class InMemoryDatabase:
+    def __init__(self, name: str):
+        self.name = name
+        self._collections: Dict[str, InMemoryCollection] = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, name: str) -> InMemoryCollection:
+        with self._lock:
+            coll = self._collections.get(name)
+            if coll is None:
+                coll = self._collections[name] = InMemoryCollection(name)
+            return coll
+
+    def create_collection(self, name: str, **options: Any) -> InMemoryCollection:
+        with self._lock:
+            coll = self._collections.get(name)
+            if coll is not None and coll.created:
+                raise InMemoryWriteError(f"La colección {name} ya existe")
+            if coll is None:
+                coll = self._collections[name] = InMemoryCollection(name)
+            coll.options = dict(options)
+            coll.created = True
+            return coll
+
+    def list_collection_names(self) -> List[str]:
+        with self._lock:
+            return [name for name, coll in self._collections.items() if coll.created]
+
+
+class InMemoryMongoClient:
+    """Cliente ficticio compatible con el acceso `client[db][coleccion]`."""
+
+    def __init__(self, *_args: Any, **_kwargs: Any):
+        self._dbs: Dict[str, InMemoryDatabase] = {}
+
+    def __getitem__(self, name: str) -> InMemoryDatabase:
+        db = self._dbs.get(name)
+        if db is None:
+            db = self._dbs[name] = InMemoryDatabase(name)
+        return db
+
+    def close(self) -> None:
+        pass
@@ -1,22 +1,87 @@
 
 # python
+import argparse
+import functools
+import itertools
 import json
 import logging
+import multiprocessing
 import os
+import signal
+import sys
 import time
-from typing import Callable, Any
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Any, Dict, Iterable, Iterator, List, Optional, Set, Tuple
 
 from requests import HTTPError
 
-from aemet import AEMETClient
-from emt import EMTClient
+import metrics
+from aemet import AEMETClient, WeatherCache
+from emt import API_BASE as EMT_API_BASE, EMTClient
+from http_transport import HttpTransport
 from bus_arrival_builder import BusArrivalDTOBuilder
+from daemon import IngestDaemon
 from weather_builder import WeatherBuilder
-from queue_bus_builder import QueueBusBuilder
+from weather_stations import IDW, MADRID_CENTER, NEAREST, STATION, StationWeather
+from queue_bus_builder import ColumnarQueueBusBuilder
+from payload_schema import SCHEMA_HEADER, encode_message
+from outbox import Outbox, OutboxDrainer
 from rabbit_publisher import RabbitPublisher
+from rate_limit import get_guard
+from sharding import SHARD_HEADER, assign_stops, load_stops
+from headway_analytics import DEFAULT_BUNCHING_S, DEFAULT_GAP_FACTOR, HEADWAYS, HeadwayAnalyzer
+from replay import RecordingTransport, ReplayTransport
+from snapshot_diff import SnapshotDiffer
+from spatial_index import VehicleIndex
+from trajectory_store import TrajectoryStore
 
 builder = BusArrivalDTOBuilder()
 
+# Límite por defecto de peticiones simultáneas contra la API de EMT
+DEFAULT_EMT_CONCURRENCY = 8
+# Intervalo por defecto entre ciclos en modo daemon (equivale al cron de 5 minutos)
+DEFAULT_INGEST_INTERVAL = 300
+
+# Paradas por defecto si no se indica STOPS_FILE / --stops-file
+PARADAS_OBJETIVO = ["5907", "66", "65", "5407"]
+
+# Caché de observaciones de AEMET compartida entre ciclos y, vía disco, entre ejecuciones cron
+weather_cache = WeatherCache()
+# Cachés de clima de las reproducciones, en el `cache_dir` temporal de cada transporte
+_replay_weather_caches: Dict[str, WeatherCache] = {}
+
+# Volcado por stdout de las llegadas, el clima y el payload completo (depuración)
+PRINT_PAYLOAD = os.getenv("PRINT_PAYLOAD", "0") == "1"
+
+# Esquema del payload: 1 (group_by_line tal cual) o 2 (normalizado, ver payload_schema)
+PAYLOAD_SCHEMA = int(os.getenv("PAYLOAD_SCHEMA", 1))
+
+# Pipeline: "batch" (snapshot completo en memoria) o "stream" (por bloques acotados)
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "batch").lower()
+# Llegadas por mensaje en modo stream
+STREAM_CHUNK_ARRIVALS = int(os.getenv("STREAM_CHUNK_ARRIVALS", 500))
+
+# Modo de publicación: "full" (snapshot completo en cada ciclo) o "delta"
+PUBLISH_MODE = os.getenv("PUBLISH_MODE", "full").lower()
+# Estado del ciclo anterior para el modo delta (se conserva entre ciclos en modo daemon)
+snapshot_differ = SnapshotDiffer(
+    eta_threshold=float(os.getenv("DELTA_ETA_THRESHOLD_S", 30)),
+    distance_threshold=float(os.getenv("DELTA_DISTANCE_THRESHOLD_M", 50)),
+    keyframe_every=int(os.getenv("DELTA_KEYFRAME_EVERY", 12)),
+)
+
+# Posiciones vivas de los vehículos, actualizadas de forma incremental en cada ciclo
+# si SPATIAL_INDEX=1; en modo daemon se consultan en /vehicles/* junto a /metrics
+vehicle_index = VehicleIndex() if os.getenv("SPATIAL_INDEX", "0") == "1" else None
+# Últimas muestras de cada vehículo para derivar velocidad y aceleración entre ciclos.
+# Sólo tiene sentido entre ciclos del mismo proceso: se crea en `run_daemon` si TRAJECTORIES=1
+trajectory_store: Optional[TrajectoryStore] = None
+# Headways y agrupamientos por parada, publicados junto al payload si HEADWAY_ANALYTICS=1
+headway_analyzer = HeadwayAnalyzer(
+    bunching_s=float(os.getenv("HEADWAY_BUNCHING_S", DEFAULT_BUNCHING_S)),
+    gap_factor=float(os.getenv("HEADWAY_GAP_FACTOR", DEFAULT_GAP_FACTOR)),
+) if os.getenv("HEADWAY_ANALYTICS", "0") == "1" else None
+
 def setup_logging():
     level_name = os.getenv("LOG_LEVEL", "INFO").upper()
     level = getattr(logging, level_name, logging.INFO)
@@ -29,124 +94,304 @@ def setup_logging():
 logger = setup_logging()
 
 
-def _get_wait_time(response: Any, attempt: int, backoff_factor: float) -> int:
-    """Calcula el tiempo de espera basado en headers o backoff exponencial."""
-    retry_after = response.headers.get("Retry-After") if response else None
-
-    if retry_after and retry_after.isdigit():
-        return int(retry_after)
+def _weather_mode() -> str:
+    mode = os.getenv("WEATHER_MODE", STATION).lower()
+    if mode not in (STATION, NEAREST, IDW):
+        logger.warning(f"WEATHER_MODE={mode!r} no válido (station, nearest o idw); se usa station.")
+        return STATION
+    return mode
+
+
+# Clima: "station" (una estación para toda la ciudad) o "nearest"/"idw" (por parada)
+WEATHER_MODE = _weather_mode()
+station_weather = StationWeather(
+    mode=WEATHER_MODE,
+    radius_km=float(os.getenv("WEATHER_STATION_RADIUS_KM", 50)),
+    k=int(os.getenv("WEATHER_IDW_K", 3)),
+) if WEATHER_MODE != STATION else None
+
+
+def _group_entry(b, weather, weather_for=None):
+    return {
+        "line": b.get("line"),
+        "destination": b.get("destination"),
+        "stop": b.get("stop"),
+        "stop_name": b.get("stop_name"),
+        "estimateArrive": b.get("estimateArrive"),
+        "vehicle_id": b.get("bus"),
+        "coords": {
+            "lat": b.get("geometry", {}).get("coordinates", [None, None])[1],
+            "lon": b.get("geometry", {}).get("coordinates", [None, None])[0],
+        },
+        "weather": (weather_for(b) if weather_for is not None else None) or weather,
+    }
+
+
+def group_by_line(bus_list, weather, weather_for=None):
+    """
+    Agrupa las llegadas por (línea, destino). Con `weather_for(llegada)` cada
+    llegada lleva el clima de su parada; `weather` queda como valor por defecto.
+    """
+    grouped = {}
+    for b in bus_list:
+        # La clave es la combinación de línea y destino
+        key = (b.get("line"), b.get("destination"))
+        grouped.setdefault(key, []).append(_group_entry(b, weather, weather_for))
 
-    return int(backoff_factor ** attempt)
+    # Al retornar, mantenemos line y destination en la raíz del objeto
+    return [{"line": k[0], "destination": k[1], "stops": v} for k, v in grouped.items()]
 
 
-def retry_on_http_429(func: Callable[[], Any], *, max_attempts: int = 5, backoff_factor: float = 2.0):
+def _fetch_stop(emt: EMTClient, stop: str) -> Optional[List[Dict[str, Any]]]:
     """
-    Ejecuta `func` y reintenta específicamente ante errores HTTP 429.
+    Consulta una única parada y etiqueta cada bus con `origin_stop`.
+    Los errores se aíslan por parada: se registran y se devuelve None, para
+    distinguir una consulta fallida de una parada sin llegadas (lista vacía).
     """
-    for attempt in range(1, max_attempts + 1):
-        try:
-            return func()
-        except HTTPError as e:
-            response = getattr(e, "response", None)
-
-            # Si no es 429, registramos y relanzamos inmediatamente
-            if response is None or response.status_code != 429:
-                logger.error("HTTPError no gestionable (no 429) en intento %d", attempt)
-                raise e
+    logger.info(f"[*] Consultando parada: {stop}")
 
-            # Es un 429: calculamos espera y reintentamos
-            wait = _get_wait_time(response, attempt, backoff_factor)
-            logger.warning("HTTP 429 (Rate Limit). Reintento %d/%d: esperando %ds",
-                           attempt, max_attempts, wait)
-            time.sleep(wait)
+    try:
+        with metrics.stage("emt_stop_fetch"):
+            # Cubo de tokens y circuito compartidos por todos los hilos de EMT
+            buses_in_stop = get_guard("emt").call(lambda: emt.lines_bus_stop(stop))
+
+        # Si la API devuelve None o lista vacía, saltamos a la siguiente
+        if not buses_in_stop:
+            logger.warning(f"La parada {stop} no devolvió datos (posiblemente sin servicio).")
+            return []
+
+        # Procesamos y enriquecemos cada bus
+        for bus in buses_in_stop:
+            bus['origin_stop'] = stop
+
+        return buses_in_stop
+
+    except (RuntimeError, ValueError) as e:
+        # Capturamos errores específicos de la API o de formato (incluido circuito abierto)
+        logger.error(f"Error controlado en parada {stop}: {e}")
+        return None
+    except HTTPError as e:
+        # 429/5xx que persisten tras los reintentos
+        logger.error(f"Error HTTP en parada {stop} tras reintentos: {e}")
+        return None
+    except Exception as e:
+        # Solo capturamos Exception aquí para evitar que el programa muera,
+        # pero registrando el tipo específico para depuración.
+        logger.critical(f"Error inesperado procesando parada {stop}: {type(e).__name__} - {e}")
+        return None
 
-        except Exception as e:
-            logger.exception("Error crítico no recuperable en intento %d", attempt)
-            raise e
 
-    raise RuntimeError(f"Máximo de intentos ({max_attempts}) alcanzado para la API")
+def _emt_concurrency(max_concurrency: Optional[int] = None) -> int:
+    if max_concurrency is None:
+        max_concurrency = int(os.getenv("EMT_MAX_CONCURRENCY", DEFAULT_EMT_CONCURRENCY))
+    return max(1, max_concurrency)
 
 
-def group_by_line(bus_list, weather):
-    grouped = {}
-    for b in bus_list:
-        line = b.get("line")
-        destination = b.get("destination")
-        # La clave es la combinación de ambos
-        key = (line, destination)
-
-        entry = {
-            "line": line,
-            "destination": destination,
-            "stop": b.get("stop"),
-            "estimateArrive": b.get("estimateArrive"),
-            "vehicle_id": b.get("bus"),
-            "coords": {
-                "lat": b.get("geometry", {}).get("coordinates", [None, None])[1],
-                "lon": b.get("geometry", {}).get("coordinates", [None, None])[0],
-            },
-            "weather": weather,
-        }
-        grouped.setdefault(key, []).append(entry)
+def build_transport(max_concurrency: Optional[int] = None):
+    """
+    Crea el transporte HTTP compartido, con tantas conexiones hacia EMT como
+    peticiones simultáneas permitidas.
 
-    # Al retornar, mantenemos line y destination en la raíz del objeto
-    return [{"line": k[0], "destination": k[1], "stops": v} for k, v in grouped.items()]
+    Con `HTTP_REPLAY_FILE` se reproducen respuestas grabadas (sin red) y con
+    `HTTP_RECORD_FILE` se graban las respuestas reales (ver `replay.py`).
+    """
+    replay_file = os.getenv("HTTP_REPLAY_FILE")
+    if replay_file:
+        return ReplayTransport(
+            replay_file,
+            realtime=os.getenv("HTTP_REPLAY_REALTIME", "0") == "1",
+            loop=True,
+        )
+    transport = HttpTransport(host_pool_sizes={EMT_API_BASE: _emt_concurrency(max_concurrency)})
+    record_file = os.getenv("HTTP_RECORD_FILE")
+    if record_file:
+        return RecordingTransport(record_file, inner=transport)
+    return transport
 
 
-def get_all_bus_data(stops):
+def build_outbox() -> Optional[Outbox]:
     """
-    Recupera y agrega los datos de todas las paradas especificadas.
+    Outbox en disco para los payloads que RabbitMQ no confirme (ver `outbox.py`).
+    Se desactiva con `OUTBOX_ENABLED=0`.
     """
-    emt = EMTClient()
-    all_buses = []
+    if os.getenv("OUTBOX_ENABLED", "1") == "0":
+        return None
+    return Outbox(logger=logger)
+
+
+def _drain_outbox(drainer: Optional[OutboxDrainer], **kwargs) -> None:
+    if drainer is None:
+        return
+    try:
+        drainer.drain(**kwargs)
+    except Exception as e:
+        logger.error(f"Error drenando el outbox: {type(e).__name__} - {e}")
 
-    for stop in stops:
-        logger.info(f"[*] Consultando parada: {stop}")
 
-        try:
-            buses_in_stop = emt.lines_bus_stop(stop)
+def get_all_bus_data(
+    stops,
+    max_concurrency: Optional[int] = None,
+    transport: Optional[HttpTransport] = None,
+    emt: Optional[EMTClient] = None,
+) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Recupera y agrega los datos de todas las paradas especificadas.
 
-            # Si la API devuelve None o lista vacía, saltamos a la siguiente
-            if not buses_in_stop:
-                logger.warning(f"La parada {stop} no devolvió datos (posiblemente sin servicio).")
-                continue
+    Las paradas se consultan en paralelo con un pool de hilos limitado a
+    `max_concurrency` peticiones simultáneas contra la API de EMT (por defecto
+    `EMT_MAX_CONCURRENCY` o 8). Con `max_concurrency=1` se mantiene el
+    comportamiento secuencial. El orden del resultado sigue el de `stops`.
 
-            # Procesamos y enriquecemos cada bus
-            for bus in buses_in_stop:
-                bus['origin_stop'] = stop
+    Devuelve ``(llegadas, paradas consultadas con éxito)``; una parada cuya
+    consulta falla no aporta llegadas ni figura en la segunda lista.
+    """
+    max_concurrency = min(_emt_concurrency(max_concurrency), len(stops) or 1)
 
-            all_buses.extend(buses_in_stop)
+    emt = emt or EMTClient(transport=transport)
+    # Pedimos el token antes de lanzar los hilos para que no hagan login en paralelo
+    try:
+        emt.ensure_token()
+    except (RuntimeError, ValueError) as e:
+        logger.error(f"No se pudo obtener token de EMT: {e}")
+        return [], []
 
-        except (RuntimeError, ValueError) as e:
-            # Capturamos errores específicos de la API o de formato
-            logger.error(f"Error controlado en parada {stop}: {e}")
-            continue
-        except Exception as e:
-            # Solo capturamos Exception aquí para evitar que el programa muera,
-            # pero registrando el tipo específico para depuración.
-            logger.critical(f"Error inesperado procesando parada {stop}: {type(e).__name__} - {e}")
+    if max_concurrency == 1:
+        results = [_fetch_stop(emt, stop) for stop in stops]
+    else:
+        with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="emt-stop") as pool:
+            results = list(pool.map(lambda stop: _fetch_stop(emt, stop), stops))
+
+    all_buses = []
+    fetched = []
+    for stop, buses_in_stop in zip(stops, results):
+        if buses_in_stop is None:
             continue
+        all_buses.extend(buses_in_stop)
+        fetched.append(stop)
+    return all_buses, fetched
 
-    return all_buses
 
-def main():
-    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO")) # requiere AEMET_API_KEY en entorno
-    # Instanciar correctamente pasando la api_key como keyword argument
+def iter_bus_data(
+    stops: Iterable[str],
+    max_concurrency: Optional[int] = None,
+    transport: Optional[HttpTransport] = None,
+    emt: Optional[EMTClient] = None,
+) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    Variante en streaming de `get_all_bus_data`: produce ``(parada, llegadas)``
+    según terminan las consultas, en orden de finalización. Las paradas cuya
+    consulta falla no se producen.
 
-    weather_dict=get_weather()
+    Como mucho hay ``2 * max_concurrency`` paradas en vuelo o esperando a ser
+    consumidas, de modo que la memoria no depende del número de paradas.
+    """
+    max_concurrency = _emt_concurrency(max_concurrency)
 
+    emt = emt or EMTClient(transport=transport)
+    try:
+        emt.ensure_token()
+    except (RuntimeError, ValueError) as e:
+        logger.error(f"No se pudo obtener token de EMT: {e}")
+        return
 
+    pending_stops = iter(stops)
+    with ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="emt-stop") as pool:
+        in_flight = {
+            pool.submit(_fetch_stop, emt, stop): stop
+            for stop in itertools.islice(pending_stops, 2 * max_concurrency)
+        }
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                stop = in_flight.pop(future)
+                for next_stop in itertools.islice(pending_stops, 1):
+                    in_flight[pool.submit(_fetch_stop, emt, next_stop)] = next_stop
+                buses = future.result()
+                if buses is not None:
+                    yield stop, buses
+
+
+def group_in_chunks(
+    stop_batches: Iterable[Tuple[str, List[Dict[str, Any]]]],
+    weather: Dict[str, Any],
+    chunk_arrivals: int = STREAM_CHUNK_ARRIVALS,
+    weather_for: Optional[Callable[[Dict[str, Any]], Optional[Dict[str, Any]]]] = None,
+) -> Iterator[Tuple[List[Dict[str, Any]], List[str]]]:
+    """
+    Agrupa por (línea, destino) como `group_by_line`, pero emite un bloque
+    ``(grupos, paradas)`` cada vez que acumula `chunk_arrivals` llegadas.
+    Las paradas no se parten entre bloques; un mismo grupo puede aparecer en
+    varios bloques con llegadas distintas.
+    """
+    grouped: Dict[Tuple[Any, Any], List[Dict[str, Any]]] = {}
+    chunk_stops: List[str] = []
+    size = 0
+    for stop, buses in stop_batches:
+        for b in buses:
+            grouped.setdefault((b.get("line"), b.get("destination")), []).append(_group_entry(b, weather, weather_for))
+        chunk_stops.append(stop)
+        size += len(buses)
+        if size >= chunk_arrivals:
+            yield [{"line": k[0], "destination": k[1], "stops": v} for k, v in grouped.items()], chunk_stops
+            grouped, chunk_stops, size = {}, [], 0
+    if chunk_stops:
+        yield [{"line": k[0], "destination": k[1], "stops": v} for k, v in grouped.items()], chunk_stops
+
+
+def run_cycle(
+    stops,
+    transport: HttpTransport,
+    publisher: RabbitPublisher,
+    emt: Optional[EMTClient] = None,
+    drainer: Optional[OutboxDrainer] = None,
+    shard_id: Optional[str] = None,
+) -> bool:
+    """
+    Ejecuta un ciclo completo fetch → build → publish.
+    Devuelve True si el payload quedó confirmado por el broker.
+    Con `shard_id`, el mensaje lleva la cabecera `x-shard-id`.
 
-    # Obtener datos y manejarlos de forma segura
+    Si el broker confirma y hay `drainer`, a continuación se reenvía el
+    backlog del outbox durante como mucho `OUTBOX_DRAIN_BUDGET_S` segundos.
+    """
+    success = False
+    runner = _run_stream_cycle if _streaming_enabled() else _run_cycle
     try:
+        with metrics.stage("cycle"):
+            success = runner(stops, transport, publisher, emt, shard_id)
+    except Exception:
+        logger.exception("Error en el ciclo de ingesta")
+    if success:
+        _drain_outbox(drainer, time_budget=float(os.getenv("OUTBOX_DRAIN_BUDGET_S", 60)))
+    metrics.CYCLES.inc(outcome="ok" if success else "failed")
+    _export_metrics()
+    return success
 
-        paradas_objetivo = ["5907", "66", "65","5407"]
-        autobuses_queue = get_all_bus_data(paradas_objetivo)
-        
-        queue_builder = QueueBusBuilder()
+
+def _run_cycle(stops, transport, publisher, emt, shard_id=None) -> bool:
+    weather_dict, weather_for = get_cycle_weather(transport)
+
+    autobuses_queue, fetched_stops = get_all_bus_data(stops, transport=transport, emt=emt)
+    metrics.ARRIVALS.inc(len(autobuses_queue))
+
+    with metrics.stage("dto_build"):
+        # Construcción en bloque por columnas; los DTO se crean al iterar
+        queue_builder = ColumnarQueueBusBuilder()
         queue_builder.from_iterable(autobuses_queue)
         queue = queue_builder.build()
 
+    if vehicle_index is not None:
+        with metrics.stage("spatial_index"):
+            # Los vehículos de paradas que han fallado se conservan hasta la siguiente consulta
+            vehicle_index.update_from_columns(queue, stops=fetched_stops)
+
+    if trajectory_store is not None:
+        with metrics.stage("trajectory"):
+            now = time.time()
+            trajectory_store.update_from_columns(queue, now)
+            trajectory_store.evict_stale(now)
+
+    if PRINT_PAYLOAD:
         # Mostrar resultados
         for i, arrival in enumerate(queue, start=1):
             print(f"{i}: {arrival}")
@@ -160,26 +405,370 @@ def main():
         )
 
         print(mail_body)
-        payload = group_by_line(autobuses_queue,  weather_dict)
-        with RabbitPublisher() as pub:
-            success = pub.publish(payload)
-            if not success:
-                logger.error("Fallo al enviar payload a la cola")
-            else:
-                logger.info("Payload enviado correctamente a la cola")
 
-        # imprimir antes de enviar
+    headway_report = None
+    with metrics.stage("group"):
+        payload = group_by_line(autobuses_queue,  weather_dict, weather_for)
+        if headway_analyzer is not None:
+            with metrics.stage("headways"):
+                # Sólo las paradas consultadas: las que fallan no dan sus vehículos por pasados
+                headway_report = headway_analyzer.update(payload, time.time(), stops=fetched_stops)
+        headers = {SCHEMA_HEADER: PAYLOAD_SCHEMA}
+        if shard_id is not None:
+            headers[SHARD_HEADER] = shard_id
+        if PUBLISH_MODE == "delta":
+            payload = snapshot_differ.diff(payload)
+            headers.update({"x-message-type": payload["type"], "x-seq": payload["seq"]})
+        payload = encode_message(payload, PAYLOAD_SCHEMA)
+
+    success = publisher.publish(payload, headers=headers)
+    if not success:
+        logger.error("Fallo al enviar payload a la cola")
+        # Los consumidores han perdido este delta: el siguiente ciclo resincroniza
+        snapshot_differ.force_keyframe()
+    else:
+        logger.info("Payload enviado correctamente a la cola")
+        _publish_headways(publisher, headway_report, shard_id)
+
+    if PRINT_PAYLOAD:
         print("Payload a enviar:")
         print(json.dumps(payload, ensure_ascii=False, indent=2))
-    except Exception:
-        logger.exception("Error al obtener datos de AEMET")
+    return success
+
+
+def _publish_headways(publisher: RabbitPublisher, report: Optional[Dict[str, Any]], shard_id=None) -> None:
+    """Publica el informe de `headway_analyzer` como mensaje aparte si trae cambios."""
+    if report is None or not (report["stats"] or report["events"]):
         return
+    headers = {"x-message-type": HEADWAYS}
+    if shard_id is not None:
+        headers[SHARD_HEADER] = shard_id
+    publisher.publish(report, headers=headers)
+
+
+@functools.lru_cache(maxsize=None)
+def _streaming_enabled() -> bool:
+    if PIPELINE_MODE != "stream":
+        return False
+    if PUBLISH_MODE == "delta":
+        # El diff necesita el snapshot completo del ciclo
+        logger.warning("PIPELINE_MODE=stream no es compatible con PUBLISH_MODE=delta; se usa batch.")
+        return False
+    return True
+
+
+def _track_positions(
+    stop_batches: Iterable[Tuple[str, List[Dict[str, Any]]]],
+    now: float,
+    seen_vehicles: Set[Any],
+    fetched_stops: List[str],
+) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    """
+    Actualiza índice espacial y trayectorias parada a parada y deja pasar los
+    datos, anotando los vehículos vistos y las paradas consultadas con éxito.
+    """
+    for stop, buses in stop_batches:
+        fetched_stops.append(stop)
+        metrics.ARRIVALS.inc(len(buses))
+        if buses:
+            with metrics.stage("dto_build"):
+                queue = ColumnarQueueBusBuilder().from_iterable(buses).build()
+            if vehicle_index is not None:
+                with metrics.stage("spatial_index"):
+                    vehicle_index.update_from_columns(queue, evict_missing=False)
+            if trajectory_store is not None:
+                with metrics.stage("trajectory"):
+                    trajectory_store.update_from_columns(queue, now)
+            seen_vehicles.update(v for v in queue.vehicle_id if v is not None)
+        yield stop, buses
+
+
+def _run_stream_cycle(stops, transport, publisher, emt, shard_id=None) -> bool:
+    """
+    Ciclo en streaming: cada bloque de `STREAM_CHUNK_ARRIVALS` llegadas se
+    publica en cuanto está agrupado, mientras siguen las consultas a EMT.
+
+    Todos los mensajes del ciclo llevan `x-snapshot-id`, su número de bloque
+    en `x-chunk` y `x-last-chunk` a True en el último; para poder marcarlo se
+    retiene un bloque antes de publicarlo. Devuelve True si el broker
+    confirmó todos los bloques.
+    """
+    weather_dict, weather_for = get_cycle_weather(transport)
+    now = time.time()
+    base_headers = {SCHEMA_HEADER: PAYLOAD_SCHEMA, "x-snapshot-id": int(now * 1000)}
+    if shard_id is not None:
+        base_headers[SHARD_HEADER] = shard_id
+
+    seen_vehicles: Set[Any] = set()
+    fetched_stops: List[str] = []
+    batches = _track_positions(
+        iter_bus_data(stops, transport=transport, emt=emt), now, seen_vehicles, fetched_stops
+    )
+    success = True
+    chunk_no = 0
+    held = None
+
+    def send(groups, last: bool) -> bool:
+        with metrics.stage("group"):
+            payload = encode_message(groups, PAYLOAD_SCHEMA)
+        if PRINT_PAYLOAD:
+            print(json.dumps(payload, ensure_ascii=False, indent=2))
+        headers = {**base_headers, "x-chunk": chunk_no, "x-last-chunk": last}
+        return publisher.publish(payload, headers=headers)
+
+    for groups, chunk_stops in group_in_chunks(batches, weather_dict, weather_for=weather_for):
+        if headway_analyzer is not None:
+            with metrics.stage("headways"):
+                report = headway_analyzer.update(groups, now, stops=chunk_stops)
+        if held is not None:
+            success = send(held, last=False) and success
+            chunk_no += 1
+        held = groups
+        if headway_analyzer is not None:
+            _publish_headways(publisher, report, shard_id)
+    success = send(held or [], last=True) and success
+
+    if vehicle_index is not None:
+        vehicle_index.retain(seen_vehicles, stops=fetched_stops)
+    if trajectory_store is not None:
+        trajectory_store.evict_stale(now)
+
+    if success:
+        logger.info("Snapshot enviado correctamente a la cola en %d bloques", chunk_no + 1)
+    else:
+        logger.error("Fallo al enviar algún bloque del snapshot a la cola")
+    return success
+
+
+def _export_metrics() -> None:
+    path = os.getenv("METRICS_FILE")
+    if not path:
+        return
+    try:
+        metrics.write_textfile(path)
+    except OSError as e:
+        logger.warning(f"No se pudieron escribir las métricas en {path}: {e}")
+
+
+def main(stops: Optional[List[str]] = None, shard_id: Optional[str] = None):
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO")) # requiere AEMET_API_KEY en entorno
+
+    transport = build_transport()
+    outbox = build_outbox()
+    # La conexión con RabbitMQ se abre al publicar, tras obtener los datos
+    publisher = RabbitPublisher(outbox=outbox)
+    drainer = OutboxDrainer(outbox, publisher, logger=logger) if outbox else None
+    try:
+        run_cycle(stops or PARADAS_OBJETIVO, transport, publisher, drainer=drainer, shard_id=shard_id)
+    finally:
+        publisher.close()
+        transport.close()
+        if outbox:
+            outbox.close()
+
+
+def run_daemon(
+    interval: Optional[float] = None,
+    always_on: bool = False,
+    stops: Optional[List[str]] = None,
+    shard_id: Optional[str] = None,
+):
+    """
+    Ejecuta el ingestor como proceso de larga duración, manteniendo calientes
+    el transporte HTTP, el token de EMT y la conexión con RabbitMQ entre ciclos.
+    """
+    global trajectory_store
+    if interval is None:
+        interval = float(os.getenv("INGEST_INTERVAL_S", DEFAULT_INGEST_INTERVAL))
+    if os.getenv("TRAJECTORIES", "0") == "1":
+        trajectory_store = TrajectoryStore()
+
+    transport = build_transport()
+    emt = EMTClient(transport=transport)
+    outbox = build_outbox()
+    publisher = RabbitPublisher(outbox=outbox)
+    drainer = OutboxDrainer(outbox, publisher, logger=logger) if outbox else None
+
+    def idle():
+        publisher.process_events()
+        # Entre ciclos se drena el backlog por lotes, al ritmo de OUTBOX_DRAIN_RATE
+        _drain_outbox(drainer, max_messages=drainer.batch_size if drainer else None)
+
+    daemon = IngestDaemon(
+        lambda: run_cycle(stops or PARADAS_OBJETIVO, transport, publisher,
+                          emt=emt, drainer=drainer, shard_id=shard_id),
+        interval=interval,
+        windows=() if always_on else None,
+        idle=idle,
+        logger=logger,
+    )
+    daemon.install_signal_handlers()
+    metrics_port = os.getenv("METRICS_PORT")
+    if metrics_port:
+        metrics.start_http_server(int(metrics_port), routes=_vehicle_routes())
+        logger.info(f"Métricas disponibles en :{metrics_port}/metrics")
+    try:
+        daemon.run()
+    finally:
+        publisher.close()
+        transport.close()
+        if outbox:
+            outbox.close()
+
+
+def _vehicle_routes() -> Dict[str, Callable[[Dict[str, str]], Any]]:
+    """
+    Consultas HTTP al estado en memoria (modo daemon con `METRICS_PORT`),
+    sólo de las estructuras activadas:
+
+    - ``/vehicles/nearest?lat=..&lon=..[&k=5][&max_radius_m=..]``
+    - ``/vehicles/within?lat=..&lon=..&radius_m=..``
+    - ``/vehicles/bbox?min_lat=..&min_lon=..&max_lat=..&max_lon=..``
+    - ``/vehicles/kinematics[?vehicle_id=..]`` (velocidad, aceleración y rumbo)
+    """
+    def nearest(q):
+        radius = q.get("max_radius_m")
+        return vehicle_index.nearest(
+            float(q["lat"]), float(q["lon"]), k=int(q.get("k", 5)),
+            max_radius_m=float(radius) if radius is not None else None,
+        )
+
+    def within(q):
+        return vehicle_index.within_radius(float(q["lat"]), float(q["lon"]), float(q["radius_m"]))
 
+    def bbox(q):
+        return vehicle_index.within_bbox(
+            float(q["min_lat"]), float(q["min_lon"]), float(q["max_lat"]), float(q["max_lon"])
+        )
 
-def get_weather():
+    def kinematics(q):
+        result = {str(vid): entry for vid, entry in trajectory_store.kinematics().items()}
+        vehicle_id = q.get("vehicle_id")
+        return result if vehicle_id is None else result.get(vehicle_id)
+
+    def checked(fn):
+        # Parámetros ausentes o no numéricos: 400 en lugar de 500
+        @functools.wraps(fn)
+        def wrapper(q):
+            try:
+                return fn(q)
+            except KeyError as e:
+                raise ValueError(f"falta el parámetro {e}") from None
+        return wrapper
+
+    routes = {}
+    if vehicle_index is not None:
+        routes.update({
+            "/vehicles/nearest": checked(nearest),
+            "/vehicles/within": checked(within),
+            "/vehicles/bbox": checked(bbox),
+        })
+    if trajectory_store is not None:
+        routes["/vehicles/kinematics"] = kinematics
+    return routes
+
+
+def _shard_entry(shard_id: str, position: int, stops: List[str], daemon: bool,
+                 interval: Optional[float], always_on: bool) -> None:
+    """Punto de entrada de cada proceso hijo en `run_shards`."""
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    # Métricas separadas por shard para que los procesos no se pisen
+    metrics_file = os.getenv("METRICS_FILE")
+    if metrics_file:
+        root, ext = os.path.splitext(metrics_file)
+        os.environ["METRICS_FILE"] = f"{root}-shard{shard_id}{ext}"
+    metrics_port = os.getenv("METRICS_PORT")
+    if metrics_port:
+        os.environ["METRICS_PORT"] = str(int(metrics_port) + position)
+
+    logger.info(f"Shard {shard_id}: {len(stops)} paradas")
+    if daemon:
+        run_daemon(interval=interval, always_on=always_on, stops=stops, shard_id=shard_id)
+    else:
+        main(stops=stops, shard_id=shard_id)
+
+
+def run_shards(
+    assignment: Dict[str, List[str]],
+    daemon: bool = False,
+    interval: Optional[float] = None,
+    always_on: bool = False,
+) -> int:
+    """
+    Ejecuta cada shard de `assignment` en su propio proceso y espera a todos.
+
+    Cada proceso tiene su transporte, su conexión con RabbitMQ y su estado del
+    modo delta; el token de EMT se comparte vía `TokenStore`. Los límites de
+    `rate_limit` son por proceso. SIGTERM se reenvía a los hijos; SIGINT ya
+    les llega desde la terminal. Devuelve 0 si todos terminaron bien.
+    """
+    processes = []
+    for position, (shard_id, stops) in enumerate(sorted(assignment.items())):
+        if not stops:
+            logger.warning(f"Shard {shard_id} sin paradas asignadas: no se lanza.")
+            continue
+        proc = multiprocessing.Process(
+            target=_shard_entry,
+            args=(shard_id, position, stops, daemon, interval, always_on),
+            name=f"shard-{shard_id}",
+        )
+        proc.start()
+        processes.append(proc)
+
+    def _forward(signum, _frame):
+        for proc in processes:
+            if proc.is_alive():
+                proc.terminate()
+
+    signal.signal(signal.SIGTERM, _forward)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    failed = 0
+    for proc in processes:
+        proc.join()
+        if proc.exitcode != 0:
+            logger.error(f"El proceso {proc.name} terminó con código {proc.exitcode}")
+            failed += 1
+    return 1 if failed else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Ingestor de llegadas EMT + clima AEMET hacia RabbitMQ.")
+    parser.add_argument("--daemon", action="store_true",
+                        help="Proceso de larga duración con planificador interno en lugar de una sola ejecución.")
+    parser.add_argument("--interval", type=float, default=None,
+                        help="Segundos entre ciclos en modo daemon (por defecto INGEST_INTERVAL_S o 300).")
+    parser.add_argument("--always-on", action="store_true",
+                        help="En modo daemon, ignora las ventanas de servicio de EMT.")
+    parser.add_argument("--stops-file", default=None,
+                        help="Fichero de paradas (JSON o una por línea); por defecto STOPS_FILE.")
+    parser.add_argument("--shard-count", type=int, default=None,
+                        help="Número total de shards del despliegue (por defecto SHARD_COUNT o 1).")
+    parser.add_argument("--shards", default=None,
+                        help="Shards que ejecuta este worker, p. ej. '0,3' (por defecto SHARD_IDS o todos).")
+    return parser.parse_args(argv)
+
+
+def _weather_cache_for(transport: Optional[HttpTransport]) -> WeatherCache:
+    """La caché real, salvo en reproducción: lo grabado no debe llegar al disco real."""
+    cache_dir = getattr(transport, "cache_dir", None) if getattr(transport, "offline", False) else None
+    if cache_dir is None:
+        return weather_cache
+    cache = _replay_weather_caches.get(cache_dir)
+    if cache is None:
+        cache = _replay_weather_caches[cache_dir] = WeatherCache(
+            path=os.path.join(cache_dir, "aemet_weather.json")
+        )
+    return cache
+
+
+def get_weather(transport: Optional[HttpTransport] = None):
     try:
-        # Intentamos obtener los datos con tu lógica de reintentos
-        datos = retry_on_http_429(lambda: AEMETClient().get_aemet_datos_url())
+        # Reintentos con backoff + Retry-After, cubo de tokens y circuito de AEMET
+        with metrics.stage("aemet_fetch"):
+            client = AEMETClient(transport=transport, cache=_weather_cache_for(transport))
+            datos = get_guard("aemet").call(client.get_aemet_datos_url, max_attempts=5)
 
         # Si datos es válido, construimos el diccionario
         if datos and len(datos) > 0:
@@ -190,13 +779,76 @@ def get_weather():
     except Exception as e:
         # Logueamos el error para saber qué pasó, pero no cortamos la ejecución
         logger.error(f"Error al obtener clima, marcando como PENDING: {e}")
-        return {
-            "status": "PENDING",
-            "temp": None,
-            "precip": None,
-            "error_log": str(e)  # Opcional: para saber por qué falló luego
-        }
+        return _pending_weather(e)
+
+
+def _pending_weather(error: Exception) -> Dict[str, Any]:
+    return {
+        "status": "PENDING",
+        "temp": None,
+        "precip": None,
+        "error_log": str(error)  # Opcional: para saber por qué falló luego
+    }
+
+
+def get_station_weather(transport: Optional[HttpTransport] = None) -> Dict[str, Any]:
+    """
+    Refresca `station_weather` con la llamada masiva de AEMET (todas las
+    estaciones, con la misma caché que `get_weather`) y devuelve el clima de
+    la estación más cercana al centro como valor por defecto.
+    """
+    try:
+        with metrics.stage("aemet_fetch"):
+            client = AEMETClient(transport=transport, cache=_weather_cache_for(transport))
+            datos = get_guard("aemet").call(client.get_all_observations, max_attempts=5)
+        station_weather.update(datos or [])
+    except Exception as e:
+        # Se siguen sirviendo las últimas lecturas de cada estación
+        logger.error(f"Error al obtener clima de las estaciones: {e}")
+        error = e
+    else:
+        error = ValueError("Datos de AEMET vacíos")
+    default = station_weather.nearest_weather(*MADRID_CENTER)
+    if default is None:
+        logger.error(f"Sin estaciones de AEMET disponibles, marcando como PENDING: {error}")
+        return _pending_weather(error)
+    return default
+
+
+def get_cycle_weather(transport: Optional[HttpTransport] = None):
+    """
+    Clima del ciclo: ``(clima por defecto, weather_for)``. `weather_for` es
+    None con `WEATHER_MODE=station` (una lectura para toda la ciudad).
+    """
+    if station_weather is None:
+        return get_weather(transport), None
+    return get_station_weather(transport), station_weather.weather_for
 
 
 if __name__ == "__main__":
-    main()
+    args = parse_args()
+    stops = load_stops(args.stops_file, default=PARADAS_OBJETIVO)
+    shard_count = args.shard_count or int(os.getenv("SHARD_COUNT", 1))
+    local_shards = args.shards or os.getenv("SHARD_IDS")
+
+    if shard_count <= 1 and not local_shards:
+        if args.daemon:
+            run_daemon(interval=args.interval, always_on=args.always_on, stops=stops)
+        else:
+            main(stops=stops)
+    else:
+        assignment = assign_stops(stops, shard_count)
+        if local_shards:
+            wanted = [s.strip() for s in local_shards.split(",") if s.strip()]
+            unknown = [s for s in wanted if s not in assignment]
+            if unknown:
+                sys.exit(f"Shards desconocidos {unknown} (SHARD_COUNT={shard_count})")
+            assignment = {s: assignment[s] for s in wanted}
+        if len(assignment) == 1:
+            (shard_id, shard_stops), = assignment.items()
+            if args.daemon:
+                run_daemon(interval=args.interval, always_on=args.always_on, stops=shard_stops, shard_id=shard_id)
+            else:
+                main(stops=shard_stops, shard_id=shard_id)
+        else:
+            sys.exit(run_shards(assignment, daemon=args.daemon, interval=args.interval, always_on=args.always_on))
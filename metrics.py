@@ -0,0 +1,272 @@
+# python
+"""
+Métricas del ingestor en formato de texto de Prometheus.
+
+Este módulo define un registro mínimo (contadores e histogramas con etiquetas)
+sin dependencias externas, las métricas de cada etapa del pipeline y dos
+formas de exponerlas:
+
+- `write_textfile(path)`: escribe el fichero de forma atómica, apto para el
+  textfile collector de node_exporter (modo cron).
+- `start_http_server(port)`: sirve `/metrics` en un hilo (modo daemon), y
+  opcionalmente rutas JSON adicionales (p. ej. consultas de `main` al
+  índice espacial).
+
+Etapas medidas en `STAGE_SECONDS` (etiqueta `stage`): ``emt_login``,
+``emt_stop_fetch``, ``aemet_fetch``, ``dto_build``, ``spatial_index``,
+``trajectory``, ``group`` (incluye ``headways``), ``serialize``,
+``publish``, ``confirm``, ``cycle`` y, en `consumer`, ``mongo_write``.
+
+Variables de entorno utilizadas por `main` (opcional):
+- METRICS_FILE: ruta donde escribir las métricas tras cada ciclo.
+- METRICS_PORT: puerto HTTP donde servir `/metrics` en modo daemon.
+"""
+
+import json
+import math
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qsl
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DEFAULT_SIZE_BUCKETS = (1e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6, 1e7)
+
+LabelValues = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{_escape(extra[1])}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(v: float) -> str:
+    if math.isinf(v):
+        return "+Inf" if v > 0 else "-Inf"
+    return repr(float(v)) if not float(v).is_integer() else str(int(v))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: etiquetas esperadas {self.labelnames}, recibidas {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    """Contador monótono con etiquetas."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def render(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [
+            f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items
+        ]
+
+
+class Histogram(_Metric):
+    """Histograma acumulativo con buckets fijos y etiquetas."""
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._counts: Dict[LabelValues, List[int]] = {}
+        self._sums: Dict[LabelValues, float] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0] * len(self.buckets)
+                self._sums[key] = 0.0
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Mide la duración del bloque `with` en segundos."""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def count(self, **labels: str) -> int:
+        return sum(self._counts.get(self._key(labels), []))
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        with self._lock:
+            items = sorted((k, list(c), self._sums[k]) for k, c in self._counts.items())
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, c in zip(self.buckets, counts):
+                cumulative += c
+                le = "+Inf" if math.isinf(bound) else _format_value(bound)
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', le))} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for m in self._metrics:
+            lines.extend(m.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "ingest_stage_seconds", "Duración de cada etapa del pipeline en segundos.", ("stage",)
+))
+STAGE_ERRORS = REGISTRY.register(Counter(
+    "ingest_stage_errors_total", "Errores por etapa y tipo de excepción.", ("stage", "error")
+))
+HTTP_RESPONSES = REGISTRY.register(Counter(
+    "upstream_http_responses_total", "Respuestas HTTP de las APIs externas por host y código.", ("host", "status")
+))
+PAYLOAD_BYTES = REGISTRY.register(Histogram(
+    "ingest_payload_bytes", "Tamaño de los mensajes publicados en bytes.", (), DEFAULT_SIZE_BUCKETS
+))
+ARRIVALS = REGISTRY.register(Counter(
+    "ingest_arrivals_total", "Llegadas procesadas.", ()
+))
+MESSAGES = REGISTRY.register(Counter(
+    "ingest_messages_total", "Mensajes publicados por resultado.", ("outcome",)
+))
+CYCLES = REGISTRY.register(Counter(
+    "ingest_cycles_total", "Ciclos de ingesta por resultado.", ("outcome",)
+))
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """Mide una etapa y cuenta sus excepciones (que se relanzan)."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        STAGE_ERRORS.inc(stage=name, error=type(e).__name__)
+        raise
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - t0, stage=name)
+
+
+def write_textfile(path: str, registry: Registry = REGISTRY) -> None:
+    """Escribe las métricas en `path` de forma atómica."""
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".metrics.")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as fh:
+            fh.write(registry.render())
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except OSError:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def start_http_server(
+    port: int,
+    addr: str = "0.0.0.0",
+    registry: Registry = REGISTRY,
+    routes: Optional[Dict[str, Callable[[Dict[str, str]], Any]]] = None,
+) -> ThreadingHTTPServer:
+    """
+    Sirve `/metrics` en un hilo daemon y devuelve el servidor.
+
+    `routes` añade rutas JSON: cada función recibe los parámetros de la query
+    y devuelve un objeto serializable; un `ValueError` responde 400.
+    """
+    routes = dict(routes or {})
+
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path, _, query = self.path.partition("?")
+            if path == "/metrics":
+                self._reply(200, registry.render().encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8")
+                return
+            handler = routes.get(path)
+            if handler is None:
+                self.send_error(404)
+                return
+            try:
+                result = handler(dict(parse_qsl(query)))
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            body = json.dumps(result, ensure_ascii=False, default=str).encode("utf-8")
+            self._reply(200, body, "application/json; charset=utf-8")
+
+        def _reply(self, status: int, body: bytes, content_type: str) -> None:
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *_args):
+            pass
+
+    server = ThreadingHTTPServer((addr, port), _Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
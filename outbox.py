@@ -0,0 +1,509 @@
+# python
+"""
+Outbox local en disco para los mensajes que RabbitMQ no pudo confirmar.
+
+Este módulo proporciona:
+
+- `Outbox`: registro append-only en segmentos (``*.seg``) donde
+  `RabbitPublisher` guarda el cuerpo ya codificado y sus propiedades cuando
+  agota los reintentos. Los `fsync` se agrupan (cada `fsync_every` registros o
+  `fsync_interval` segundos) y los segmentos rotan al superar `segment_bytes`.
+- `OutboxDrainer`: reenvía el backlog en lotes cuando el broker vuelve, con
+  un ritmo máximo (`TokenBucket`) para no saturarlo durante la recuperación.
+
+Formato de cada registro: cabecera ``>III`` (longitud de metadatos, longitud
+del cuerpo, CRC32 de ambos) + metadatos JSON + cuerpo. Un registro truncado o
+con CRC incorrecto (caída a mitad de escritura) invalida el resto de su
+segmento. El progreso del drenado se guarda por segmento en ``cursor.json``;
+la entrega es at-least-once y cada mensaje reenviado lleva `x-outbox-id` para
+deduplicar.
+
+Cada escritor añade a su propio segmento ``<id>.open`` y lo sella como
+``<id>.seg`` al rotarlo o cerrarlo; sólo los sellados y consumidos se borran.
+Mientras escribe mantiene bloqueado ``.<id>.lock``: si el bloqueo está libre
+el escritor ha terminado sin cerrar y el drenador sella el segmento.
+
+Variables de entorno utilizadas (opcional):
+- OUTBOX_DIR: directorio de los segmentos.
+- OUTBOX_SEGMENT_BYTES / OUTBOX_MAX_BYTES: tamaño de rotación y tope total.
+- OUTBOX_FSYNC_EVERY / OUTBOX_FSYNC_INTERVAL_S: agrupación de fsync.
+- OUTBOX_DRAIN_RATE / OUTBOX_DRAIN_BATCH: mensajes/s y tamaño de lote al drenar.
+- OUTBOX_DRAIN_PIPELINE: "1" para drenar con confirms asíncronos (`publish_raw_many`).
+"""
+
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import ExitStack, contextmanager
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import metrics
+from rate_limit import TokenBucket
+from token_store import file_lock
+
+DEFAULT_OUTBOX_DIR = os.path.join(os.path.expanduser("~"), ".cache", "madrid-mobility", "outbox")
+DEFAULT_SEGMENT_BYTES = 4 * 1024 * 1024
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+
+_HEADER = struct.Struct(">III")
+_SEGMENT_SUFFIX = ".seg"
+_OPEN_SUFFIX = ".open"
+_CURSOR_FILE = "cursor.json"
+
+OUTBOX_RECORDS = metrics.REGISTRY.register(metrics.Counter(
+    "outbox_records_total", "Registros del outbox por evento.", ("event",)
+))
+
+
+@dataclass
+class OutboxRecord:
+    """Mensaje guardado en el outbox, listo para reenviar tal cual."""
+
+    segment: str
+    offset: int
+    end: int
+    body: bytes
+    content_type: Optional[str]
+    content_encoding: Optional[str]
+    headers: Optional[Dict[str, Any]]
+    enqueued_at: float
+
+    @property
+    def record_id(self) -> str:
+        return f"{self.segment}:{self.offset}"
+
+
+class Outbox:
+    """
+    Registro append-only en disco, seguro entre hilos y procesos.
+
+    Cada instancia escribe en su propio segmento abierto (``<id>.open``, con
+    un identificador ordenable por instante de creación y el pid), de modo
+    que varios procesos pueden compartir el directorio. Al rotar o cerrar, el
+    escritor lo sella renombrándolo a ``<id>.seg``. El drenador sólo borra
+    segmentos sellados y consumidos por completo; el progreso se guarda por
+    segmento, así que el orden de los nombres nunca decide qué se borra.
+    Los segmentos abiertos cuyo escritor ya no tiene su bloqueo (caída del
+    proceso) se sellan al leer.
+
+    Args:
+        directory (Optional[str]): Directorio de los segmentos; por defecto
+            `OUTBOX_DIR` o `~/.cache/madrid-mobility/outbox`.
+        segment_bytes (Optional[int]): Tamaño a partir del cual se rota.
+        max_bytes (Optional[int]): Tope del backlog; al superarlo se descartan
+            los segmentos sellados más antiguos.
+        fsync_every (Optional[int]): Registros entre `fsync`.
+        fsync_interval (Optional[float]): Segundos máximos sin `fsync`.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        segment_bytes: Optional[int] = None,
+        max_bytes: Optional[int] = None,
+        fsync_every: Optional[int] = None,
+        fsync_interval: Optional[float] = None,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.directory = directory or os.getenv("OUTBOX_DIR", DEFAULT_OUTBOX_DIR)
+        self.segment_bytes = segment_bytes or int(os.getenv("OUTBOX_SEGMENT_BYTES", DEFAULT_SEGMENT_BYTES))
+        self.max_bytes = max_bytes or int(os.getenv("OUTBOX_MAX_BYTES", DEFAULT_MAX_BYTES))
+        self.fsync_every = fsync_every or int(os.getenv("OUTBOX_FSYNC_EVERY", 16))
+        self.fsync_interval = fsync_interval if fsync_interval is not None else float(
+            os.getenv("OUTBOX_FSYNC_INTERVAL_S", 1.0)
+        )
+        self.logger = logger or logging.getLogger(__name__)
+        self._lock_path = os.path.join(self.directory, ".lock")
+        self._drain_lock_path = os.path.join(self.directory, ".drain.lock")
+        self._thread_lock = threading.RLock()
+        self._fh = None
+        self._segment: Optional[str] = None
+        self._owner: Optional[ExitStack] = None
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        """Bloqueo exclusivo entre hilos y procesos sobre el directorio (operaciones cortas)."""
+        with self._thread_lock, file_lock(self._lock_path):
+            yield
+
+    def drain_lock(self):
+        """
+        Bloqueo no bloqueante del drenado: produce False si otro proceso ya
+        está drenando. No impide escribir mientras se publica.
+        """
+        return file_lock(self._drain_lock_path, blocking=False)
+
+    # --- escritura ---
+
+    def append(
+        self,
+        body: bytes,
+        content_type: Optional[str] = None,
+        content_encoding: Optional[str] = None,
+        headers: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Añade un mensaje al final del segmento activo."""
+        meta = json.dumps(
+            {"ts": time.time(), "content_type": content_type,
+             "content_encoding": content_encoding, "headers": headers},
+            separators=(",", ":"), default=str,
+        ).encode("utf-8")
+        record = _HEADER.pack(len(meta), len(body), zlib.crc32(meta + body)) + meta + body
+
+        with self.lock():
+            fh = self._active_segment()
+            fh.write(record)
+            fh.flush()
+            self._unsynced += 1
+            OUTBOX_RECORDS.inc(event="appended")
+            if (self._unsynced >= self.fsync_every
+                    or time.monotonic() - self._last_sync >= self.fsync_interval):
+                self._sync()
+            if fh.tell() >= self.segment_bytes:
+                self._close_segment()
+            self._enforce_max_bytes()
+
+    def flush(self) -> None:
+        """Fuerza el `fsync` de lo escrito hasta ahora."""
+        with self.lock():
+            self._sync()
+
+    def _path(self, segment: str, sealed: bool) -> str:
+        return os.path.join(self.directory, segment + (_SEGMENT_SUFFIX if sealed else _OPEN_SUFFIX))
+
+    def _owner_path(self, segment: str) -> str:
+        return os.path.join(self.directory, f".{segment}.lock")
+
+    def _active_segment(self):
+        if self._fh is None:
+            segment = f"{time.time_ns():020d}-{os.getpid()}"
+            # El bloqueo del propietario se toma antes de que exista el segmento
+            owner = ExitStack()
+            owner.enter_context(file_lock(self._owner_path(segment)))
+            self._fh = open(self._path(segment, sealed=False), "ab")
+            self._segment, self._owner = segment, owner
+            self._fsync_directory()
+        return self._fh
+
+    def _sync(self) -> None:
+        if self._fh is not None and self._unsynced:
+            os.fsync(self._fh.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def _close_segment(self) -> None:
+        """Cierra el segmento activo y lo sella (``.open`` → ``.seg``)."""
+        if self._fh is None:
+            return
+        segment = self._segment
+        try:
+            self._sync()
+            self._fh.close()
+            sealed = self._path(segment, sealed=True)
+            os.replace(self._path(segment, sealed=False), sealed)
+            if self._load_cursor().get(segment, 0) >= os.path.getsize(sealed):
+                # Ya drenado por completo mientras estaba abierto
+                self._remove_segment(segment)
+            self._fsync_directory()
+        except OSError as e:
+            self.logger.warning(f"Error cerrando segmento del outbox {segment}: {e}")
+        self._owner.close()
+        _unlink(self._owner_path(segment))
+        self._fh = None
+        self._segment = None
+        self._owner = None
+
+    def _seal_orphans(self) -> None:
+        """Sella los segmentos abiertos cuyo escritor ya no mantiene su bloqueo."""
+        for segment, _size, sealed in self.segments():
+            if sealed or segment == self._segment:
+                continue
+            with file_lock(self._owner_path(segment), blocking=False) as acquired:
+                if not acquired:
+                    continue
+                self.logger.warning(f"Segmento del outbox {segment} sin escritor: se sella")
+                try:
+                    os.replace(self._path(segment, sealed=False), self._path(segment, sealed=True))
+                except FileNotFoundError:
+                    pass
+            _unlink(self._owner_path(segment))
+
+    def _fsync_directory(self) -> None:
+        if os.name == "nt":
+            return
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def _enforce_max_bytes(self) -> None:
+        segments = self.segments()
+        total = sum(size for _segment, size, _sealed in segments)
+        for segment, size, sealed in segments:
+            if total <= self.max_bytes:
+                break
+            if not sealed:
+                # Nunca se borra un segmento con escritor activo
+                continue
+            self.logger.error(f"Outbox lleno ({total} bytes): se descarta el segmento {segment}")
+            OUTBOX_RECORDS.inc(event="dropped_segment")
+            self._remove_segment(segment)
+            total -= size
+
+    # --- lectura ---
+
+    def segments(self) -> List[Tuple[str, int, bool]]:
+        """Segmentos existentes `(id, bytes, sellado)` del más antiguo al más nuevo."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        result = []
+        for name in names:
+            stem, suffix = os.path.splitext(name)
+            if suffix not in (_SEGMENT_SUFFIX, _OPEN_SUFFIX):
+                continue
+            try:
+                result.append((stem, os.path.getsize(os.path.join(self.directory, name)), suffix == _SEGMENT_SUFFIX))
+            except FileNotFoundError:
+                continue
+        result.sort()
+        return result
+
+    def pending(self) -> bool:
+        """True si queda algún registro sin drenar (comprobación barata)."""
+        offsets = self._load_cursor()
+        return any(size > offsets.get(segment, 0) for segment, size, _sealed in self.segments())
+
+    def read_batch(self, limit: int) -> List[OutboxRecord]:
+        """Lee hasta `limit` registros pendientes de todos los segmentos (llamar con `lock()`)."""
+        self._seal_orphans()
+        offsets = self._load_cursor()
+        records: List[OutboxRecord] = []
+        for segment, size, sealed in self.segments():
+            offset = offsets.get(segment, 0)
+            if offset >= size:
+                continue
+            records.extend(self._read_segment(segment, sealed, offset, limit - len(records)))
+            if len(records) >= limit:
+                break
+        return records
+
+    def _read_segment(self, segment: str, sealed: bool, offset: int, limit: int) -> List[OutboxRecord]:
+        records = []
+        path = self._path(segment, sealed)
+        try:
+            with open(path, "rb") as fh:
+                fh.seek(offset)
+                while len(records) < limit:
+                    start = fh.tell()
+                    header = fh.read(_HEADER.size)
+                    if not header:
+                        break
+                    record = None
+                    if len(header) == _HEADER.size:
+                        meta_len, body_len, crc = _HEADER.unpack(header)
+                        data = fh.read(meta_len + body_len)
+                        if len(data) == meta_len + body_len and zlib.crc32(data) == crc:
+                            record = self._decode(segment, start, fh.tell(), data[:meta_len], data[meta_len:])
+                    if record is None:
+                        # Escritura interrumpida: el resto del segmento no es recuperable
+                        if sealed:
+                            self.logger.error(f"Registro corrupto en {segment}@{start}: se descarta el resto del segmento")
+                            OUTBOX_RECORDS.inc(event="corrupt")
+                            os.truncate(path, start)
+                        break
+                    records.append(record)
+        except FileNotFoundError:
+            pass
+        return records
+
+    @staticmethod
+    def _decode(segment: str, start: int, end: int, meta_raw: bytes, body: bytes) -> Optional[OutboxRecord]:
+        try:
+            meta = json.loads(meta_raw.decode("utf-8"))
+        except ValueError:
+            return None
+        return OutboxRecord(
+            segment=segment, offset=start, end=end, body=body,
+            content_type=meta.get("content_type"),
+            content_encoding=meta.get("content_encoding"),
+            headers=meta.get("headers"),
+            enqueued_at=meta.get("ts", 0.0),
+        )
+
+    def commit(self, records: Iterable[OutboxRecord]) -> None:
+        """
+        Marca como entregados `records` (y lo anterior de sus segmentos) y borra
+        los segmentos sellados ya consumidos (llamar con `lock()`). Si el
+        segmento activo de esta instancia queda consumido, se sella y se borra.
+        """
+        offsets = self._load_cursor()
+        for record in records:
+            offsets[record.segment] = max(offsets.get(record.segment, 0), record.end)
+        existing = set()
+        for segment, size, sealed in self.segments():
+            existing.add(segment)
+            if offsets.get(segment, 0) < size:
+                continue
+            if segment == self._segment:
+                self._close_segment()
+                sealed = True
+            if sealed:
+                self._remove_segment(segment)
+                existing.discard(segment)
+        self._save_cursor({s: o for s, o in offsets.items() if s in existing})
+
+    def _remove_segment(self, segment: str) -> None:
+        _unlink(self._path(segment, sealed=True))
+
+    def _load_cursor(self) -> Dict[str, int]:
+        try:
+            with open(os.path.join(self.directory, _CURSOR_FILE), "r", encoding="utf-8") as fh:
+                data = json.load(fh)
+            if "segment" in data:
+                # Formato antiguo (un único cursor global)
+                return {os.path.splitext(data["segment"])[0]: int(data.get("offset", 0))}
+            return {str(k): int(v) for k, v in data.get("offsets", {}).items()}
+        except (OSError, ValueError, TypeError, AttributeError):
+            return {}
+
+    def _save_cursor(self, offsets: Dict[str, int]) -> None:
+        fd, tmp = tempfile.mkstemp(dir=self.directory, prefix=".cursor.")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                json.dump({"offsets": offsets}, fh)
+                fh.flush()
+                os.fsync(fh.fileno())
+            os.replace(tmp, os.path.join(self.directory, _CURSOR_FILE))
+        except OSError:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def close(self) -> None:
+        """Hace `fsync`, cierra y sella el segmento activo."""
+        with self.lock():
+            self._close_segment()
+
+
+def _unlink(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+class OutboxDrainer:
+    """
+    Reenvía el backlog del outbox a RabbitMQ en lotes y con ritmo limitado.
+
+    Args:
+        outbox (Outbox): Outbox a drenar.
+        publisher: Objeto con `publish_raw(body, ..., retries)` (normalmente
+            `RabbitPublisher`); se reutiliza su conexión de `publish`.
+        pipeline (Optional[bool]): Publica cada lote con `publish_raw_many`
+            (confirms asíncronos, abre una segunda conexión al broker); por
+            defecto `OUTBOX_DRAIN_PIPELINE=1`.
+        rate (Optional[float]): Mensajes por segundo como máximo.
+        batch_size (Optional[int]): Registros leídos y confirmados por lote.
+        retry_interval (float): Segundos sin reintentar tras un fallo del broker.
+    """
+
+    def __init__(
+        self,
+        outbox: Outbox,
+        publisher: Any,
+        pipeline: Optional[bool] = None,
+        rate: Optional[float] = None,
+        batch_size: Optional[int] = None,
+        retry_interval: float = 30.0,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.outbox = outbox
+        self.publisher = publisher
+        self.pipeline = pipeline if pipeline is not None else os.getenv("OUTBOX_DRAIN_PIPELINE", "0") == "1"
+        self.batch_size = batch_size or int(os.getenv("OUTBOX_DRAIN_BATCH", 50))
+        rate = rate or float(os.getenv("OUTBOX_DRAIN_RATE", 20))
+        self.bucket = TokenBucket(rate, self.batch_size)
+        self.retry_interval = retry_interval
+        self.logger = logger or logging.getLogger(__name__)
+        self._blocked_until = 0.0
+
+    def drain(self, max_messages: Optional[int] = None, time_budget: Optional[float] = None) -> int:
+        """
+        Reenvía mensajes hasta vaciar el outbox, alcanzar `max_messages`,
+        agotar `time_budget` segundos o fallar el broker. Devuelve los enviados.
+        """
+        if time.monotonic() < self._blocked_until or not self.outbox.pending():
+            return 0
+        deadline = None if time_budget is None else time.monotonic() + time_budget
+        sent = 0
+        # Un solo drenador a la vez; el bloqueo del directorio sólo se toma
+        # para leer y confirmar, nunca mientras se publica o se espera al cubo
+        with self.outbox.drain_lock() as acquired:
+            if not acquired:
+                return 0
+            while max_messages is None or sent < max_messages:
+                limit = self.batch_size if max_messages is None else min(self.batch_size, max_messages - sent)
+                with self.outbox.lock():
+                    batch = self.outbox.read_batch(limit)
+                if not batch:
+                    break
+                to_send: List[OutboxRecord] = []
+                for record in batch:
+                    if deadline is not None and time.monotonic() >= deadline:
+                        break
+                    self.bucket.acquire()
+                    to_send.append(record)
+                confirmed: List[OutboxRecord] = []
+                for record, ok in zip(to_send, self._publish(to_send)):
+                    if not ok:
+                        # Sólo se confirma el prefijo entregado: el cursor no admite huecos
+                        self._blocked_until = time.monotonic() + self.retry_interval
+                        break
+                    confirmed.append(record)
+                    sent += 1
+                    OUTBOX_RECORDS.inc(event="drained")
+                if confirmed:
+                    with self.outbox.lock():
+                        self.outbox.commit(confirmed)
+                if len(confirmed) < len(batch):
+                    break
+        if sent:
+            self.logger.info(f"Outbox: {sent} mensajes reenviados a RabbitMQ")
+        return sent
+
+    def _publish(self, records: List[OutboxRecord]) -> Iterator[bool]:
+        """Publica `records` en orden y produce si cada uno quedó confirmado."""
+        if not records:
+            return
+        if self.pipeline:
+            # El lote viaja en pipeline y los confirms llegan de forma asíncrona
+            outcomes = self.publisher.publish_raw_many([self._message(r) for r in records], retries=1)
+            for outcome in outcomes:
+                yield outcome.confirmed
+            return
+        for record in records:
+            yield self.publisher.publish_raw(**self._message(record), retries=1)
+
+    @staticmethod
+    def _message(record: OutboxRecord) -> Dict[str, Any]:
+        headers = dict(record.headers or {})
+        headers.update({"x-outbox-id": record.record_id, "x-enqueued-at": record.enqueued_at})
+        return {
+            "body": record.body,
+            "content_type": record.content_type,
+            "content_encoding": record.content_encoding,
+            "headers": headers,
+            "timestamp": int(record.enqueued_at),
+        }
@@ -0,0 +1,166 @@
+# python
+"""
+Esquemas de payload publicados en la cola.
+
+- v1 (por defecto): salida de `main.group_by_line`, una lista de grupos
+  ``{"line", "destination", "stops": [entrada, ...]}`` en la que cada entrada
+  repite `line`, `destination` y el dict `weather` completo.
+- v2: versión normalizada. El contexto del ciclo (clima) va una sola vez
+  arriba, los textos repetidos (líneas, destinos, paradas) se guardan en una
+  tabla `strings` y cada llegada es una fila compacta::
+
+    {
+        "schema": 2,
+        "strings": ["27", "PLAZA CASTILLA", "66", ...],
+        "weathers": [{...}],
+        "fields": ["stop", "estimateArrive", "vehicle_id", "lat", "lon", "weather", "stop_name"],
+        "groups": [{"line": 0, "destination": 1, "rows": [[2, 300, 4321, 40.4, -3.7, 0, 3], ...]}]
+    }
+
+  `stop`, `stop_name` y los textos de grupo son índices de `strings`;
+  `weather` es índice de `weathers` (o None). Los decodificadores localizan
+  cada columna por `fields`, así que añadir columnas al final no rompe a los
+  consumidores existentes.
+
+La versión se anuncia con la cabecera AMQP `x-schema-version`; los
+consumidores pueden usar `decode_to_v1` para seguir leyendo v1. En modo delta
+(ver `snapshot_diff`) el esquema se aplica al campo `groups` del mensaje.
+"""
+
+from typing import Any, Dict, List, Mapping, Optional
+
+SCHEMA_HEADER = "x-schema-version"
+SCHEMA_V1 = 1
+SCHEMA_V2 = 2
+
+V2_FIELDS = ["stop", "estimateArrive", "vehicle_id", "lat", "lon", "weather", "stop_name"]
+
+
+class _StringTable:
+    def __init__(self):
+        self.values: List[Any] = []
+        self._index: Dict[Any, int] = {}
+
+    def ref(self, value: Any) -> Optional[int]:
+        if value is None:
+            return None
+        idx = self._index.get(value)
+        if idx is None:
+            idx = self._index[value] = len(self.values)
+            self.values.append(value)
+        return idx
+
+
+def encode_v2(groups: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Convierte una lista de grupos v1 al documento v2."""
+    strings = _StringTable()
+    weathers: List[Any] = []
+    # Los dicts de clima de un ciclo son el mismo objeto: deduplicamos por identidad
+    # y, si no, por igualdad, para no repetir bloques idénticos
+    weather_ids: Dict[int, int] = {}
+
+    def weather_ref(w: Any) -> Optional[int]:
+        if w is None:
+            return None
+        idx = weather_ids.get(id(w))
+        if idx is None:
+            try:
+                idx = weathers.index(w)
+            except ValueError:
+                idx = len(weathers)
+                weathers.append(w)
+            weather_ids[id(w)] = idx
+        return idx
+
+    out_groups = []
+    for group in groups:
+        rows = []
+        for entry in group.get("stops", []):
+            coords = entry.get("coords") or {}
+            rows.append([
+                strings.ref(entry.get("stop")),
+                entry.get("estimateArrive"),
+                entry.get("vehicle_id"),
+                coords.get("lat"),
+                coords.get("lon"),
+                weather_ref(entry.get("weather")),
+                strings.ref(entry.get("stop_name")),
+            ])
+        out_groups.append({
+            "line": strings.ref(group.get("line")),
+            "destination": strings.ref(group.get("destination")),
+            "rows": rows,
+        })
+
+    return {
+        "schema": SCHEMA_V2,
+        "strings": strings.values,
+        "weathers": weathers,
+        "fields": list(V2_FIELDS),
+        "groups": out_groups,
+    }
+
+
+def decode_v2(doc: Mapping[str, Any]) -> List[Dict[str, Any]]:
+    """Expande un documento v2 a la lista de grupos v1."""
+    if doc.get("schema") != SCHEMA_V2:
+        raise ValueError(f"Documento no es schema v2: {doc.get('schema')!r}")
+    strings = doc.get("strings", [])
+    weathers = doc.get("weathers", [])
+    pos = {name: i for i, name in enumerate(doc.get("fields", V2_FIELDS))}
+    # Documentos anteriores a la columna `stop_name`
+    stop_name_pos = pos.get("stop_name")
+
+    def s(idx: Optional[int]) -> Any:
+        return strings[idx] if idx is not None else None
+
+    groups = []
+    for group in doc.get("groups", []):
+        line = s(group.get("line"))
+        destination = s(group.get("destination"))
+        entries = []
+        for row in group.get("rows", []):
+            w = row[pos["weather"]]
+            entries.append({
+                "line": line,
+                "destination": destination,
+                "stop": s(row[pos["stop"]]),
+                "stop_name": s(row[stop_name_pos]) if stop_name_pos is not None else None,
+                "estimateArrive": row[pos["estimateArrive"]],
+                "vehicle_id": row[pos["vehicle_id"]],
+                "coords": {"lat": row[pos["lat"]], "lon": row[pos["lon"]]},
+                "weather": weathers[w] if w is not None else None,
+            })
+        groups.append({"line": line, "destination": destination, "stops": entries})
+    return groups
+
+
+def encode_message(payload: Any, version: int = SCHEMA_V1) -> Any:
+    """
+    Aplica el esquema `version` a un payload v1: la lista de `group_by_line`
+    o un mensaje de `SnapshotDiffer` (dict con `groups`).
+    """
+    if version == SCHEMA_V1:
+        return payload
+    if version != SCHEMA_V2:
+        raise ValueError(f"Versión de esquema no soportada: {version}")
+    if isinstance(payload, list):
+        return encode_v2(payload)
+    if isinstance(payload, dict) and "groups" in payload:
+        return {**payload, "groups": encode_v2(payload["groups"])}
+    raise ValueError("Payload no reconocido para schema v2")
+
+
+def decode_to_v1(payload: Any, headers: Optional[Mapping[str, Any]] = None) -> Any:
+    """
+    Devuelve el payload en formato v1. Los documentos v2 se reconocen por su
+    campo `schema`; la cabecera `x-schema-version` sólo se valida.
+    """
+    version = int((headers or {}).get(SCHEMA_HEADER) or SCHEMA_V1)
+    if version not in (SCHEMA_V1, SCHEMA_V2):
+        raise ValueError(f"Versión de esquema no soportada: {version}")
+    if isinstance(payload, dict) and payload.get("schema") == SCHEMA_V2:
+        return decode_v2(payload)
+    if isinstance(payload, dict) and isinstance(payload.get("groups"), dict):
+        return {**payload, "groups": decode_v2(payload["groups"])}
+    return payload
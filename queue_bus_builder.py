@@ -1,4 +1,7 @@
 # python
+import math
+from array import array
+from collections.abc import Sequence
 from datetime import datetime
 from typing import Any, Dict, Iterable, List, Optional, Union
 from zoneinfo import ZoneInfo
@@ -160,4 +163,197 @@ class QueueBusBuilder:
         return self
 
     def build(self) -> List[BusArrivalDTO]:
-        return list(self._items)
\ No newline at end of file
+        return list(self._items)
+
+
+def _memo_tz(values: List[Any]) -> List[Optional[datetime]]:
+    """Parsea y normaliza a Europe/Madrid una columna de fechas, una vez por valor distinto."""
+    memo: Dict[Any, Optional[datetime]] = {}
+    out: List[Optional[datetime]] = []
+    for v in values:
+        if v is None:
+            out.append(None)
+            continue
+        key = v if isinstance(v, (str, datetime)) else repr(v)
+        if key not in memo:
+            dt = _parse_iso_datetime(v)
+            memo[key] = _ensure_spain_tz(dt) if dt is not None else None
+        out.append(memo[key])
+    return out
+
+
+def _intern_column(values: List[Any]) -> List[Any]:
+    """Comparte una única instancia por valor repetido (líneas, destinos, paradas...)."""
+    pool: Dict[Any, Any] = {}
+    return [pool.setdefault(v, v) if isinstance(v, str) else v for v in values]
+
+
+class ColumnarArrivals(Sequence):
+    """
+    Llegadas almacenadas por columnas (struct-of-arrays).
+
+    Los numéricos viven en `array('d')` (NaN = ausente) y el resto en listas
+    paralelas. Los `BusArrivalDTO` se materializan sólo al indexar o iterar,
+    de modo que quien sólo necesita columnas (agrupar, serializar, índices)
+    no paga la construcción de un objeto por llegada.
+    """
+
+    def __init__(
+        self,
+        line: List[str],
+        stop: List[str],
+        eta: List[Optional[datetime]],
+        vehicle_id: List[Optional[str]],
+        destination: List[Optional[str]],
+        lat: array,
+        lon: array,
+        weather: List[Optional[Dict[str, Any]]],
+        distance: array,
+        estimate_arrive: array,
+        extra: List[Dict[str, Any]],
+        sent_at: List[datetime],
+    ):
+        self.line = line
+        self.stop = stop
+        self.eta = eta
+        self.vehicle_id = vehicle_id
+        self.destination = destination
+        self.lat = lat
+        self.lon = lon
+        self.weather = weather
+        self.distance = distance
+        self.estimate_arrive = estimate_arrive
+        self.extra = extra
+        self.sent_at = sent_at
+
+    def __len__(self) -> int:
+        return len(self.line)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._materialize(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("índice fuera de rango")
+        return self._materialize(index)
+
+    def _materialize(self, i: int) -> BusArrivalDTO:
+        lat = self.lat[i]
+        coords = None if math.isnan(lat) else {"lat": lat, "lon": self.lon[i]}
+        distance = self.distance[i]
+        estimate_arrive = self.estimate_arrive[i]
+        return BusArrivalDTO(
+            line=self.line[i],
+            stop=self.stop[i],
+            eta=self.eta[i],
+            vehicle_id=self.vehicle_id[i],
+            destination=self.destination[i],
+            coords=coords,
+            weather=self.weather[i],
+            distance=None if math.isnan(distance) else int(distance),
+            estimate_arrive=None if math.isnan(estimate_arrive) else int(estimate_arrive),
+            extra=self.extra[i],
+            sent_at=self.sent_at[i],
+        )
+
+    def to_list(self) -> List[BusArrivalDTO]:
+        return [self._materialize(i) for i in range(len(self))]
+
+
+class ColumnarQueueBusBuilder:
+    """
+    Variante en bloque de QueueBusBuilder para miles de llegadas.
+
+    - from_iterable(items): vuelca los dicts `Arrive` de EMT en columnas en una
+      sola pasada, sin crear un BusArrivalDTOBuilder por elemento.
+    - build(): valida y normaliza columnas completas (obligatorios, rango de
+      coordenadas, zonas horarias) y devuelve un `ColumnarArrivals`.
+
+    Aplica las mismas reglas que los handlers `_set_*` de QueueBusBuilder.
+    """
+
+    def __init__(self):
+        self._line: List[Any] = []
+        self._stop: List[Any] = []
+        self._eta: List[Any] = []
+        self._vehicle_id: List[Any] = []
+        self._destination: List[Any] = []
+        self._coords: List[Any] = []
+        self._weather: List[Any] = []
+        self._distance: List[Any] = []
+        self._estimate_arrive: List[Any] = []
+        self._extra: List[Any] = []
+        self._sent_at: List[Any] = []
+
+    def add(self, item: Dict[str, Any]) -> "ColumnarQueueBusBuilder":
+        if not isinstance(item, dict):
+            raise ValueError("item debe ser dict compatible")
+        geometry = item.get("geometry")
+        self._line.append(item.get("line"))
+        self._stop.append(item.get("stop"))
+        self._eta.append(item.get("eta"))
+        self._vehicle_id.append(item.get("bus"))
+        self._destination.append(item.get("destination"))
+        self._coords.append(geometry.get("coordinates") if geometry else None)
+        self._weather.append(item.get("weather"))
+        self._distance.append(item.get("DistanceBus") or None)
+        self._estimate_arrive.append(item.get("estimateArrive") or None)
+        self._extra.append(item.get("extra"))
+        self._sent_at.append(item.get("sent_at"))
+        return self
+
+    def from_iterable(self, items: Iterable[Dict[str, Any]]) -> "ColumnarQueueBusBuilder":
+        for it in items:
+            self.add(it)
+        return self
+
+    def _coords_columns(self) -> "tuple[array, array]":
+        n = len(self._coords)
+        lat = array("d", [math.nan]) * n
+        lon = array("d", [math.nan]) * n
+        for i, c in enumerate(self._coords):
+            if c is None:
+                continue
+            if not isinstance(c, Sequence) or isinstance(c, (str, bytes)) or len(c) < 2:
+                raise ValueError(f"[{i}] coords debe ser dict con 'lat'/'lon' o secuencia [lon, lat]")
+            try:
+                # Convención GeoJSON [lon, lat]
+                lon[i] = float(c[0])
+                lat[i] = float(c[1])
+            except Exception:
+                raise ValueError(f"[{i}] coords debe ser secuencia numérica de dos elementos")
+        # Validación de rango sobre la columna completa
+        for i in range(n):
+            if not math.isnan(lat[i]) and not (-90.0 <= lat[i] <= 90.0 and -180.0 <= lon[i] <= 180.0):
+                raise ValueError(f"[{i}] valores de lat/lon fuera de rango esperado")
+        return lat, lon
+
+    @staticmethod
+    def _int_column(values: List[Any]) -> array:
+        return array("d", (math.nan if v is None else float(int(v)) for v in values))
+
+    def build(self) -> ColumnarArrivals:
+        missing = [i for i, (line, stop) in enumerate(zip(self._line, self._stop)) if not line or not stop]
+        if missing:
+            raise ValueError(f"Campos obligatorios: line y stop (filas {missing[:10]})")
+
+        lat, lon = self._coords_columns()
+        # Un único "ahora" para todo el lote en lugar de uno por llegada
+        now = datetime.now(SPAIN)
+        sent_at = [dt or now for dt in _memo_tz(self._sent_at)]
+
+        return ColumnarArrivals(
+            line=_intern_column(self._line),
+            stop=_intern_column(self._stop),
+            eta=_memo_tz(self._eta),
+            vehicle_id=list(self._vehicle_id),
+            destination=_intern_column(self._destination),
+            lat=lat,
+            lon=lon,
+            weather=list(self._weather),
+            distance=self._int_column(self._distance),
+            estimate_arrive=self._int_column(self._estimate_arrive),
+            extra=[e if e is not None else {} for e in self._extra],
+            sent_at=sent_at,
+        )
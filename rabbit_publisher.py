@@ -1,12 +1,243 @@
-import json
 import logging
 import os
 import time
-from typing import Any, Optional
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
 import pika
 # Importamos excepciones específicas de Pika para manejarlas mejor
 from pika.exceptions import AMQPConnectionError, AMQPChannelError
 
+import metrics
+from wire_codec import get_codec
+
+# Cola donde publica el ingestor y de la que leen los consumidores
+DEFAULT_QUEUE = "micola_queue"
+
+
+def rabbit_url() -> str:
+    """URL AMQP a partir de `RABBITMQ_USER`, `RABBITMQ_PASS` y `RABBITMQ_HOST`."""
+    env_user = os.getenv("RABBITMQ_USER")
+    env_pass = os.getenv("RABBITMQ_PASS")
+    env_host = os.getenv("RABBITMQ_HOST")
+    return f"amqps://{env_user}:{env_pass}@{env_host}"
+
+
+@dataclass
+class PublishOutcome:
+    """Resultado de un mensaje dentro de `RabbitPublisher.publish_many`."""
+
+    index: int
+    confirmed: bool = False
+    attempts: int = 0
+    error: Optional[str] = None
+
+
+def _with_message_id(props: pika.BasicProperties, message_id: str) -> pika.BasicProperties:
+    return pika.BasicProperties(
+        content_type=props.content_type,
+        content_encoding=props.content_encoding,
+        delivery_mode=props.delivery_mode,
+        headers=props.headers,
+        timestamp=props.timestamp,
+        message_id=message_id,
+    )
+
+
+class _AsyncConfirmChannel:
+    """
+    Canal con confirms asíncronos sobre una `SelectConnection` reutilizable.
+
+    `publish_batch` envía el lote seguido y mueve el ioloop hasta resolver
+    todos sus confirms o agotar `timeout`; la conexión queda abierta para el
+    siguiente lote y sólo se rehace si se ha cerrado. Los delivery tags
+    pendientes se guardan en orden (`OrderedDict`), de modo que un Ack/Nack
+    con `multiple=True` sólo recorre los tags que confirma. Los mensajes
+    devueltos por `mandatory` (Basic.Return) se identifican por su tag (en
+    `message_id`) y cuentan como fallidos aunque después llegue el Ack.
+    """
+
+    def __init__(self, params: pika.URLParameters, queue: str, durable: bool, logger: logging.Logger):
+        self.params = params
+        self.queue = queue
+        self.durable = durable
+        self.logger = logger
+        self._connection = None
+        self._channel = None
+        self._ready = False
+        self._next_tag = 1
+        self._batch: Sequence[Tuple[int, bytes, pika.BasicProperties]] = ()
+        self._pending: "OrderedDict[int, int]" = OrderedDict()
+        self._returned: Dict[int, str] = {}
+        self._results: Dict[int, Tuple[bool, Optional[str]]] = {}
+        self._error: Optional[str] = None
+        self._timeout = 0.0
+        self._published_at: Optional[float] = None
+        self.publish_seconds: Optional[float] = None
+        self.confirm_seconds: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._ready and self._connection is not None and self._connection.is_open
+
+    def publish_batch(
+            self, messages: Sequence[Tuple[int, bytes, pika.BasicProperties]], timeout: float
+    ) -> Dict[int, Tuple[bool, Optional[str]]]:
+        """Publica `(índice, cuerpo, propiedades)` y bloquea hasta resolver el lote."""
+        if not messages:
+            return {}
+        self._batch = messages
+        self._timeout = timeout
+        self._pending.clear()
+        self._returned.clear()
+        self._results = {}
+        self._error = None
+        self._published_at = None
+        self.publish_seconds = self.confirm_seconds = None
+
+        if self.is_open:
+            self._connection.ioloop.call_later(0, self._send)
+        else:
+            self._connection = pika.SelectConnection(
+                self.params,
+                on_open_callback=self._on_connection_open,
+                on_open_error_callback=self._on_connection_error,
+                on_close_callback=self._on_connection_closed,
+            )
+        timer = self._connection.ioloop.call_later(timeout, self._on_timeout)
+        self._connection.ioloop.start()
+        self._connection.ioloop.remove_timeout(timer)
+        if self._published_at is not None:
+            self.confirm_seconds = time.perf_counter() - self._published_at
+
+        error = self._error or "sin confirmación del broker"
+        for index, _body, _props in messages:
+            self._results.setdefault(index, (False, error))
+        self._pending.clear()
+        self._batch = ()
+        return self._results
+
+    def process_events(self, time_limit: float = 0) -> None:
+        """Mueve el ioloop durante `time_limit` segundos (heartbeats entre lotes)."""
+        if not self.is_open:
+            return
+        ioloop = self._connection.ioloop
+        ioloop.call_later(max(time_limit, 0), ioloop.stop)
+        ioloop.start()
+
+    def close(self) -> None:
+        """Cierra la conexión (si sigue abierta) y espera a que termine de cerrarse."""
+        if self._connection is not None and self._connection.is_open:
+            self._connection.close()
+            self._connection.ioloop.start()
+        self._connection = None
+
+    def _done(self) -> bool:
+        return len(self._results) == len(self._batch)
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_connection_error(self, _connection, exc):
+        self._error = f"no se pudo conectar: {exc}"
+        self._connection.ioloop.stop()
+
+    def _on_connection_closed(self, _connection, reason):
+        self._ready = False
+        self._channel = None
+        if self._batch and not self._done() and not self._error:
+            self._error = f"conexión cerrada: {reason}"
+        self._connection.ioloop.stop()
+
+    def _on_channel_open(self, channel):
+        self._channel = channel
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.add_on_return_callback(self._on_return)
+        channel.queue_declare(queue=self.queue, durable=self.durable, callback=self._on_queue_declared)
+
+    def _on_channel_closed(self, _channel, reason):
+        self._ready = False
+        if self._batch and not self._done() and not self._error:
+            self._error = f"canal cerrado: {reason}"
+        # Sin canal la conexión no sirve: se cierra y el siguiente lote la rehace
+        if self._connection.is_open:
+            self._connection.close()
+        else:
+            self._connection.ioloop.stop()
+
+    def _on_queue_declared(self, _frame):
+        self._channel.confirm_delivery(ack_nack_callback=self._on_confirm, callback=self._on_confirm_selected)
+
+    def _on_confirm_selected(self, _frame):
+        # Canal nuevo en modo confirm: los delivery tags empiezan en 1
+        self._ready = True
+        self._next_tag = 1
+        self._send()
+
+    def _send(self):
+        # Pipeline: publicamos todo el lote sin esperar confirmaciones intermedias
+        started = time.perf_counter()
+        for index, body, props in self._batch:
+            tag = self._next_tag
+            self._next_tag += 1
+            self._pending[tag] = index
+            self._channel.basic_publish(
+                exchange="", routing_key=self.queue, body=body,
+                properties=_with_message_id(props, str(tag)), mandatory=True,
+            )
+        self._published_at = time.perf_counter()
+        self.publish_seconds = self._published_at - started
+
+    def _on_return(self, _channel, method, properties, _body):
+        if properties.message_id is not None:
+            self._returned[int(properties.message_id)] = f"mensaje devuelto: {method.reply_text}"
+
+    def _on_confirm(self, frame):
+        method = frame.method
+        is_ack = isinstance(method, pika.spec.Basic.Ack)
+        if method.multiple:
+            confirmed = []
+            while self._pending and next(iter(self._pending)) <= method.delivery_tag:
+                confirmed.append(self._pending.popitem(last=False))
+        else:
+            index = self._pending.pop(method.delivery_tag, None)
+            confirmed = [] if index is None else [(method.delivery_tag, index)]
+        for tag, index in confirmed:
+            returned = self._returned.pop(tag, None)
+            if not is_ack:
+                self._results[index] = (False, "nack del broker")
+            elif returned is not None:
+                self._results[index] = (False, returned)
+            else:
+                self._results[index] = (True, None)
+        if self._batch and self._done():
+            self._connection.ioloop.stop()
+
+    def _on_timeout(self):
+        if not self._done():
+            self._error = f"timeout de {self._timeout}s esperando confirmaciones"
+        # Los confirms tardíos no deben mezclarse con el siguiente lote
+        self._ready = False
+        if self._connection.is_open:
+            self._connection.close()
+        else:
+            self._connection.ioloop.stop()
+
+
+def _raw_properties(
+        content_type: Optional[str],
+        content_encoding: Optional[str],
+        headers: Optional[Dict[str, Any]],
+        timestamp: Optional[int],
+) -> pika.BasicProperties:
+    return pika.BasicProperties(
+        content_type=content_type,
+        content_encoding=content_encoding,
+        delivery_mode=2,
+        headers=headers or None,
+        timestamp=timestamp if timestamp is not None else int(time.time()),
+    )
+
 
 class RabbitPublisher:
     """
@@ -16,16 +247,20 @@ class RabbitPublisher:
     def __init__(
             self,
             logger: Optional[logging.Logger] = None,
-            durable: bool = True
+            durable: bool = True,
+            codec: Optional[str] = None,
+            connection_factory: Optional[Callable[[pika.URLParameters], Any]] = None,
+            outbox: Optional[Any] = None,
     ):
 
-        env_user = os.getenv("RABBITMQ_USER")
-        env_pass = os.getenv("RABBITMQ_PASS")
-        env_host = os.getenv("RABBITMQ_HOST")
-        self.url = f"amqps://{env_user}:{env_pass}@{env_host}"
-        self.queue = "micola_queue"
+        self.url = rabbit_url()
+        self.queue = DEFAULT_QUEUE
         self.logger = logger or logging.getLogger(__name__)
         self.durable = durable
+        # Códec de los mensajes: json (por defecto), json+gzip, json+zlib, msgpack...
+        self.codec = get_codec(codec or os.getenv("RABBITMQ_CODEC"))
+        # Outbox en disco (outbox.Outbox) donde guardar lo que no se pudo publicar
+        self.outbox = outbox
 
         # Guardamos los parámetros pero NO conectamos en el __init__
         # para facilitar la reconexión en caso de fallo.
@@ -33,14 +268,21 @@ class RabbitPublisher:
             raise ValueError("Faltan RABBIT_URL o RABBIT_QUEUE")
 
         self._params = pika.URLParameters(self.url)
+        # Permite sustituir la conexión real (p. ej. por local_broker en benchmarks)
+        self._connection_factory = connection_factory or pika.BlockingConnection
         self._connection = None
         self._channel = None
+        # Conexión asíncrona de `publish_many`, abierta en el primer lote y reutilizada.
+        # Con `connection_factory` propia (p. ej. local_broker) no hay SelectConnection
+        # equivalente: los lotes se publican mensaje a mensaje por esa conexión.
+        self._pipelined = connection_factory is None
+        self._async: Optional[_AsyncConfirmChannel] = None
 
     def _connect(self):
         """Método interno para establecer conexión y canal."""
         if not self._connection or self._connection.is_closed:
             self.logger.info("Conectando a RabbitMQ...")
-            self._connection = pika.BlockingConnection(self._params)
+            self._connection = self._connection_factory(self._params)
             self._channel = self._connection.channel()
             self._channel.queue_declare(queue=self.queue, durable=self.durable)
 
@@ -49,46 +291,238 @@ class RabbitPublisher:
             self._channel.confirm_delivery()
             self.logger.info("Conexión establecida y Confirms activados.")
 
-    def publish(self, payload: Any, retries: int = 3) -> bool:
+    def _encode(self, payload: Any) -> bytes:
+        with metrics.stage("serialize"):
+            body = self.codec.encode(payload)
+        metrics.PAYLOAD_BYTES.observe(len(body))
+        return body
+
+    def _properties(self, headers: Optional[Dict[str, Any]] = None) -> pika.BasicProperties:
+        # Propiedades estáticas (Persistencia) + códec anunciado a los consumidores
+        # `timestamp` es el instante de creación; los consumidores lo usan como `sent_at`
+        return pika.BasicProperties(
+            content_type=self.codec.content_type,
+            content_encoding=self.codec.content_encoding,
+            delivery_mode=2,
+            headers=headers or None,
+            timestamp=int(time.time()),
+        )
+
+    def publish(self, payload: Any, retries: int = 3, headers: Optional[Dict[str, Any]] = None) -> bool:
         """
         Publica con reintentos y confirmación de entrega.
+        `headers` se envía como cabeceras AMQP del mensaje (p. ej. tipo de mensaje).
         Retorna True si el mensaje fue confirmado por el broker.
+
+        Si se agotan los reintentos y hay `outbox`, el mensaje ya codificado se
+        guarda en disco para reenviarlo con `outbox.OutboxDrainer`.
         """
-        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        body = self._encode(payload)
+        props = self._properties(headers)
+        if self._publish_body(body, props, retries):
+            return True
+        if self.outbox is not None:
+            try:
+                self.outbox.append(body, props.content_type, props.content_encoding, headers)
+                self.logger.warning("Mensaje guardado en el outbox local para reenviarlo más tarde.")
+            except OSError as e:
+                self.logger.error(f"No se pudo guardar el mensaje en el outbox: {e}")
+        return False
 
-        # Propiedades estáticas (Persistencia)
-        props = pika.BasicProperties(content_type="application/json", delivery_mode=2)
+    def publish_raw(
+            self,
+            body: bytes,
+            content_type: Optional[str] = None,
+            content_encoding: Optional[str] = None,
+            headers: Optional[Dict[str, Any]] = None,
+            retries: int = 3,
+            timestamp: Optional[int] = None,
+    ) -> bool:
+        """
+        Publica un cuerpo ya codificado con sus propiedades originales (p. ej.
+        al drenar el outbox). No vuelve a guardar en el outbox si falla.
+        """
+        props = _raw_properties(content_type, content_encoding, headers, timestamp)
+        return self._publish_body(body, props, retries)
 
+    def _publish_body(self, body: bytes, props: pika.BasicProperties, retries: int) -> bool:
         for attempt in range(1, retries + 1):
             try:
                 self._connect()  # Asegura que estamos conectados
 
                 # Al tener confirm_delivery activado, basic_publish puede lanzar excepciones
                 # si el mensaje no se puede enrutar, garantizando seguridad.
-                self._channel.basic_publish(
-                    exchange="",
-                    routing_key=self.queue,
-                    body=body,
-                    properties=props,
-                    mandatory=True  # Lanza error si no se puede enrutar
-                )
+                # En BlockingConnection el confirm es síncrono: la etapa incluye su espera.
+                with metrics.stage("publish"):
+                    self._channel.basic_publish(
+                        exchange="",
+                        routing_key=self.queue,
+                        body=body,
+                        properties=props,
+                        mandatory=True  # Lanza error si no se puede enrutar
+                    )
 
                 self.logger.debug("Mensaje publicado y confirmado en %s", self.queue)
+                metrics.MESSAGES.inc(outcome="confirmed")
                 return True
 
             except (AMQPConnectionError, AMQPChannelError) as e:
                 self.logger.warning(f"Error de conexión (intento {attempt}/{retries}): {e}")
                 self._connection = None  # Forzamos reconexión en la siguiente vuelta
-                time.sleep(2)  # Espera antes de reintentar
+                if attempt < retries:
+                    time.sleep(2)  # Espera antes de reintentar
             except Exception as e:
                 self.logger.error(f"Error irrecuperable publicando: {e}")
                 raise e
 
         self.logger.error("Fallo al publicar mensaje después de todos los reintentos.")
+        metrics.MESSAGES.inc(outcome="failed")
         return False
 
+    def publish_many(
+            self,
+            payloads: Sequence[Any],
+            retries: int = 3,
+            timeout: float = 30.0,
+            headers: Optional[Dict[str, Any]] = None,
+    ) -> List[PublishOutcome]:
+        """
+        Publica muchos mensajes en pipeline con confirmaciones asíncronas.
+
+        A diferencia de `publish`, no espera el confirm de cada mensaje antes de
+        enviar el siguiente: el lote entero viaja seguido y los Ack/Nack se
+        asocian a cada mensaje por delivery tag. En cada reintento sólo se
+        reenvían los mensajes con Nack, devueltos o sin confirmar.
+
+        Usa una conexión asíncrona (`SelectConnection`) propia, independiente
+        de la de `publish`, que se mantiene abierta entre lotes; con un
+        `connection_factory` inyectado se publica mensaje a mensaje por la
+        conexión de `publish`. Los mensajes que siguen sin confirmar tras los
+        reintentos se guardan en `outbox`.
+
+        Returns:
+            List[PublishOutcome]: Un resultado por payload, en el mismo orden.
+        """
+        bodies = [self._encode(p) for p in payloads]
+        props = self._properties(headers)
+        outcomes = self._publish_many_bodies([(body, props) for body in bodies], retries, timeout)
+        failed = [bodies[o.index] for o in outcomes if not o.confirmed]
+        if failed and self.outbox is not None:
+            try:
+                for body in failed:
+                    self.outbox.append(body, props.content_type, props.content_encoding, headers)
+                self.logger.warning("%d mensajes guardados en el outbox local para reenviarlos más tarde.", len(failed))
+            except OSError as e:
+                self.logger.error(f"No se pudo guardar el lote en el outbox: {e}")
+        return outcomes
+
+    def publish_raw_many(
+            self,
+            messages: Sequence[Dict[str, Any]],
+            retries: int = 3,
+            timeout: float = 30.0,
+    ) -> List[PublishOutcome]:
+        """
+        Como `publish_many`, pero con cuerpos ya codificados y propiedades por
+        mensaje (claves de `publish_raw`: ``body``, ``content_type``,
+        ``content_encoding``, ``headers``, ``timestamp``), p. ej. al drenar el
+        outbox. No vuelve a guardar en el outbox lo que falle.
+        """
+        return self._publish_many_bodies(
+            [
+                (m["body"], _raw_properties(
+                    m.get("content_type"), m.get("content_encoding"), m.get("headers"), m.get("timestamp")
+                ))
+                for m in messages
+            ],
+            retries, timeout,
+        )
+
+    def _publish_many_bodies(
+            self, messages: Sequence[Tuple[bytes, pika.BasicProperties]], retries: int, timeout: float
+    ) -> List[PublishOutcome]:
+        if not self._pipelined:
+            return self._publish_sequential(messages, retries)
+        outcomes = [PublishOutcome(index=i) for i in range(len(messages))]
+        pending = list(range(len(messages)))
+        if self._async is None:
+            self._async = _AsyncConfirmChannel(self._params, self.queue, self.durable, self.logger)
+
+        for attempt in range(1, retries + 1):
+            if not pending:
+                break
+            batch = self._async
+            try:
+                results = batch.publish_batch([(i, *messages[i]) for i in pending], timeout)
+                if batch.publish_seconds is not None:
+                    metrics.STAGE_SECONDS.observe(batch.publish_seconds, stage="publish")
+                if batch.confirm_seconds is not None:
+                    metrics.STAGE_SECONDS.observe(batch.confirm_seconds, stage="confirm")
+            except Exception as e:
+                self.logger.warning(f"Error publicando lote (intento {attempt}/{retries}): {e}")
+                results = {i: (False, str(e)) for i in pending}
+
+            for i in pending:
+                ok, error = results.get(i, (False, "sin resultado"))
+                outcomes[i].attempts = attempt
+                outcomes[i].confirmed = ok
+                outcomes[i].error = error
+            pending = [i for i in pending if not outcomes[i].confirmed]
+            if pending:
+                self.logger.warning(
+                    "%d/%d mensajes sin confirmar (intento %d/%d)",
+                    len(pending), len(messages), attempt, retries,
+                )
+                if attempt < retries:
+                    time.sleep(2)
+
+        metrics.MESSAGES.inc(len(messages) - len(pending), outcome="confirmed")
+        metrics.MESSAGES.inc(len(pending), outcome="failed")
+        if pending:
+            self.logger.error("Fallo al publicar %d mensajes después de todos los reintentos.", len(pending))
+        else:
+            self.logger.debug("Lote de %d mensajes confirmado en %s", len(messages), self.queue)
+        return outcomes
+
+    def _publish_sequential(
+            self, messages: Sequence[Tuple[bytes, pika.BasicProperties]], retries: int
+    ) -> List[PublishOutcome]:
+        outcomes = []
+        for i, (body, props) in enumerate(messages):
+            ok = self._publish_body(body, props, retries)
+            outcomes.append(PublishOutcome(
+                index=i, confirmed=ok, attempts=retries if not ok else 1,
+                error=None if ok else "sin confirmación del broker",
+            ))
+        return outcomes
+
+    def process_events(self, time_limit: float = 0) -> None:
+        """
+        Atiende heartbeats y eventos pendientes de la conexión.
+
+        `BlockingConnection` sólo responde a los heartbeats del broker dentro de
+        llamadas a pika; un proceso de larga duración debe invocar esto mientras
+        espera entre publicaciones para que el broker no cierre la conexión.
+        También atiende la conexión asíncrona de `publish_many`.
+        """
+        if self._async is not None:
+            self._async.process_events()
+        if not self._connection or self._connection.is_closed:
+            return
+        try:
+            self._connection.process_data_events(time_limit=time_limit)
+        except (AMQPConnectionError, AMQPChannelError) as e:
+            self.logger.warning(f"Conexión perdida mientras estaba inactiva: {e}")
+            self._connection = None  # Se reconectará en la siguiente publicación
+
     def close(self):
-        """Cierra la conexión de RabbitMQ de forma segura."""
+        """Cierra las conexiones de RabbitMQ de forma segura."""
+        if self._async is not None:
+            try:
+                self._async.close()
+            except Exception as e:
+                self.logger.warning("Error cerrando la conexión asíncrona de RabbitMQ: %s", e)
+            self._async = None
         try:
             # Verificamos si existe la conexión y si no está ya cerrada
             if hasattr(self, '_connection') and self._connection and self._connection.is_open:
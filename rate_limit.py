@@ -0,0 +1,288 @@
+# python
+"""
+Limitación de ritmo y protección frente a APIs externas caídas.
+
+Este módulo proporciona:
+
+- `TokenBucket`: cubo de tokens compartido entre hilos; limita las peticiones
+  por segundo contra una API y permite pausar a todos los consumidores cuando
+  la API responde 429 con `Retry-After`.
+- `CircuitBreaker`: deja de llamar a una API tras `failure_threshold` fallos
+  seguidos y vuelve a probar con una única petición pasado `reset_timeout`.
+- `backoff_delay`: espera exponencial con jitter completo que respeta
+  `Retry-After`.
+- `UpstreamGuard`: combina los tres alrededor de una llamada, y `get_guard`
+  devuelve una instancia compartida por API (``emt``, ``aemet``).
+
+Variables de entorno utilizadas (opcional):
+- EMT_RATE_PER_S / EMT_BURST: ritmo y ráfaga máxima contra EMT.
+- AEMET_RATE_PER_S / AEMET_BURST: ritmo y ráfaga máxima contra AEMET.
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, Callable, Dict, Optional
+
+import requests
+
+import metrics
+
+_logger = logging.getLogger(__name__)
+
+# Ritmo por defecto (peticiones/s, ráfaga) por API
+DEFAULT_LIMITS = {"emt": (10.0, 20), "aemet": (0.5, 2)}
+
+UPSTREAM_RETRIES = metrics.REGISTRY.register(metrics.Counter(
+    "upstream_retries_total", "Reintentos contra APIs externas por motivo.", ("api", "reason")
+))
+CIRCUIT_REJECTIONS = metrics.REGISTRY.register(metrics.Counter(
+    "upstream_circuit_rejections_total", "Llamadas rechazadas con el circuito abierto.", ("api",)
+))
+
+
+class CircuitOpenError(RuntimeError):
+    """La API está marcada como caída y no se intenta la llamada."""
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Interpreta `Retry-After` en segundos o como fecha HTTP. None si no es válido."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def backoff_delay(
+    attempt: int,
+    base: float = 1.0,
+    cap: float = 60.0,
+    retry_after: Optional[float] = None,
+) -> float:
+    """
+    Espera antes del reintento `attempt` (1, 2, ...).
+
+    Jitter completo (uniforme entre 0 y `base * 2**(attempt-1)`, con tope
+    `cap`) para que los hilos que fallan a la vez no reintenten a la vez. Si
+    el servidor indicó `Retry-After`, se espera al menos eso más un pequeño
+    jitter.
+    """
+    ceiling = min(cap, base * (2 ** max(0, attempt - 1)))
+    jitter = random.uniform(0, ceiling)
+    if retry_after is not None:
+        return retry_after + random.uniform(0, min(ceiling, 1.0))
+    return jitter
+
+
+class TokenBucket:
+    """
+    Cubo de tokens thread-safe.
+
+    Args:
+        rate (float): Tokens repuestos por segundo.
+        capacity (float): Tamaño máximo de ráfaga.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        if rate <= 0 or capacity <= 0:
+            raise ValueError("rate y capacity deben ser positivos")
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, tokens: float = 1.0, timeout: Optional[float] = None) -> bool:
+        """Bloquea hasta disponer de `tokens`. Devuelve False si vence `timeout`."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if now >= self._paused_until and self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return True
+                wait = max(self._paused_until - now, (tokens - self._tokens) / self.rate)
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Detiene a todos los consumidores `seconds` segundos (p. ej. tras un 429)."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+class CircuitBreaker:
+    """
+    Interruptor cerrado → abierto → semiabierto.
+
+    Args:
+        failure_threshold (int): Fallos consecutivos que abren el circuito.
+        reset_timeout (float): Segundos en abierto antes de permitir una prueba.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+                return self.HALF_OPEN
+            return self._state
+
+    def allow(self) -> bool:
+        """True si se puede hacer la llamada. En semiabierto sólo pasa una prueba."""
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._state = self.HALF_OPEN
+            if self._probe_in_flight:
+                return False
+            self._probe_in_flight = True
+            return True
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    _logger.warning("Circuito abierto tras %d fallos consecutivos.", self._failures)
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+
+
+def _retry_reason(exc: BaseException) -> Optional[str]:
+    """Motivo de reintento para `exc`, o None si el error no es transitorio."""
+    if isinstance(exc, requests.HTTPError):
+        status = getattr(exc.response, "status_code", None)
+        if status == 429:
+            return "429"
+        if status is not None and status >= 500:
+            return "5xx"
+        return None
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout)):
+        return "network"
+    return None
+
+
+class UpstreamGuard:
+    """
+    Ejecuta llamadas a una API respetando su cubo de tokens y su circuito.
+
+    Los 429 pausan el cubo compartido el tiempo de `Retry-After`, de modo que
+    todos los hilos frenan a la vez en lugar de seguir provocando 429. Los 5xx
+    y errores de red cuentan como fallo del circuito. El resto de excepciones
+    se relanzan sin reintentar.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        bucket: TokenBucket,
+        breaker: Optional[CircuitBreaker] = None,
+        max_attempts: int = 3,
+        backoff_base: float = 1.0,
+        backoff_cap: float = 60.0,
+        logger: Optional[logging.Logger] = None,
+    ):
+        self.name = name
+        self.bucket = bucket
+        self.breaker = breaker or CircuitBreaker()
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.logger = logger or _logger
+
+    def call(self, func: Callable[[], Any], max_attempts: Optional[int] = None) -> Any:
+        attempts = max_attempts or self.max_attempts
+        for attempt in range(1, attempts + 1):
+            if not self.breaker.allow():
+                CIRCUIT_REJECTIONS.inc(api=self.name)
+                raise CircuitOpenError(f"API {self.name} no disponible (circuito abierto)")
+            self.bucket.acquire()
+            try:
+                result = func()
+            except Exception as e:
+                reason = _retry_reason(e)
+                if reason is None:
+                    # Error no transitorio: la API respondió, el circuito sigue sano
+                    self.breaker.record_success()
+                    raise
+                retry_after = None
+                if reason == "429":
+                    retry_after = parse_retry_after(e.response.headers.get("Retry-After"))
+                    self.breaker.record_success()
+                else:
+                    self.breaker.record_failure()
+                if attempt == attempts:
+                    raise
+                wait = backoff_delay(attempt, self.backoff_base, self.backoff_cap, retry_after)
+                if reason == "429":
+                    self.bucket.pause(wait)
+                UPSTREAM_RETRIES.inc(api=self.name, reason=reason)
+                self.logger.warning(
+                    "%s: %s, reintento %d/%d en %.1fs", self.name, reason, attempt, attempts, wait
+                )
+                if reason != "429":
+                    time.sleep(wait)
+                continue
+            self.breaker.record_success()
+            return result
+        raise RuntimeError(f"Máximo de intentos ({attempts}) alcanzado para la API {self.name}")
+
+
+_guards: Dict[str, UpstreamGuard] = {}
+_guards_lock = threading.Lock()
+
+
+def get_guard(api: str) -> UpstreamGuard:
+    """Instancia compartida por proceso para `api` (``emt`` o ``aemet``)."""
+    with _guards_lock:
+        guard = _guards.get(api)
+        if guard is None:
+            rate, burst = DEFAULT_LIMITS.get(api, (5.0, 10))
+            prefix = api.upper()
+            rate = float(os.getenv(f"{prefix}_RATE_PER_S", rate))
+            burst = float(os.getenv(f"{prefix}_BURST", burst))
+            guard = _guards[api] = UpstreamGuard(api, TokenBucket(rate, burst))
+        return guard
@@ -0,0 +1,212 @@
+# python
+"""
+Grabación y reproducción de respuestas HTTP de EMT y AEMET.
+
+Este módulo proporciona dos transportes intercambiables con `HttpTransport`:
+
+- `RecordingTransport`: envuelve un transporte real y guarda cada respuesta
+  (método, URL, estado, cabeceras, cuerpo y tiempo de respuesta) en un
+  archivo JSONL.
+- `ReplayTransport`: devuelve las respuestas de ese archivo sin red ni
+  credenciales, con la latencia original (`realtime=True`) o lo más rápido
+  posible, para reproducir carga de producción y medir el pipeline.
+
+Las cabeceras de la petición (credenciales, `accessToken`, `api_key`) nunca
+se graban, y los campos JSON listados en `redact_keys` se sustituyen por
+``"REDACTED"`` antes de escribirlos.
+
+`ReplayTransport` se marca como `offline`: los clientes no exigen
+credenciales y guardan sus cachés en disco (token de EMT, metadatos de
+paradas) en su `cache_dir` temporal, de modo que el token ``"REDACTED"`` y los
+datos reproducidos nunca llegan a las cachés reales.
+
+Variables de entorno utilizadas por `main.build_transport` (opcional):
+- HTTP_RECORD_FILE: graba las respuestas en este archivo.
+- HTTP_REPLAY_FILE: reproduce las respuestas de este archivo.
+- HTTP_REPLAY_REALTIME: "1" para respetar la latencia grabada.
+"""
+
+import base64
+import json
+import shutil
+import tempfile
+import threading
+import time
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from http_transport import HttpTransport
+
+REDACTED = "REDACTED"
+DEFAULT_REDACT_KEYS = ("accessToken", "refreshToken")
+
+
+def _redact(value: Any, keys: Iterable[str]) -> Any:
+    keys = set(keys)
+
+    def walk(v: Any) -> Any:
+        if isinstance(v, dict):
+            return {k: (REDACTED if k in keys else walk(x)) for k, x in v.items()}
+        if isinstance(v, list):
+            return [walk(x) for x in v]
+        return v
+
+    return walk(value)
+
+
+def _build_response(record: Dict[str, Any]) -> requests.Response:
+    """Reconstruye un `requests.Response` a partir de una línea del archivo."""
+    resp = requests.Response()
+    resp.status_code = record["status"]
+    resp.headers = CaseInsensitiveDict(record.get("headers") or {})
+    resp._content = base64.b64decode(record.get("body_b64") or "")
+    resp.url = record["url"]
+    resp.encoding = record.get("encoding")
+    resp.reason = record.get("reason")
+    return resp
+
+
+class RecordingTransport:
+    """
+    Transporte que delega en `inner` y graba cada respuesta en `path` (JSONL).
+
+    Args:
+        path (str): Archivo de salida (se abre en modo append).
+        inner (Optional[HttpTransport]): Transporte real; por defecto uno nuevo.
+        redact_keys (Iterable[str]): Campos JSON a ocultar en los cuerpos.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        inner: Optional[HttpTransport] = None,
+        redact_keys: Iterable[str] = DEFAULT_REDACT_KEYS,
+    ):
+        self.path = path
+        self.inner = inner or HttpTransport()
+        self.redact_keys = tuple(redact_keys)
+        self._lock = threading.Lock()
+        self._fh = open(path, "a", encoding="utf-8")
+
+    def _record(self, method: str, url: str, resp: requests.Response, started: float, elapsed: float) -> None:
+        body = resp.content
+        if self.redact_keys:
+            try:
+                body = json.dumps(_redact(json.loads(body), self.redact_keys), ensure_ascii=False).encode("utf-8")
+            except ValueError:
+                pass
+        record = {
+            "t": started,
+            "elapsed": elapsed,
+            "method": method,
+            "url": url,
+            "status": resp.status_code,
+            "reason": resp.reason,
+            "headers": dict(resp.headers),
+            "encoding": resp.encoding,
+            "body_b64": base64.b64encode(body).decode("ascii"),
+        }
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._fh.write(line + "\n")
+            self._fh.flush()
+
+    def _call(self, method: str, url: str, **kwargs: Any) -> requests.Response:
+        started = time.time()
+        t0 = time.perf_counter()
+        resp = getattr(self.inner, method.lower())(url, **kwargs)
+        self._record(method, url, resp, started, time.perf_counter() - t0)
+        return resp
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self._call("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self._call("POST", url, **kwargs)
+
+    def close(self) -> None:
+        with self._lock:
+            self._fh.close()
+        self.inner.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ReplayTransport:
+    """
+    Transporte que responde con lo grabado por `RecordingTransport`.
+
+    Cada petición consume la siguiente respuesta grabada para el mismo método
+    y URL, en orden. Con `loop=True` las respuestas se reciclan al agotarse
+    (útil para pruebas de carga largas); si no, se lanza
+    `requests.ConnectionError` como si no hubiera red.
+
+    Args:
+        path (str): Archivo JSONL grabado.
+        realtime (bool): Si True, espera la latencia original de cada respuesta.
+        speed (float): Factor de aceleración de la latencia en modo realtime.
+        loop (bool): Reciclar respuestas al agotarse.
+    """
+
+    # Sin red: los clientes no piden credenciales reales
+    offline = True
+
+    def __init__(self, path: str, realtime: bool = False, speed: float = 1.0, loop: bool = False):
+        self.path = path
+        # Cachés en disco de los clientes durante la reproducción (se borra en `close`)
+        self.cache_dir = tempfile.mkdtemp(prefix="madrid-mobility-replay-")
+        self.realtime = realtime
+        self.speed = speed if speed > 0 else 1.0
+        self.loop = loop
+        self._lock = threading.Lock()
+        self._records: Dict[Tuple[str, str], Deque[Dict[str, Any]]] = defaultdict(deque)
+        self.requests_served = 0
+        with open(path, "r", encoding="utf-8") as fh:
+            for line in fh:
+                line = line.strip()
+                if line:
+                    r = json.loads(line)
+                    self._records[(r["method"], r["url"])].append(r)
+
+    @property
+    def records(self) -> List[Dict[str, Any]]:
+        return [r for q in self._records.values() for r in q]
+
+    def _next(self, method: str, url: str) -> Dict[str, Any]:
+        with self._lock:
+            queue = self._records.get((method, url))
+            if not queue:
+                raise requests.ConnectionError(f"Sin respuesta grabada para {method} {url}")
+            record = queue.popleft()
+            if self.loop:
+                queue.append(record)
+            self.requests_served += 1
+        return record
+
+    def _call(self, method: str, url: str) -> requests.Response:
+        record = self._next(method, url)
+        if self.realtime:
+            time.sleep(record.get("elapsed", 0.0) / self.speed)
+        return _build_response(record)
+
+    def get(self, url: str, **kwargs: Any) -> requests.Response:
+        return self._call("GET", url)
+
+    def post(self, url: str, **kwargs: Any) -> requests.Response:
+        return self._call("POST", url)
+
+    def close(self) -> None:
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,127 @@
+# python
+"""
+Reparto de paradas entre workers con hashing consistente.
+
+Este módulo proporciona:
+
+- `HashRing`: anillo de hashing consistente con nodos virtuales. Al añadir o
+  quitar un shard sólo cambian de dueño las paradas de los arcos afectados
+  (≈ 1/N del total), no todo el reparto.
+- `load_stops`: carga la lista de paradas desde un fichero de configuración.
+- `assign_stops`: reparte las paradas entre `shard_count` shards.
+
+Formatos admitidos para el fichero de paradas:
+- JSON: lista de códigos (``["5907", "66"]``) o ``{"stops": [...]}``.
+- Texto: un código por línea; se ignoran líneas vacías y comentarios ``#``.
+
+Variables de entorno utilizadas (opcional):
+- STOPS_FILE: fichero de paradas.
+- SHARD_COUNT: número total de shards del despliegue.
+- SHARD_IDS: shards que ejecuta este worker, separados por comas.
+- SHARD_VNODES: nodos virtuales por shard en el anillo.
+"""
+
+import bisect
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Sequence
+
+DEFAULT_VNODES = 128
+# Cabecera AMQP con el shard que publicó el mensaje
+SHARD_HEADER = "x-shard-id"
+
+
+def _hash(key: str) -> int:
+    # md5 sólo como función de dispersión estable entre procesos (no `hash()`)
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Anillo de hashing consistente.
+
+    Args:
+        nodes (Iterable[str]): Identificadores de los nodos (shards).
+        vnodes (int): Puntos del anillo por nodo; más puntos reparten mejor.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), vnodes: int = DEFAULT_VNODES):
+        self.vnodes = vnodes
+        self._points: List[int] = []
+        self._owners: List[str] = []
+        self._nodes: set = set()
+        for node in nodes:
+            self.add_node(node)
+
+    @property
+    def nodes(self) -> List[str]:
+        return sorted(self._nodes)
+
+    def add_node(self, node: str) -> None:
+        if node in self._nodes:
+            return
+        self._nodes.add(node)
+        for i in range(self.vnodes):
+            point = _hash(f"{node}#{i}")
+            idx = bisect.bisect(self._points, point)
+            self._points.insert(idx, point)
+            self._owners.insert(idx, node)
+
+    def remove_node(self, node: str) -> None:
+        if node not in self._nodes:
+            return
+        self._nodes.discard(node)
+        keep = [(p, o) for p, o in zip(self._points, self._owners) if o != node]
+        self._points = [p for p, _o in keep]
+        self._owners = [o for _p, o in keep]
+
+    def node_for(self, key: str) -> str:
+        """Nodo dueño de `key`: el primer punto del anillo en sentido horario."""
+        if not self._points:
+            raise ValueError("El anillo no tiene nodos")
+        idx = bisect.bisect(self._points, _hash(key)) % len(self._points)
+        return self._owners[idx]
+
+    def assign(self, keys: Iterable[str]) -> Dict[str, List[str]]:
+        """Reparte `keys` entre los nodos (todos los nodos aparecen, aunque vacíos)."""
+        result: Dict[str, List[str]] = {node: [] for node in self.nodes}
+        for key in keys:
+            result[self.node_for(key)].append(key)
+        return result
+
+
+def load_stops(path: Optional[str] = None, default: Sequence[str] = ()) -> List[str]:
+    """
+    Lee las paradas de `path` (o `STOPS_FILE`). Sin fichero devuelve `default`.
+    Elimina duplicados conservando el orden.
+    """
+    path = path or os.getenv("STOPS_FILE")
+    if not path:
+        return list(default)
+    with open(path, "r", encoding="utf-8") as fh:
+        raw = fh.read()
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        data = None
+    if not isinstance(data, (list, dict)):
+        # Texto plano (una parada por línea); "5907" solo también es JSON válido
+        data = [line.split("#", 1)[0].strip() for line in raw.splitlines()]
+    if isinstance(data, dict):
+        data = data.get("stops", [])
+    if not isinstance(data, list):
+        raise ValueError(f"Formato de paradas no válido en {path}")
+    stops = [str(s).strip() for s in data if str(s).strip()]
+    return list(dict.fromkeys(stops))
+
+
+def shard_ids(shard_count: int) -> List[str]:
+    """Identificadores de shard de un despliegue de `shard_count` shards."""
+    return [str(i) for i in range(max(1, shard_count))]
+
+
+def assign_stops(stops: Sequence[str], shard_count: int, vnodes: Optional[int] = None) -> Dict[str, List[str]]:
+    """Reparto `{shard_id: [paradas]}` de `stops` entre `shard_count` shards."""
+    vnodes = vnodes or int(os.getenv("SHARD_VNODES", DEFAULT_VNODES))
+    return HashRing(shard_ids(shard_count), vnodes=vnodes).assign(stops)
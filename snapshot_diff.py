@@ -0,0 +1,147 @@
+# python
+"""
+Publicación incremental de snapshots de llegadas.
+
+Este módulo proporciona la clase `SnapshotDiffer`, que compara cada snapshot
+de `main.group_by_line` con el último estado emitido y devuelve sólo:
+
+- altas: llegadas (línea, destino, vehículo, parada) que no existían;
+- cambios: llegadas cuyo `estimateArrive` o posición se han movido más que
+  los umbrales configurados;
+- bajas: llegadas que han desaparecido del snapshot.
+
+Cada `keyframe_every` ciclos (o tras `force_keyframe`) se emite el snapshot
+completo para que los consumidores puedan resincronizarse.
+
+Formato del mensaje::
+
+    {
+        "type": "keyframe" | "delta",
+        "seq": 42,                 # número de ciclo
+        "keyframe_seq": 36,        # último keyframe del que depende este delta
+        "groups": [...],           # mismo formato que group_by_line (v1)
+        "removed": [{"line", "destination", "vehicle_id", "stop"}, ...]
+    }
+"""
+
+import math
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+KEYFRAME = "keyframe"
+DELTA = "delta"
+
+# Radio medio terrestre en metros (aproximación equirrectangular)
+_EARTH_RADIUS_M = 6371000.0
+
+ArrivalKey = Tuple[Any, Any, Any, Any]
+
+
+def arrival_key(entry: Dict[str, Any]) -> ArrivalKey:
+    return (entry.get("line"), entry.get("destination"), entry.get("vehicle_id"), entry.get("stop"))
+
+
+def _moved_metres(a: Optional[Dict[str, Any]], b: Optional[Dict[str, Any]]) -> float:
+    if not a or not b:
+        return 0.0 if a == b else math.inf
+    try:
+        lat1, lon1, lat2, lon2 = float(a["lat"]), float(a["lon"]), float(b["lat"]), float(b["lon"])
+    except (KeyError, TypeError, ValueError):
+        return 0.0 if a == b else math.inf
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * _EARTH_RADIUS_M
+
+
+def _eta_delta(a: Any, b: Any) -> float:
+    if a is None or b is None:
+        return 0.0 if a == b else math.inf
+    try:
+        return abs(float(a) - float(b))
+    except (TypeError, ValueError):
+        return 0.0 if a == b else math.inf
+
+
+class SnapshotDiffer:
+    """
+    Calcula deltas entre snapshots consecutivos de `group_by_line`.
+
+    El estado guardado es el último valor *emitido* de cada llegada, no el
+    último observado: así los cambios lentos se acumulan y acaban superando
+    el umbral en lugar de perderse.
+
+    Args:
+        eta_threshold (float): Cambio mínimo de `estimateArrive` (segundos)
+            para emitir una actualización.
+        distance_threshold (float): Desplazamiento mínimo (metros) para emitir
+            una actualización.
+        keyframe_every (int): Cada cuántos ciclos se emite un snapshot completo.
+    """
+
+    def __init__(
+        self,
+        eta_threshold: float = 30.0,
+        distance_threshold: float = 50.0,
+        keyframe_every: int = 12,
+    ):
+        if keyframe_every < 1:
+            raise ValueError("keyframe_every debe ser >= 1")
+        self.eta_threshold = eta_threshold
+        self.distance_threshold = distance_threshold
+        self.keyframe_every = keyframe_every
+        self._state: Dict[ArrivalKey, Dict[str, Any]] = {}
+        self._seq = 0
+        self._keyframe_seq: Optional[int] = None
+        self._force_keyframe = True
+
+    def force_keyframe(self) -> None:
+        """El siguiente `diff` emitirá un keyframe (p. ej. tras un fallo de publicación)."""
+        self._force_keyframe = True
+
+    def _is_changed(self, previous: Dict[str, Any], current: Dict[str, Any]) -> bool:
+        if _eta_delta(previous.get("estimateArrive"), current.get("estimateArrive")) >= self.eta_threshold:
+            return True
+        return _moved_metres(previous.get("coords"), current.get("coords")) >= self.distance_threshold
+
+    def diff(self, groups: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+        """Compara `groups` (salida de group_by_line) con el estado y devuelve el mensaje a publicar."""
+        groups = list(groups)
+        self._seq += 1
+        is_keyframe = (
+            self._force_keyframe
+            or self._keyframe_seq is None
+            or self._seq - self._keyframe_seq >= self.keyframe_every
+        )
+
+        current: Dict[ArrivalKey, Dict[str, Any]] = {}
+        changed_groups: List[Dict[str, Any]] = []
+        for group in groups:
+            changed_entries = []
+            for entry in group.get("stops", []):
+                key = arrival_key(entry)
+                previous = self._state.get(key)
+                if is_keyframe or previous is None or self._is_changed(previous, entry):
+                    current[key] = entry
+                    changed_entries.append(entry)
+                else:
+                    # Sin cambios relevantes: conservamos el último valor emitido
+                    current[key] = previous
+            if changed_entries and not is_keyframe:
+                changed_groups.append({**group, "stops": changed_entries})
+
+        removed = [] if is_keyframe else [
+            {"line": k[0], "destination": k[1], "vehicle_id": k[2], "stop": k[3]}
+            for k in self._state if k not in current
+        ]
+
+        self._state = current
+        if is_keyframe:
+            self._keyframe_seq = self._seq
+            self._force_keyframe = False
+
+        return {
+            "type": KEYFRAME if is_keyframe else DELTA,
+            "seq": self._seq,
+            "keyframe_seq": self._keyframe_seq,
+            "groups": groups if is_keyframe else changed_groups,
+            "removed": removed,
+        }
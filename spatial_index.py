@@ -0,0 +1,303 @@
+# python
+"""
+Índice espacial en memoria de las posiciones de los vehículos.
+
+Este módulo proporciona la clase `VehicleIndex`, una rejilla uniforme sobre
+una proyección equirrectangular local (metros) en la que cada celda guarda el
+conjunto de vehículos que contiene. Permite responder sin recorrer la flota:
+
+- `within_bbox`: vehículos dentro de un rectángulo lat/lon.
+- `within_radius`: vehículos a menos de `radius_m` metros de un punto.
+- `nearest`: los `k` vehículos más cercanos (búsqueda por anillos de celdas).
+
+El índice se actualiza de forma incremental en cada ciclo con
+`update_from_columns` a partir de las columnas `lat`/`lon`/`vehicle_id` de
+`ColumnarArrivals`: sólo se mueven de celda los vehículos que han cambiado y
+se eliminan los que no aparecen en el ciclo. Con `stops` (paradas consultadas
+con éxito) sólo se eliminan los vehículos vistos por última vez en esas
+paradas, de modo que una consulta fallida no vacía el índice.
+
+A escala de ciudad la proyección equirrectangular con latitud de referencia
+fija tiene un error muy inferior al de las coordenadas GPS de EMT, así que las
+distancias se calculan en el plano.
+
+Variables de entorno utilizadas (opcional):
+- SPATIAL_INDEX: "1" para que `main` mantenga el índice y lo sirva en /vehicles/*.
+- SPATIAL_INDEX_CELL_M: lado de la celda de la rejilla en metros (por defecto 250).
+"""
+
+import heapq
+import math
+import os
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+
+DEFAULT_CELL_M = 250.0
+# Latitud de referencia de la proyección (Puerta del Sol)
+MADRID_LAT = 40.4168
+
+# Metros por grado de latitud (aproximación esférica)
+_M_PER_DEG = math.pi * 6371000.0 / 180.0
+
+Cell = Tuple[int, int]
+
+
+class VehicleIndex:
+    """
+    Rejilla uniforme de vehículos por posición.
+
+    Args:
+        cell_m (Optional[float]): Lado de la celda en metros; conviene que sea
+            del orden del radio de las consultas habituales.
+        ref_lat (float): Latitud de referencia de la proyección.
+    """
+
+    def __init__(self, cell_m: Optional[float] = None, ref_lat: float = MADRID_LAT):
+        self.cell_m = float(cell_m or os.getenv("SPATIAL_INDEX_CELL_M", DEFAULT_CELL_M))
+        self._kx = _M_PER_DEG * math.cos(math.radians(ref_lat))
+        self._ky = _M_PER_DEG
+        # vehicle_id -> (x, y, lat, lon, celda, atributos)
+        self._vehicles: Dict[Any, Tuple[float, float, float, float, Cell, Dict[str, Any]]] = {}
+        self._cells: Dict[Cell, Set[Any]] = {}
+        # vehicle_id -> (ciclo, paradas en las que se ha visto en ese ciclo)
+        self._stops: Dict[Any, Tuple[int, Set[str]]] = {}
+        self._cycle = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._vehicles)
+
+    def __contains__(self, vehicle_id: Any) -> bool:
+        return vehicle_id in self._vehicles
+
+    def _project(self, lat: float, lon: float) -> Tuple[float, float]:
+        return lon * self._kx, lat * self._ky
+
+    def _cell(self, x: float, y: float) -> Cell:
+        return int(math.floor(x / self.cell_m)), int(math.floor(y / self.cell_m))
+
+    # --- actualización ---
+
+    def upsert(self, vehicle_id: Any, lat: float, lon: float, **attrs: Any) -> bool:
+        """
+        Inserta o mueve un vehículo. Devuelve True si el índice ha cambiado
+        (alta o nueva posición); los atributos se actualizan siempre.
+        """
+        with self._lock:
+            return self._upsert(vehicle_id, lat, lon, attrs)
+
+    def _upsert(self, vehicle_id: Any, lat: float, lon: float, attrs: Dict[str, Any]) -> bool:
+        current = self._vehicles.get(vehicle_id)
+        if current is not None and current[2] == lat and current[3] == lon:
+            if attrs:
+                current[5].update(attrs)
+            return False
+        x, y = self._project(lat, lon)
+        cell = self._cell(x, y)
+        if current is not None and current[4] != cell:
+            self._discard(vehicle_id, current[4])
+        if current is None or current[4] != cell:
+            self._cells.setdefault(cell, set()).add(vehicle_id)
+        merged = current[5] if current is not None else {}
+        merged.update(attrs)
+        self._vehicles[vehicle_id] = (x, y, lat, lon, cell, merged)
+        return True
+
+    def _discard(self, vehicle_id: Any, cell: Cell) -> None:
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(vehicle_id)
+            if not members:
+                del self._cells[cell]
+
+    def remove(self, vehicle_id: Any) -> bool:
+        """Elimina un vehículo. Devuelve False si no estaba indexado."""
+        with self._lock:
+            current = self._vehicles.pop(vehicle_id, None)
+            if current is None:
+                return False
+            self._discard(vehicle_id, current[4])
+            self._stops.pop(vehicle_id, None)
+            return True
+
+    def update_from_columns(self, arrivals: Any, evict_missing: bool = True,
+                            stops: Optional[Iterable[Any]] = None) -> Dict[str, int]:
+        """
+        Sincroniza el índice con las columnas de un `ColumnarArrivals`.
+
+        Un vehículo aparece una vez por cada parada a la que se acerca; se
+        indexa una sola vez con su línea y destino. Las posiciones NaN se
+        ignoran. Con `evict_missing` se eliminan los vehículos que no están en
+        este ciclo (ver `retain` para el significado de `stops`). Devuelve los
+        contadores ``{"added", "moved", "removed"}``.
+        """
+        stats = {"added": 0, "moved": 0, "removed": 0}
+        seen: Set[Any] = set()
+        lats, lons, ids = arrivals.lat, arrivals.lon, arrivals.vehicle_id
+        lines, destinations, stop_ids = arrivals.line, arrivals.destination, arrivals.stop
+        with self._lock:
+            for i in range(len(ids)):
+                vid = ids[i]
+                if vid is None:
+                    continue
+                lat, lon = lats[i], lons[i]
+                if lat != lat or lon != lon:
+                    continue
+                self._seen_at(vid, stop_ids[i])
+                if vid in seen:
+                    continue
+                seen.add(vid)
+                existed = vid in self._vehicles
+                if self._upsert(vid, lat, lon, {"line": lines[i], "destination": destinations[i]}):
+                    stats["moved" if existed else "added"] += 1
+            if evict_missing:
+                stats["removed"] = self._retain(seen, stops)
+        return stats
+
+    def _seen_at(self, vehicle_id: Any, stop: Any) -> None:
+        entry = self._stops.get(vehicle_id)
+        if entry is None or entry[0] != self._cycle:
+            entry = self._stops[vehicle_id] = (self._cycle, set())
+        entry[1].add(str(stop))
+
+    def retain(self, vehicle_ids: Iterable[Any], stops: Optional[Iterable[Any]] = None) -> int:
+        """
+        Elimina los vehículos que no están en `vehicle_ids` y cierra el ciclo.
+        Devuelve cuántos.
+
+        Con `stops` (paradas consultadas con éxito) sólo se eliminan los
+        vehículos cuyas paradas del último ciclo en que se vieron están todas
+        en `stops`; los de paradas que han fallado se conservan.
+        """
+        keep = set(vehicle_ids)
+        with self._lock:
+            return self._retain(keep, stops)
+
+    def _retain(self, keep: Set[Any], stops: Optional[Iterable[Any]]) -> int:
+        fetched = None if stops is None else {str(stop) for stop in stops}
+        missing = []
+        for vid in self._vehicles:
+            if vid in keep:
+                continue
+            if fetched is not None:
+                entry = self._stops.get(vid)
+                if entry is not None and not entry[1] <= fetched:
+                    continue
+            missing.append(vid)
+        for vid in missing:
+            self._discard(vid, self._vehicles.pop(vid)[4])
+            self._stops.pop(vid, None)
+        self._cycle += 1
+        return len(missing)
+
+    # --- consultas ---
+
+    def get(self, vehicle_id: Any) -> Optional[Dict[str, Any]]:
+        """Posición y atributos de un vehículo, o None."""
+        current = self._vehicles.get(vehicle_id)
+        return None if current is None else self._result(vehicle_id, current)
+
+    @staticmethod
+    def _result(vehicle_id: Any, entry: Tuple, distance: Optional[float] = None) -> Dict[str, Any]:
+        result = {"vehicle_id": vehicle_id, "lat": entry[2], "lon": entry[3], **entry[5]}
+        if distance is not None:
+            result["distance_m"] = distance
+        return result
+
+    def _cells_in(self, x0: float, y0: float, x1: float, y1: float) -> Iterable[Set[Any]]:
+        cx0, cy0 = self._cell(x0, y0)
+        cx1, cy1 = self._cell(x1, y1)
+        # Si el rectángulo abarca más celdas de las que hay ocupadas se recorren éstas
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self._cells):
+            return [m for (cx, cy), m in self._cells.items() if cx0 <= cx <= cx1 and cy0 <= cy <= cy1]
+        cells = self._cells
+        return [cells[(cx, cy)] for cx in range(cx0, cx1 + 1) for cy in range(cy0, cy1 + 1) if (cx, cy) in cells]
+
+    def within_bbox(self, min_lat: float, min_lon: float, max_lat: float, max_lon: float) -> List[Dict[str, Any]]:
+        """Vehículos con ``min_lat <= lat <= max_lat`` y ``min_lon <= lon <= max_lon``."""
+        x0, y0 = self._project(min_lat, min_lon)
+        x1, y1 = self._project(max_lat, max_lon)
+        with self._lock:
+            vehicles = self._vehicles
+            return [
+                self._result(vid, vehicles[vid])
+                for members in self._cells_in(x0, y0, x1, y1)
+                for vid in members
+                if min_lat <= vehicles[vid][2] <= max_lat and min_lon <= vehicles[vid][3] <= max_lon
+            ]
+
+    def within_radius(self, lat: float, lon: float, radius_m: float) -> List[Dict[str, Any]]:
+        """Vehículos a menos de `radius_m` metros, ordenados por distancia (`distance_m`)."""
+        x, y = self._project(lat, lon)
+        found = []
+        with self._lock:
+            vehicles = self._vehicles
+            for members in self._cells_in(x - radius_m, y - radius_m, x + radius_m, y + radius_m):
+                for vid in members:
+                    entry = vehicles[vid]
+                    d = math.hypot(entry[0] - x, entry[1] - y)
+                    if d <= radius_m:
+                        found.append((d, vid, entry))
+        found.sort(key=lambda t: t[0])
+        return [self._result(vid, entry, d) for d, vid, entry in found]
+
+    def nearest(self, lat: float, lon: float, k: int = 1, max_radius_m: Optional[float] = None) -> List[Dict[str, Any]]:
+        """
+        Los `k` vehículos más cercanos (con `distance_m`), opcionalmente
+        limitados a `max_radius_m`.
+
+        Recorre anillos de celdas alrededor del punto y se detiene cuando el
+        anillo siguiente ya no puede contener nada más cerca que el k-ésimo.
+        """
+        if k <= 0:
+            return []
+        x, y = self._project(lat, lon)
+        cx, cy = self._cell(x, y)
+        limit = math.inf if max_radius_m is None else max_radius_m
+        heap: List[Tuple[float, int, Any]] = []  # max-heap por -distancia
+        with self._lock:
+            vehicles, cells = self._vehicles, self._cells
+            remaining = len(vehicles)
+            ring = 0
+            while remaining > 0:
+                # Distancia mínima posible a cualquier punto del anillo `ring`
+                ring_min = max(0.0, (ring - 1) * self.cell_m)
+                if ring_min > limit or (len(heap) == k and ring_min > -heap[0][0]):
+                    break
+                if 8 * ring > len(cells):
+                    # Anillo mayor que las celdas ocupadas (p. ej. un punto atípico
+                    # lejano): se recorren éstas directamente y se termina
+                    ring_members = [
+                        m for (kx, ky), m in cells.items() if max(abs(kx - cx), abs(ky - cy)) >= ring
+                    ]
+                    remaining = 0
+                else:
+                    ring_members = [cells[key] for key in _ring_cells(cx, cy, ring) if key in cells]
+                for members in ring_members:
+                    remaining -= len(members)
+                    for vid in members:
+                        entry = vehicles[vid]
+                        d = math.hypot(entry[0] - x, entry[1] - y)
+                        if d > limit:
+                            continue
+                        item = (-d, id(vid), vid)
+                        if len(heap) < k:
+                            heapq.heappush(heap, item)
+                        elif d < -heap[0][0]:
+                            heapq.heapreplace(heap, item)
+                ring += 1
+            heap.sort(key=lambda item: -item[0])
+            return [self._result(vid, vehicles[vid], -nd) for nd, _, vid in heap]
+
+
+def _ring_cells(cx: int, cy: int, ring: int) -> Iterable[Cell]:
+    """Celdas a distancia de Chebyshev exactamente `ring` de ``(cx, cy)``."""
+    if ring == 0:
+        yield cx, cy
+        return
+    for dx in range(-ring, ring + 1):
+        yield cx + dx, cy - ring
+        yield cx + dx, cy + ring
+    for dy in range(-ring + 1, ring):
+        yield cx - ring, cy + dy
+        yield cx + ring, cy + dy
@@ -0,0 +1,131 @@
+# python
+"""
+Caché persistente de metadatos estáticos de paradas de EMT.
+
+La descripción de una parada (nombre, coordenadas, dirección y líneas que la
+sirven) apenas cambia, pero la API la devuelve en cada consulta de llegadas
+si se pide `Text_StopRequired_YN: "Y"`. Este módulo proporciona
+`StopMetadataCache`, que guarda esa descripción en disco con un TTL largo
+para que `EMTClient` sólo la pida cuando falta o caduca y, en las consultas
+habituales, pida únicamente las estimaciones y una los metadatos en local.
+
+Variables de entorno utilizadas (opcional):
+- STOP_METADATA_CACHE: ruta del fichero JSON de la caché.
+- STOP_METADATA_TTL_S: validez de cada parada en segundos (por defecto 7 días).
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional
+
+from token_store import file_lock
+
+DEFAULT_STOP_METADATA_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "madrid-mobility", "emt_stops.json"
+)
+DEFAULT_STOP_METADATA_TTL = 7 * 24 * 3600
+
+# Campos de cada línea de `StopInfo.lines` que se conservan
+_LINE_FIELDS = ("label", "nameA", "nameB", "headerA", "headerB", "to", "minFreq", "maxFreq")
+
+
+def parse_stop_info(stop_info: Dict[str, Any]) -> Dict[str, Any]:
+    """Normaliza un elemento `StopInfo` de la respuesta de llegadas."""
+    coords = (stop_info.get("geometry") or {}).get("coordinates") or [None, None]
+    lines = {}
+    for line in stop_info.get("lines") or []:
+        key = str(line.get("line") or line.get("label") or "")
+        if key:
+            lines[key] = {f: line[f] for f in _LINE_FIELDS if f in line}
+    return {
+        "name": stop_info.get("stopName"),
+        "lat": coords[1] if len(coords) > 1 else None,
+        "lon": coords[0] if coords else None,
+        "address": stop_info.get("postalAddress"),
+        "lines": lines,
+    }
+
+
+class StopMetadataCache:
+    """
+    Metadatos por parada con TTL, en memoria y persistidos en disco.
+
+    Args:
+        path (Optional[str]): Fichero JSON; por defecto `STOP_METADATA_CACHE`
+            o `~/.cache/madrid-mobility/emt_stops.json`.
+        ttl (Optional[float]): Segundos de validez de cada parada.
+    """
+
+    def __init__(self, path: Optional[str] = None, ttl: Optional[float] = None):
+        self.path = path or os.getenv("STOP_METADATA_CACHE", DEFAULT_STOP_METADATA_CACHE)
+        self.ttl = ttl if ttl is not None else float(os.getenv("STOP_METADATA_TTL_S", DEFAULT_STOP_METADATA_TTL))
+        self._entries: Optional[Dict[str, Dict[str, Any]]] = None
+        self._lock = threading.Lock()
+
+    def _loaded(self) -> Dict[str, Dict[str, Any]]:
+        if self._entries is None:
+            self._entries = self._read()
+        return self._entries
+
+    def _read(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.path, "r", encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return {}
+        stops = data.get("stops") if isinstance(data, dict) else None
+        return stops if isinstance(stops, dict) else {}
+
+    def get(self, stop_id: str, now: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Metadatos vigentes de `stop_id`, o None si faltan o han caducado."""
+        with self._lock:
+            entry = self._loaded().get(str(stop_id))
+        if entry is None:
+            return None
+        if entry.get("fetched_at", 0) + self.ttl <= (time.time() if now is None else now):
+            return None
+        return entry
+
+    def put(self, stop_id: str, stop_info: Dict[str, Any]) -> Dict[str, Any]:
+        """Guarda el `StopInfo` de la API para `stop_id` y lo persiste."""
+        entry = parse_stop_info(stop_info)
+        entry["fetched_at"] = time.time()
+        with self._lock:
+            self._loaded()[str(stop_id)] = entry
+            try:
+                self._save(str(stop_id), entry)
+            except OSError:
+                # La caché es una optimización: si no se puede escribir seguimos en memoria
+                pass
+        return entry
+
+    def _save(self, stop_id: str, entry: Dict[str, Any]) -> None:
+        # Se relee bajo bloqueo para no perder lo que hayan guardado otros procesos (shards)
+        directory = os.path.dirname(self.path) or "."
+        with file_lock(self.path + ".lock"):
+            merged = self._read()
+            merged[stop_id] = entry
+            self._entries.update({k: v for k, v in merged.items() if k not in self._entries})
+            fd, tmp = tempfile.mkstemp(dir=directory, prefix=".emt_stops.")
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                    json.dump({"stops": merged}, fh, ensure_ascii=False)
+                os.replace(tmp, self.path)
+            except OSError:
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                raise
+
+    def join(self, stop_id: str, arrivals: Iterable[Dict[str, Any]]) -> None:
+        """Añade `stop_name` y `stop_coords` de la caché a cada llegada de `stop_id`."""
+        entry = self.get(stop_id)
+        if entry is None:
+            return
+        # Un único dict de coordenadas por parada, compartido por sus llegadas
+        coords = {"lat": entry.get("lat"), "lon": entry.get("lon")}
+        for arrival in arrivals:
+            arrival["stop_name"] = entry.get("name")
+            arrival["stop_coords"] = coords
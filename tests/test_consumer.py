@@ -0,0 +1,113 @@
+# python
+"""
+Pruebas de `consumer.BatchConsumer` contra `local_broker.InMemoryBroker` y
+`local_mongo.InMemoryMongoClient`, sin RabbitMQ ni MongoDB.
+
+Uso::
+
+    python -m unittest discover -s tests -t .
+"""
+
+import threading
+import time
+import unittest
+
+import pika
+
+from arrival_store import ArrivalStore
+from consumer import BatchConsumer
+from local_broker import InMemoryBroker
+from local_mongo import InMemoryMongoClient
+from rabbit_publisher import DEFAULT_QUEUE, RabbitPublisher
+
+STOPS_PER_MESSAGE = 3
+
+
+def _payload(n: int):
+    return [{
+        "line": "27",
+        "stops": [
+            {"line": "27", "stop": str(stop), "vehicle_id": n, "estimateArrive": 60 * stop,
+             "coords": {"lat": 40.4, "lon": -3.7}}
+            for stop in range(STOPS_PER_MESSAGE)
+        ],
+    }]
+
+
+class BatchConsumerTest(unittest.TestCase):
+    def setUp(self):
+        self.broker = InMemoryBroker()
+        self.store = ArrivalStore(InMemoryMongoClient()["test"])
+        self.store.ensure_schema()
+        self.arrivals = self.store.arrivals
+        self.acked_at_write = []
+        self.consumer = BatchConsumer(
+            self._write, connection_factory=self.broker.connection_factory,
+            batch_size=4, batch_timeout=0.05,
+        )
+        self.publisher = RabbitPublisher(connection_factory=self.broker.connection_factory)
+
+    def _write(self, docs):
+        # Antes de cada escritura, todo lo confirmado debe estar ya en MongoDB
+        self.acked_at_write.append((self.broker.acked, self.arrivals.count_documents({})))
+        return self.store.insert_batch(docs)
+
+    def _publish(self, n: int) -> None:
+        for i in range(n):
+            self.assertTrue(self.publisher.publish(_payload(i)))
+
+    def _run_until(self, done, timeout: float = 10.0) -> None:
+        thread = threading.Thread(target=self.consumer.run, daemon=True)
+        thread.start()
+        deadline = time.monotonic() + timeout
+        while not done() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.consumer.stop()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive())
+
+    def test_writes_and_acks_every_message(self):
+        self._publish(10)
+        self._run_until(lambda: self.broker.acked == 10)
+
+        self.assertEqual(self.broker.acked, 10)
+        self.assertEqual(self.broker.pending(DEFAULT_QUEUE), 0)
+        self.assertEqual(self.arrivals.count_documents({}), 10 * STOPS_PER_MESSAGE)
+        self.assertEqual(self.broker.dead_lettered, [])
+
+    def test_acks_only_after_the_write(self):
+        self._publish(10)
+        self._run_until(lambda: self.broker.acked == 10)
+
+        self.assertTrue(self.acked_at_write)
+        for acked, stored in self.acked_at_write:
+            self.assertEqual(acked * STOPS_PER_MESSAGE, stored)
+
+    def test_failed_insert_requeues_the_batch(self):
+        self.arrivals.fail_next_writes = 1
+        self._publish(6)
+        self._run_until(lambda: self.broker.acked == 6)
+
+        # El lote fallido vuelve a la cola y se escribe una sola vez al reintentar
+        self.assertEqual(self.arrivals.fail_next_writes, 0)
+        self.assertGreaterEqual(len(self.acked_at_write), 2)
+        self.assertEqual(self.acked_at_write[0], (0, 0))
+        self.assertEqual(self.broker.acked, 6)
+        self.assertEqual(self.broker.pending(DEFAULT_QUEUE), 0)
+        self.assertEqual(self.arrivals.count_documents({}), 6 * STOPS_PER_MESSAGE)
+
+    def test_undecodable_message_is_dead_lettered(self):
+        self._publish(2)
+        self.broker.route(DEFAULT_QUEUE, b"\xff no es json", pika.BasicProperties(content_type="application/json"))
+        self._publish(1)
+        self._run_until(lambda: self.broker.acked == 3 and len(self.broker.dead_lettered) == 1)
+
+        self.assertEqual(len(self.broker.dead_lettered), 1)
+        self.assertEqual(self.broker.dead_lettered[0][0], b"\xff no es json")
+        self.assertEqual(self.broker.acked, 3)
+        self.assertEqual(self.broker.pending(DEFAULT_QUEUE), 0)
+        self.assertEqual(self.arrivals.count_documents({}), 3 * STOPS_PER_MESSAGE)
+
+
+if __name__ == "__main__":
+    unittest.main()
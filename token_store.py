@@ -0,0 +1,134 @@
+# python
+"""
+Almacén persistente del token de acceso de EMT.
+
+Este módulo proporciona la clase `TokenStore`, que guarda en disco el token
+obtenido en el login junto con su instante de caducidad, para que ejecuciones
+sucesivas (o varios procesos en paralelo) lo reutilicen en lugar de volver a
+autenticarse contra `LOGIN_URL`.
+
+El acceso está protegido con un bloqueo de fichero (`fcntl` en Linux,
+`msvcrt` en Windows) para que sólo un proceso haga login a la vez.
+
+Variables de entorno utilizadas (opcional):
+- EMT_TOKEN_CACHE: ruta del fichero de caché del token.
+"""
+
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+DEFAULT_TOKEN_CACHE = os.path.join(
+    os.path.expanduser("~"), ".cache", "madrid-mobility", "emt_token.json"
+)
+
+
+@contextmanager
+def file_lock(lock_path: str, blocking: bool = True) -> Iterator[bool]:
+    """
+    Bloqueo exclusivo entre procesos sobre `lock_path` (se crea si no existe).
+
+    Con `blocking=False` no espera: produce False si otro proceso ya lo tiene
+    y True si se ha adquirido.
+    """
+    os.makedirs(os.path.dirname(lock_path) or ".", exist_ok=True)
+    with open(lock_path, "a+b") as fh:
+        try:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            else:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+        except OSError:
+            if blocking:
+                raise
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+            else:
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class TokenStore:
+    """
+    Caché en disco de un token con caducidad, segura entre hilos y procesos.
+
+    Args:
+        path (Optional[str]): Ruta del fichero JSON; por defecto
+            `EMT_TOKEN_CACHE` o `~/.cache/madrid-mobility/emt_token.json`.
+
+    Attributes:
+        path (str): Fichero donde se persiste el token.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path or os.getenv("EMT_TOKEN_CACHE", DEFAULT_TOKEN_CACHE)
+        self._lock_path = self.path + ".lock"
+        self._thread_lock = threading.RLock()
+
+    @contextmanager
+    def lock(self) -> Iterator[None]:
+        """Bloqueo exclusivo entre hilos y procesos sobre el fichero de caché."""
+        with self._thread_lock, file_lock(self._lock_path):
+            yield
+
+    def load(self, account: str) -> Optional[Dict[str, Any]]:
+        """
+        Devuelve `{"access_token", "expires_at"}` para `account` o None si no
+        hay token guardado o el fichero está corrupto.
+        """
+        try:
+            with open(self.path, "r", encoding="utf-8") as fh:
+                data = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if not isinstance(data, dict) or data.get("account") != account:
+            return None
+        if not data.get("access_token") or not isinstance(data.get("expires_at"), (int, float)):
+            return None
+        return data
+
+    def save(self, account: str, access_token: str, expires_at: float) -> None:
+        """Persiste el token de forma atómica (fichero temporal + rename)."""
+        directory = os.path.dirname(self.path) or "."
+        os.makedirs(directory, exist_ok=True)
+        data = {"account": account, "access_token": access_token, "expires_at": expires_at}
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=".emt_token.")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as fh:
+                json.dump(data, fh)
+            os.chmod(tmp, 0o600)
+            os.replace(tmp, self.path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def clear(self) -> None:
+        """Elimina el token persistido (p. ej. tras un fallo de autenticación)."""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def is_fresh(expires_at: Optional[float], margin: float, now: Optional[float] = None) -> bool:
+    """True si el token sigue siendo válido durante al menos `margin` segundos."""
+    if expires_at is None:
+        return False
+    return expires_at - margin > (time.time() if now is None else now)
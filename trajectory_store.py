@@ -0,0 +1,255 @@
+# python
+"""
+Trayectorias recientes de cada vehículo en buffers circulares.
+
+Este módulo proporciona la clase `TrajectoryStore`, que conserva entre ciclos
+las últimas `capacity` muestras ``(ts, lat, lon, distance, estimateArrive)``
+de cada `vehicle_id` para derivar velocidad y aceleración sin releer la base
+de datos.
+
+La memoria se reserva una sola vez: cada campo es un único `array('d')` de
+``max_vehicles * capacity`` posiciones y cada vehículo ocupa un hueco (slot)
+fijo de `capacity` muestras contiguas. Añadir una muestra es O(1) (se escribe
+en la cabeza del buffer y se sobrescribe la más antigua); los vehículos que
+llevan `stale_after` segundos sin verse liberan su hueco y, si la flota llena
+todos los huecos, se recicla el del vehículo visto hace más tiempo. El
+consumo es, por tanto, constante por mucho que dure el proceso.
+
+Variables de entorno utilizadas (opcional):
+- TRAJECTORIES: "1" para que `main` mantenga el almacén en modo daemon.
+- TRAJECTORY_CAPACITY: muestras por vehículo (por defecto 32).
+- TRAJECTORY_MAX_VEHICLES: vehículos simultáneos (por defecto 4096).
+- TRAJECTORY_STALE_S: segundos sin ver un vehículo antes de olvidarlo (por defecto 900).
+"""
+
+import math
+import os
+import threading
+from array import array
+from typing import Any, Dict, List, Optional
+
+DEFAULT_CAPACITY = 32
+DEFAULT_MAX_VEHICLES = 4096
+DEFAULT_STALE_AFTER = 900.0
+
+FIELDS = ("ts", "lat", "lon", "distance", "estimate_arrive")
+
+# Radio medio terrestre en metros (aproximación equirrectangular)
+_EARTH_RADIUS_M = 6371000.0
+_NAN = float("nan")
+
+
+class TrajectoryStore:
+    """
+    Buffers circulares de muestras por vehículo sobre arrays preasignados.
+
+    Args:
+        capacity (Optional[int]): Muestras por vehículo.
+        max_vehicles (Optional[int]): Huecos disponibles.
+        stale_after (Optional[float]): Segundos sin muestras tras los que se
+            libera el hueco de un vehículo.
+    """
+
+    def __init__(
+        self,
+        capacity: Optional[int] = None,
+        max_vehicles: Optional[int] = None,
+        stale_after: Optional[float] = None,
+    ):
+        self.capacity = int(capacity or os.getenv("TRAJECTORY_CAPACITY", DEFAULT_CAPACITY))
+        self.max_vehicles = int(max_vehicles or os.getenv("TRAJECTORY_MAX_VEHICLES", DEFAULT_MAX_VEHICLES))
+        self.stale_after = float(
+            stale_after if stale_after is not None else os.getenv("TRAJECTORY_STALE_S", DEFAULT_STALE_AFTER)
+        )
+        size = self.max_vehicles * self.capacity
+        self._columns: Dict[str, array] = {f: array("d", [_NAN]) * size for f in FIELDS}
+        # Por hueco: siguiente posición de escritura, muestras válidas y última vez visto
+        self._head = array("l", [0]) * self.max_vehicles
+        self._count = array("l", [0]) * self.max_vehicles
+        self._last_seen = array("d", [0.0]) * self.max_vehicles
+        self._slots: Dict[Any, int] = {}
+        self._owners: List[Any] = [None] * self.max_vehicles
+        self._free = list(range(self.max_vehicles - 1, -1, -1))
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def __contains__(self, vehicle_id: Any) -> bool:
+        return vehicle_id in self._slots
+
+    def nbytes(self) -> int:
+        """Bytes reservados por los arrays (fijos desde la construcción)."""
+        arrays = list(self._columns.values()) + [self._head, self._count, self._last_seen]
+        return sum(a.itemsize * len(a) for a in arrays)
+
+    # --- escritura ---
+
+    def _slot_for(self, vehicle_id: Any) -> int:
+        slot = self._slots.get(vehicle_id)
+        if slot is not None:
+            return slot
+        if self._free:
+            slot = self._free.pop()
+        else:
+            # Sin huecos libres se recicla el del vehículo visto hace más tiempo
+            last_seen = self._last_seen
+            slot = min(range(self.max_vehicles), key=last_seen.__getitem__)
+            del self._slots[self._owners[slot]]
+        self._slots[vehicle_id] = slot
+        self._owners[slot] = vehicle_id
+        self._head[slot] = 0
+        self._count[slot] = 0
+        return slot
+
+    def append(self, vehicle_id: Any, ts: float, lat: float, lon: float,
+               distance: float = _NAN, estimate_arrive: float = _NAN) -> bool:
+        """
+        Añade una muestra en O(1). Las muestras con `ts` no posterior a la
+        última del vehículo se descartan (devuelve False).
+        """
+        with self._lock:
+            return self._append(vehicle_id, ts, (ts, lat, lon, distance, estimate_arrive))
+
+    def _append(self, vehicle_id: Any, ts: float, values: tuple, replace_nearer: bool = False) -> bool:
+        slot = self._slot_for(vehicle_id)
+        cap = self.capacity
+        head, count = self._head[slot], self._count[slot]
+        if count:
+            last = slot * cap + (head - 1) % cap
+            last_ts = self._columns["ts"][last]
+            if replace_nearer and ts == last_ts and values[4] < self._columns["estimate_arrive"][last]:
+                # Mismo instante con una parada más próxima: se corrige la última muestra
+                for column, value in zip(self._columns.values(), values):
+                    column[last] = value
+                return True
+            if ts <= last_ts:
+                return False
+        pos = slot * cap + head
+        for column, value in zip(self._columns.values(), values):
+            column[pos] = value
+        self._head[slot] = (head + 1) % cap
+        if count < cap:
+            self._count[slot] = count + 1
+        self._last_seen[slot] = ts
+        return True
+
+    def update_from_columns(self, arrivals: Any, ts: float) -> int:
+        """
+        Añade una muestra por vehículo a partir de un `ColumnarArrivals`.
+
+        Un vehículo aparece una vez por parada a la que se acerca; se toma la
+        fila con menor `estimate_arrive` (su próxima parada), de modo que
+        `distance` y `estimate_arrive` se refieren siempre a la parada
+        inmediata. Si el vehículo ya tiene una muestra con el mismo `ts`
+        (pipeline en streaming, una llamada por parada) se sustituye cuando la
+        nueva fila está más próxima. Devuelve las muestras añadidas o corregidas.
+        """
+        best: Dict[Any, int] = {}
+        ids, lats, lons, etas = arrivals.vehicle_id, arrivals.lat, arrivals.lon, arrivals.estimate_arrive
+        for i in range(len(ids)):
+            vid = ids[i]
+            if vid is None or lats[i] != lats[i] or lons[i] != lons[i]:
+                continue
+            j = best.get(vid)
+            if j is None or etas[i] < etas[j]:
+                best[vid] = i
+        distances = arrivals.distance
+        added = 0
+        with self._lock:
+            for vid, i in best.items():
+                added += self._append(vid, ts, (ts, lats[i], lons[i], distances[i], etas[i]), replace_nearer=True)
+        return added
+
+    def evict_stale(self, now: float) -> int:
+        """Libera los huecos de vehículos sin muestras desde hace `stale_after` segundos."""
+        cutoff = now - self.stale_after
+        with self._lock:
+            stale = [vid for vid, slot in self._slots.items() if self._last_seen[slot] < cutoff]
+            for vid in stale:
+                slot = self._slots.pop(vid)
+                self._owners[slot] = None
+                self._count[slot] = 0
+                self._free.append(slot)
+        return len(stale)
+
+    # --- lectura ---
+
+    def _window(self, slot: int) -> Dict[str, array]:
+        cap, head, count = self.capacity, self._head[slot], self._count[slot]
+        base = slot * cap
+        start = (head - count) % cap
+        out = {}
+        for name, column in self._columns.items():
+            if start + count <= cap:
+                out[name] = column[base + start: base + start + count]
+            else:
+                out[name] = column[base + start: base + cap] + column[base: base + head]
+        return out
+
+    def samples(self, vehicle_id: Any) -> Optional[Dict[str, array]]:
+        """Muestras del vehículo en orden temporal, por columnas (`FIELDS`)."""
+        with self._lock:
+            slot = self._slots.get(vehicle_id)
+            return None if slot is None else self._window(slot)
+
+    def speeds(self, vehicle_id: Any) -> array:
+        """Velocidades en m/s entre muestras consecutivas (``len(samples) - 1``)."""
+        window = self.samples(vehicle_id)
+        return array("d") if window is None else _speeds(window)
+
+    def accelerations(self, vehicle_id: Any) -> array:
+        """Aceleraciones en m/s² entre velocidades consecutivas."""
+        window = self.samples(vehicle_id)
+        return array("d") if window is None else _accelerations(window["ts"], _speeds(window))
+
+    def kinematics(self) -> Dict[Any, Dict[str, float]]:
+        """
+        Última velocidad, aceleración y rumbo (grados desde el norte) de cada
+        vehículo con al menos dos muestras, calculados en una pasada sobre
+        los arrays sin copiar las ventanas.
+        """
+        cap = self.capacity
+        ts, lat, lon = self._columns["ts"], self._columns["lat"], self._columns["lon"]
+        result: Dict[Any, Dict[str, float]] = {}
+        with self._lock:
+            for vid, slot in self._slots.items():
+                count = self._count[slot]
+                if count < 2:
+                    continue
+                base, head = slot * cap, self._head[slot]
+                i1 = base + (head - 1) % cap
+                i0 = base + (head - 2) % cap
+                dt = ts[i1] - ts[i0]
+                dx, dy = _delta_m(lat[i0], lon[i0], lat[i1], lon[i1])
+                speed = math.hypot(dx, dy) / dt
+                entry = {"speed_ms": speed, "heading_deg": math.degrees(math.atan2(dx, dy)) % 360.0}
+                if count >= 3:
+                    im = base + (head - 3) % cap
+                    mx, my = _delta_m(lat[im], lon[im], lat[i0], lon[i0])
+                    prev_speed = math.hypot(mx, my) / (ts[i0] - ts[im])
+                    entry["accel_ms2"] = (speed - prev_speed) / ((ts[i1] - ts[im]) / 2.0)
+                result[vid] = entry
+        return result
+
+
+def _delta_m(lat0: float, lon0: float, lat1: float, lon1: float):
+    x = math.radians(lon1 - lon0) * math.cos(math.radians((lat0 + lat1) / 2))
+    y = math.radians(lat1 - lat0)
+    return x * _EARTH_RADIUS_M, y * _EARTH_RADIUS_M
+
+
+def _speeds(window: Dict[str, array]) -> array:
+    ts, lat, lon = window["ts"], window["lat"], window["lon"]
+    return array("d", (
+        math.hypot(*_delta_m(lat[i], lon[i], lat[i + 1], lon[i + 1])) / (ts[i + 1] - ts[i])
+        for i in range(len(ts) - 1)
+    ))
+
+
+def _accelerations(ts: array, speeds: array) -> array:
+    # Cada velocidad corresponde al punto medio de su intervalo
+    return array("d", (
+        (speeds[i + 1] - speeds[i]) / ((ts[i + 2] - ts[i]) / 2.0)
+        for i in range(len(speeds) - 1)
+    ))
@@ -0,0 +1,236 @@
+# python
+"""
+Clima por parada a partir de varias estaciones de AEMET.
+
+Este módulo proporciona la clase `StationWeather`, que sustituye la lectura
+única de la estación 3195 por la estación más cercana a cada parada (o una
+interpolación por distancia inversa, IDW, de las `k` más cercanas):
+
+- `update(records)` incorpora la respuesta del endpoint masivo de AEMET
+  (``/observacion/convencional/todas``, una sola llamada para todas las
+  estaciones). Se guarda la última observación de cada estación dentro de
+  `radius_km` del centro; una estación que falte en una descarga conserva su
+  lectura anterior hasta `max_age` segundos (caché por estación).
+- La asignación parada → estaciones se calcula una sola vez por parada, la
+  primera vez que se ven sus coordenadas (`stop_coords`, ver
+  `stop_metadata.py`), y sólo se rehace si cambia el conjunto de estaciones.
+- `weather_for(arrival)` es una búsqueda en diccionario: las paradas con la
+  misma estación comparten el mismo dict de clima, de modo que el esquema v2
+  lo deduplica en `weathers`.
+
+Cada dict de clima es el de `WeatherBuilder` más ``station_id`` (o
+``stations`` con los pesos en modo IDW).
+
+Variables de entorno utilizadas por `main` (opcional):
+- WEATHER_MODE: "station" (una estación, por defecto), "nearest" o "idw".
+- WEATHER_STATION_RADIUS_KM: radio en km de las estaciones candidatas (por defecto 50).
+- WEATHER_IDW_K: estaciones que intervienen en la interpolación IDW (por defecto 3).
+"""
+
+import math
+import threading
+import time
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+from weather_builder import WeatherBuilder
+
+STATION = "station"
+NEAREST = "nearest"
+IDW = "idw"
+
+# Puerta del Sol
+MADRID_CENTER = (40.4168, -3.7038)
+DEFAULT_RADIUS_KM = 50.0
+DEFAULT_IDW_K = 3
+DEFAULT_IDW_POWER = 2.0
+DEFAULT_MAX_AGE = 6 * 3600
+# Campos numéricos que se interpolan en modo IDW
+_IDW_FIELDS = ("temperature", "humidity", "wind_speed", "precipitation")
+
+_EARTH_RADIUS_KM = 6371.0
+
+
+def _distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    x = math.radians(lon2 - lon1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return math.hypot(x, y) * _EARTH_RADIUS_KM
+
+
+def _coords(value: Any) -> Optional[Tuple[float, float]]:
+    try:
+        return float(value["lat"]), float(value["lon"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+class StationWeather:
+    """
+    Observaciones por estación y asignación de cada parada a sus estaciones.
+
+    Args:
+        mode (str): `NEAREST` o `IDW`.
+        radius_km (float): Radio alrededor de `center` de las estaciones candidatas.
+        k (int): Estaciones de la interpolación IDW.
+        power (float): Exponente de la distancia en IDW.
+        max_age (float): Segundos que se conserva la lectura de una estación
+            que ha dejado de aparecer en las descargas.
+        center (Tuple[float, float]): Centro (lat, lon) del área.
+    """
+
+    def __init__(
+        self,
+        mode: str = NEAREST,
+        radius_km: float = DEFAULT_RADIUS_KM,
+        k: int = DEFAULT_IDW_K,
+        power: float = DEFAULT_IDW_POWER,
+        max_age: float = DEFAULT_MAX_AGE,
+        center: Tuple[float, float] = MADRID_CENTER,
+    ):
+        if mode not in (NEAREST, IDW):
+            raise ValueError(f"Modo de clima no soportado: {mode}")
+        self.mode = mode
+        self.radius_km = radius_km
+        self.k = 1 if mode == NEAREST else max(1, k)
+        self.power = power
+        self.max_age = max_age
+        self.center = center
+        # idema -> {"lat", "lon", "fint", "weather", "received_at"}
+        self._stations: Dict[str, Dict[str, Any]] = {}
+        # parada -> ((idema, peso), ...)
+        self._assignments: Dict[str, Tuple[Tuple[str, float], ...]] = {}
+        # parada -> dict de clima interpolado (IDW), válido hasta la siguiente actualización
+        self._blended: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._stations)
+
+    # --- observaciones ---
+
+    def update(self, records: Iterable[Dict[str, Any]], now: Optional[float] = None) -> int:
+        """
+        Incorpora observaciones de AEMET (una o varias por estación) y devuelve
+        cuántas estaciones han cambiado de lectura.
+        """
+        now = time.time() if now is None else now
+        latest: Dict[str, Dict[str, Any]] = {}
+        for record in records or []:
+            idema = record.get("idema") if isinstance(record, dict) else None
+            coords = _coords(record) if idema else None
+            if coords is None or _distance_km(*self.center, *coords) > self.radius_km:
+                continue
+            previous = latest.get(idema)
+            if previous is None or str(record.get("fint") or "") >= str(previous.get("fint") or ""):
+                latest[idema] = record
+
+        changed = 0
+        with self._lock:
+            stations_before = set(self._stations)
+            for idema, record in latest.items():
+                current = self._stations.get(idema)
+                if current is not None and current["fint"] == record.get("fint"):
+                    current["received_at"] = now
+                    continue
+                weather = WeatherBuilder().from_aemet(record).build()
+                weather["station_id"] = idema
+                self._stations[idema] = {
+                    "lat": float(record["lat"]),
+                    "lon": float(record["lon"]),
+                    "fint": record.get("fint"),
+                    "weather": weather,
+                    "received_at": now,
+                }
+                changed += 1
+            for idema in [i for i, s in self._stations.items() if now - s["received_at"] > self.max_age]:
+                del self._stations[idema]
+            if set(self._stations) != stations_before:
+                # Nuevas estaciones o bajas: la asignación de cada parada se recalcula
+                self._assignments.clear()
+            if changed or set(self._stations) != stations_before:
+                self._blended.clear()
+        return changed
+
+    # --- asignación ---
+
+    def _assign(self, stop: str, coords: Tuple[float, float]) -> Tuple[Tuple[str, float], ...]:
+        ranked = sorted(
+            (_distance_km(*coords, s["lat"], s["lon"]), idema) for idema, s in self._stations.items()
+        )[: self.k]
+        if not ranked:
+            return ()
+        if self.mode == NEAREST or ranked[0][0] < 1e-3:
+            assignment: Tuple[Tuple[str, float], ...] = ((ranked[0][1], 1.0),)
+        else:
+            weights = [(idema, 1.0 / d ** self.power) for d, idema in ranked]
+            total = sum(w for _, w in weights)
+            assignment = tuple((idema, w / total) for idema, w in weights)
+        self._assignments[stop] = assignment
+        return assignment
+
+    def precompute(self, stops: Dict[str, Dict[str, Any]]) -> int:
+        """
+        Calcula por adelantado la asignación de las paradas ``{parada: {"lat", "lon"}}``
+        (p. ej. las de `StopMetadataCache`). Devuelve cuántas se han asignado.
+        """
+        assigned = 0
+        with self._lock:
+            for stop, value in stops.items():
+                coords = _coords(value)
+                if coords is not None and self._assign(str(stop), coords):
+                    assigned += 1
+        return assigned
+
+    def stations_for(self, stop: Any) -> Tuple[Tuple[str, float], ...]:
+        """Estaciones asignadas a `stop` con su peso (vacío si no se conocen)."""
+        return self._assignments.get(str(stop), ())
+
+    # --- consulta ---
+
+    def weather_for(self, arrival: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Clima de la parada de `arrival` (usa `stop` y `stop_coords`), o None
+        si la parada no tiene coordenadas o no hay estaciones.
+        """
+        stop = str(arrival.get("stop"))
+        assignment = self._assignments.get(stop)
+        if assignment is None:
+            coords = _coords(arrival.get("stop_coords"))
+            if coords is None:
+                return None
+            with self._lock:
+                assignment = self._assignments.get(stop) or self._assign(stop, coords)
+        if not assignment:
+            return None
+        if len(assignment) == 1:
+            station = self._stations.get(assignment[0][0])
+            return station["weather"] if station else None
+        blended = self._blended.get(stop)
+        if blended is None:
+            with self._lock:
+                blended = self._blended[stop] = self._blend(assignment)
+        return blended
+
+    def _blend(self, assignment: Tuple[Tuple[str, float], ...]) -> Dict[str, Any]:
+        present = [(self._stations[i]["weather"], w) for i, w in assignment if i in self._stations]
+        if not present:
+            return {}
+        # Los campos no numéricos (p. ej. observed_at) se toman de la estación más cercana
+        blended = dict(present[0][0])
+        blended.pop("station_id", None)
+        for name in _IDW_FIELDS:
+            values = [(w[name], weight) for w, weight in present if isinstance(w.get(name), (int, float))]
+            total = sum(weight for _, weight in values)
+            if values and total > 0:
+                blended[name] = sum(v * weight for v, weight in values) / total
+        if isinstance(blended.get("precipitation"), float):
+            blended["is_raining"] = blended["precipitation"] > 0.0
+        blended["stations"] = [{"station_id": w.get("station_id"), "weight": weight} for w, weight in present]
+        return blended
+
+    def nearest_weather(self, lat: float, lon: float) -> Optional[Dict[str, Any]]:
+        """Clima de la estación más cercana a un punto (p. ej. el centro, como valor por defecto)."""
+        with self._lock:
+            ranked = sorted(
+                (_distance_km(lat, lon, s["lat"], s["lon"]), idema) for idema, s in self._stations.items()
+            )
+            return self._stations[ranked[0][1]]["weather"] if ranked else None
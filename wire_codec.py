@@ -0,0 +1,123 @@
+# python
+"""
+Codificación de los payloads publicados en RabbitMQ.
+
+Un códec se elige por nombre con el formato ``<formato>[+<compresión>]``:
+
+- Formatos: ``json`` (por defecto) y ``msgpack`` (binario compacto; requiere
+  el paquete opcional `msgpack`).
+- Compresión: ``gzip`` o ``zlib``.
+
+Ejemplos: ``json``, ``json+gzip``, ``json+zlib``, ``msgpack``, ``msgpack+zlib``.
+
+El formato se anuncia en `content_type` y la compresión en `content_encoding`
+(``gzip`` o ``deflate``), de modo que los consumidores pueden usar
+`decode_payload` sin conocer de antemano el códec del productor.
+"""
+
+import gzip
+import json
+import zlib
+from dataclasses import dataclass
+from typing import Any, Optional
+
+try:
+    import msgpack
+except ImportError:  # dependencia opcional
+    msgpack = None
+
+JSON_CONTENT_TYPE = "application/json"
+MSGPACK_CONTENT_TYPE = "application/msgpack"
+
+_CONTENT_TYPES = {"json": JSON_CONTENT_TYPE, "msgpack": MSGPACK_CONTENT_TYPE}
+# Nombre de la compresión en el códec -> valor de `content_encoding`
+_CONTENT_ENCODINGS = {"gzip": "gzip", "zlib": "deflate"}
+
+
+@dataclass(frozen=True)
+class WireCodec:
+    """
+    Códec de un payload: serialización + compresión opcional.
+
+    Attributes:
+        fmt (str): ``json`` o ``msgpack``.
+        compression (Optional[str]): ``gzip``, ``zlib`` o None.
+        level (int): Nivel de compresión (1 rápido ... 9 máximo).
+    """
+
+    fmt: str = "json"
+    compression: Optional[str] = None
+    level: int = 6
+
+    @property
+    def name(self) -> str:
+        return f"{self.fmt}+{self.compression}" if self.compression else self.fmt
+
+    @property
+    def content_type(self) -> str:
+        return _CONTENT_TYPES[self.fmt]
+
+    @property
+    def content_encoding(self) -> Optional[str]:
+        return _CONTENT_ENCODINGS[self.compression] if self.compression else None
+
+    def encode(self, payload: Any) -> bytes:
+        if self.fmt == "msgpack":
+            body = msgpack.packb(payload, use_bin_type=True)
+        else:
+            body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+        if self.compression == "gzip":
+            return gzip.compress(body, compresslevel=self.level, mtime=0)
+        if self.compression == "zlib":
+            return zlib.compress(body, self.level)
+        return body
+
+
+def get_codec(name: Optional[str] = None, level: int = 6) -> WireCodec:
+    """
+    Devuelve el códec para `name` (p. ej. ``json+gzip``).
+
+    Raises:
+        ValueError: Si el nombre no es válido o `msgpack` no está instalado.
+    """
+    fmt, _, compression = (name or "json").strip().lower().partition("+")
+    if fmt not in _CONTENT_TYPES:
+        raise ValueError(f"Formato de códec desconocido: {fmt!r} (usa json o msgpack)")
+    if compression and compression not in _CONTENT_ENCODINGS:
+        raise ValueError(f"Compresión desconocida: {compression!r} (usa gzip o zlib)")
+    if fmt == "msgpack" and msgpack is None:
+        raise ValueError("El códec msgpack requiere instalar el paquete `msgpack`.")
+    return WireCodec(fmt=fmt, compression=compression or None, level=level)
+
+
+def decode_payload(
+        body: bytes,
+        content_type: Optional[str] = None,
+        content_encoding: Optional[str] = None,
+) -> Any:
+    """
+    Decodifica un mensaje a partir de sus propiedades AMQP.
+
+    Pensado para los consumidores: ``decode_payload(body,
+    properties.content_type, properties.content_encoding)``.
+
+    Raises:
+        ValueError: Si la codificación o el tipo de contenido no se reconocen.
+    """
+    encoding = (content_encoding or "").lower()
+    if encoding == "gzip":
+        body = gzip.decompress(body)
+    elif encoding == "deflate":
+        body = zlib.decompress(body)
+    elif encoding not in ("", "identity", "utf-8"):
+        raise ValueError(f"content_encoding no soportado: {content_encoding!r}")
+
+    ctype = (content_type or JSON_CONTENT_TYPE).split(";")[0].strip().lower()
+    if ctype in (MSGPACK_CONTENT_TYPE, "application/x-msgpack"):
+        if msgpack is None:
+            raise ValueError("Se recibió msgpack pero el paquete `msgpack` no está instalado.")
+        return msgpack.unpackb(body, raw=False)
+    if ctype == JSON_CONTENT_TYPE:
+        return json.loads(body.decode("utf-8"))
+    raise ValueError(f"content_type no soportado: {content_type!r}")